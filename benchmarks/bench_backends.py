@@ -0,0 +1,83 @@
+'''
+Время ответа Dispatcher на запросы рейсов и локаций: запросы к БД (sql) и снимок рейсов в памяти (columnar).
+Запуск из корня проекта: python -m benchmarks.bench_backends --routes 300 --days 120
+'''
+import argparse
+import datetime
+import os.path
+import random
+import tempfile
+import time
+
+from benchmarks.bench_loader import make_settings
+from tickets import Dispatcher
+
+
+def make_queries(routes, num_queries, seed):
+    """ Запросы в духе сценария бота: маршрут с датой, только город вылета, списки локаций, проверка маршрута """
+
+    rnd = random.Random(seed)
+    now = datetime.datetime.now()
+    queries = []
+    for _ in range(num_queries):
+        from_, to_ = rnd.choice(routes)
+        when_ = now + datetime.timedelta(days=rnd.randrange(60), minutes=rnd.randrange(24 * 60))
+        queries.append((from_, to_, when_))
+    return queries
+
+
+def measure(dispatcher, queries):
+    """ мкс на вызов для каждого метода API """
+
+    calls = {
+        'get_tickets (маршрут)': lambda from_, to_, when_: dispatcher.get_tickets(when_, from_, to_, limit=5,
+                                                                                  use_cache=False),
+        'get_tickets (вылет)': lambda from_, to_, when_: dispatcher.get_tickets(when_, from_, limit=5,
+                                                                                use_cache=False),
+        'get_departure_locations': lambda from_, to_, when_: dispatcher.get_departure_locations(when_),
+        'is_route_available': lambda from_, to_, when_: dispatcher.is_route_available(from_, to_, when_),
+    }
+
+    result = {}
+    for title, call in calls.items():
+        started = time.perf_counter()
+        for query in queries:
+            call(*query)
+        result[title] = (time.perf_counter() - started) / len(queries) * 1e6
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк источников ответов Dispatcher')
+    parser.add_argument('--routes', type=int, default=300)
+    parser.add_argument('--days', type=int, default=120)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    settings = make_settings(args.routes, args.days, args.seed)
+    routes = [(cfg['from_'], cfg['to_'])
+              for key in ('daily_tickets', 'tickets_on_weekdays', 'tickets_on_monthdays')
+              for cfg in settings[key]]
+    queries = make_queries(routes, args.queries, args.seed)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_url = f'sqlite:///{os.path.join(tmp_dir, "bench.sqlite")}'
+        stats = Dispatcher(db_url)._create_tickets_in_db(settings=settings)
+        print(f'Рейсов в БД: {stats["rows"]}')
+
+        sql = Dispatcher(db_url, use_route_index=False, tickets_cache_size=0)
+        columnar = Dispatcher(db_url, tickets_cache_size=0, backend='columnar')
+        started = time.perf_counter()
+        columnar.inventory.get(columnar.inventory_version)
+        print(f'Построение снимка в памяти: {time.perf_counter() - started:.2f} сек.')
+
+        sql_result, columnar_result = measure(sql, queries), measure(columnar, queries)
+        print(f'{"запрос":<26} {"sql, мкс":>12} {"columnar, мкс":>14} {"ускорение":>10}')
+        for title, sql_time in sql_result.items():
+            columnar_time = columnar_result[title]
+            print(f'{title:<26} {sql_time:>12.1f} {columnar_time:>14.1f} {sql_time / columnar_time:>9.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+'''
+Пропускная способность Bot.on_event на полных разговорах: заказ билета, помощь, непонятные сообщения.
+Разговоры многих собеседников перемешаны, ответы уходят в фейковый api, рейсы - из временной БД.
+Результат (событий/сек., задержки p50/p95/p99 по шагам сценария, рост памяти) печатается и сохраняется в JSON.
+Запуск из корня проекта: python -m benchmarks.bench_conversations --conversations 2000 --peers 200
+'''
+import argparse
+import datetime
+import json
+import logging
+import os.path
+import platform
+import random
+import re
+import resource
+import tempfile
+import time
+
+from vk_api.bot_longpoll import VkBotMessageEvent
+
+import settings
+from bot import Bot
+from tickets import Dispatcher
+
+FLIGHT_ID_PATTERN = re.compile(r'ID: <(\d+)>')
+STEPS = settings.SCENARIOS['ticket']['steps']
+
+
+class FakeMessages:
+    def __init__(self):
+        self.sent = 0
+        self.last = {}  # peer_id -> текст последнего ответа
+
+    def send(self, peer_id, random_id, message):
+        self.sent += 1
+        self.last[peer_id] = message
+        return self.sent
+
+
+class FakeApi:
+    """ Вместо vk api: ответы бота запоминаются, чтобы разговор мог на них опираться (ID рейса) """
+
+    def __init__(self):
+        self.messages = FakeMessages()
+
+
+def make_event(peer_id, text, message_id):
+    return VkBotMessageEvent({
+        'type': 'message_new',
+        'object': {'message': {'date': int(time.time()), 'from_id': peer_id, 'id': message_id, 'out': 0,
+                               'peer_id': peer_id, 'text': text, 'conversation_message_id': message_id,
+                               'fwd_messages': [], 'important': False, 'random_id': 0, 'attachments': [],
+                               'is_hidden': False}},
+        'group_id': settings.GROUP_ID,
+        'event_id': f'{peer_id}-{message_id}',
+    })
+
+
+def ticket_conversation(rnd, routes, quit_early=False):
+    """
+    Генератор реплик собеседника при заказе билета: выдает (шаг, текст), получает ответ бота.
+    Шаг - имя обработчика сценария, которому достанется реплика.
+    """
+
+    from_, to_ = rnd.choice(routes)
+    yield 'start', rnd.choice((settings.SCENARIOS['ticket']['main_token'], 'хочу билет', 'заказать'))
+    yield STEPS[1]['handler'], from_[:-1].lower() if len(from_) > 4 else from_  # "москв" - по префиксу
+    yield STEPS[2]['handler'], to_.lower()
+    if quit_early:
+        yield 'quit', settings.SCENARIOS['ticket']['quit_token']
+        return
+
+    when_ = datetime.date.today() + datetime.timedelta(days=rnd.randrange(1, 30))
+    reply = yield STEPS[3]['handler'], when_.strftime('%d-%m-%Y')
+    flight_ids = FLIGHT_ID_PATTERN.findall(reply)
+    if not flight_ids:
+        return  # на эту дату рейсов нет - бот завершил сценарий
+
+    yield STEPS[4]['handler'], rnd.choice(flight_ids)
+    yield STEPS[5]['handler'], str(rnd.randint(1, 5))
+    yield STEPS[6]['handler'], 'оплата картой'
+    yield STEPS[7]['handler'], 'да'
+    yield STEPS[8]['handler'], f'+79{rnd.randrange(10 ** 9):09d}'
+
+
+def help_conversation(rnd):
+    yield 'help', rnd.choice((settings.SCENARIOS['ticket']['help_token'], 'помогите', 'расскажите подробнее'))
+
+
+def unknown_conversation(rnd):
+    yield 'unknown', rnd.choice(('привет', 'добрый день', 'спасибо', 'ок'))
+
+
+def make_conversation(rnd, routes):
+    kind = rnd.random()
+    if kind < 0.6:
+        return ticket_conversation(rnd, routes)
+    if kind < 0.7:
+        return ticket_conversation(rnd, routes, quit_early=True)
+    if kind < 0.85:
+        return help_conversation(rnd)
+    return unknown_conversation(rnd)
+
+
+def percentile(sorted_values, share):
+    return sorted_values[min(len(sorted_values) - 1, int(share * len(sorted_values)))]
+
+
+def get_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run(bot, routes, num_conversations, num_peers, seed):
+    """ Прогон разговоров: собеседники ходят вперемешку, на месте завершенного разговора начинается новый """
+
+    rnd = random.Random(seed)
+    latencies = {}  # шаг -> задержки on_event, сек.
+    active = []  # [peer_id, разговор, очередная реплика]
+    started_conversations = events = 0
+
+    def start_conversation():
+        nonlocal started_conversations
+        conversation = make_conversation(rnd, routes)
+        active.append([1000000 + started_conversations, conversation, next(conversation)])
+        started_conversations += 1
+
+    while started_conversations < min(num_peers, num_conversations):
+        start_conversation()
+
+    started = time.perf_counter()
+    while active:
+        position = rnd.randrange(len(active))
+        peer_id, conversation, (step, text) = active[position]
+
+        events += 1
+        event = make_event(peer_id, text, events)
+        event_started = time.perf_counter()
+        bot.on_event(event)
+        latencies.setdefault(step, []).append(time.perf_counter() - event_started)
+
+        try:
+            active[position][2] = conversation.send(bot.api.messages.last[peer_id])
+        except StopIteration:
+            active.pop(position)
+            if started_conversations < num_conversations:
+                start_conversation()
+    elapsed = time.perf_counter() - started
+
+    return events, elapsed, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк обработки разговоров Bot.on_event')
+    parser.add_argument('--conversations', type=int, default=2000)
+    parser.add_argument('--peers', type=int, default=200, help='кол-во одновременно идущих разговоров')
+    parser.add_argument('--backend', default='sql', help='источник рейсов Dispatcher: sql или columnar')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='bench_conversations.json', help='файл для результатов в JSON')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_url = f'sqlite:///{os.path.join(tmp_dir, "bench.sqlite")}'
+        Dispatcher(db_url)._create_tickets_in_db()
+
+        bot = Bot(settings.TOKEN, settings.GROUP_ID, poll=False)
+        logging.getLogger('bot_logger').setLevel(logging.WARNING)  # без записи о каждом заказе
+        bot.api = FakeApi()
+        bot.tickets_api = Dispatcher(db_url, backend=args.backend)
+        bot.departures = bot.tickets_api.get_departure_locations()
+        bot.arrivals = bot.tickets_api.get_arrival_locations()
+
+        routes = [(from_, to_) for from_ in bot.departures for to_ in bot.arrivals
+                  if bot.tickets_api.is_route_available(from_, to_)]
+
+        rss_before = get_rss_kb()
+        events, elapsed, latencies = run(bot, routes, args.conversations, args.peers, args.seed)
+        rss_after = get_rss_kb()
+
+    steps = {}
+    for step, values in latencies.items():
+        values.sort()
+        steps[step] = {
+            'count': len(values),
+            'p50_ms': percentile(values, 0.50) * 1e3,
+            'p95_ms': percentile(values, 0.95) * 1e3,
+            'p99_ms': percentile(values, 0.99) * 1e3,
+        }
+
+    result = {
+        'params': vars(args),
+        'python': platform.python_version(),
+        'events': events,
+        'seconds': elapsed,
+        'events_per_second': events / elapsed,
+        'conversations_per_second': args.conversations / elapsed,
+        'max_rss_growth_kb': rss_after - rss_before,
+        'sessions_left': len(bot.user_states),
+        'steps': steps,
+    }
+
+    print(f'Событий: {events} за {elapsed:.2f} сек.: {result["events_per_second"]:.0f} событий/сек., '
+          f'{result["conversations_per_second"]:.0f} разговоров/сек.')
+    print(f'Рост пикового RSS: {result["max_rss_growth_kb"]} Кб, сессий осталось: {result["sessions_left"]}')
+    print(f'{"шаг":<20} {"событий":>8} {"p50, мс":>9} {"p95, мс":>9} {"p99, мс":>9}')
+    for step, stats in steps.items():
+        print(f'{step:<20} {stats["count"]:>8} {stats["p50_ms"]:>9.3f} {stats["p95_ms"]:>9.3f} {stats["p99_ms"]:>9.3f}')
+
+    with open(args.output, 'w', encoding='utf8') as file:
+        json.dump(result, file, ensure_ascii=False, indent=2)
+    print(f'Результаты сохранены в {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+'''
+Сравнение поиска интентов: перебор токенов (как было в Bot.on_event) и автомат IntentMatcher.
+Запуск из корня проекта: python -m benchmarks.bench_intents
+'''
+import argparse
+import random
+import time
+
+from intents import IntentMatcher
+
+ALPHABET = 'абвгдеёжзийклмнопрстуфхцчшщъыьэюя'
+
+
+def random_word(rnd, min_len=3, max_len=10):
+    return ''.join(rnd.choice(ALPHABET) for _ in range(rnd.randint(min_len, max_len)))
+
+
+def make_intents(rnd, num_intents, tokens_per_intent):
+    return [
+        {
+            'name': f'интент {index}',
+            'tokens': tuple(random_word(rnd, 4, 12) for _ in range(tokens_per_intent)),
+            'answer': f'ответ {index}',
+        }
+        for index in range(num_intents)
+    ]
+
+
+def make_messages(rnd, intents, num_messages, words_per_message):
+    messages = []
+    for _ in range(num_messages):
+        words = [random_word(rnd) for _ in range(words_per_message)]
+        if rnd.random() < 0.5:  # половина сообщений содержит токен какого-либо интента
+            intent = rnd.choice(intents)
+            words.insert(rnd.randrange(len(words) + 1), rnd.choice(intent['tokens']))
+        messages.append(' '.join(words))
+    return messages
+
+
+def match_by_scan(intents, text):
+    for intent in intents:
+        if any(token in text for token in intent['tokens']):
+            return intent
+    return None
+
+
+def measure(func, messages):
+    started = time.perf_counter()
+    results = [func(message) for message in messages]
+    return time.perf_counter() - started, results
+
+
+def run(num_messages, words_per_message, tokens_per_intent, seed):
+    rnd = random.Random(seed)
+    print(f'{"интентов":>9} {"токенов":>8} {"перебор, мкс":>13} {"индекс, мкс":>12} {"ускорение":>10} {"сборка, мс":>11}')
+
+    for num_intents in (2, 10, 100, 500, 1000):
+        intents = make_intents(rnd, num_intents, tokens_per_intent)
+        messages = make_messages(rnd, intents, num_messages, words_per_message)
+
+        started = time.perf_counter()
+        matcher = IntentMatcher(intents, scan_threshold=0)
+        build_time = time.perf_counter() - started
+
+        scan_time, scan_results = measure(lambda text: match_by_scan(intents, text), messages)
+        index_time, index_results = measure(matcher.match, messages)
+        assert scan_results == index_results, 'результаты поиска интентов не совпадают'
+
+        print(f'{num_intents:>9} {num_intents * tokens_per_intent:>8} '
+              f'{scan_time / num_messages * 1e6:>13.1f} {index_time / num_messages * 1e6:>12.1f} '
+              f'{scan_time / index_time:>9.1f}x {build_time * 1e3:>11.1f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк поиска интентов')
+    parser.add_argument('--messages', type=int, default=2000, help='кол-во сообщений')
+    parser.add_argument('--words', type=int, default=12, help='кол-во слов в сообщении')
+    parser.add_argument('--tokens', type=int, default=10, help='кол-во токенов на интент')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    run(args.messages, args.words, args.tokens, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+'''
+Скорость загрузки рейсов: ORM (session.add_all, как было в _create_tickets_in_db) и пакетная запись add_tickets.
+Запуск из корня проекта: python -m benchmarks.bench_loader --routes 1000 --days 365
+'''
+import argparse
+import datetime
+import os.path
+import random
+import tempfile
+import time
+
+from tickets import Dispatcher, Ticket
+
+
+def make_settings(num_routes, num_days, seed):
+    """ Расписание из num_routes маршрутов: ежедневные, по дням недели и по дням месяца """
+
+    rnd = random.Random(seed)
+    settings = {'num_days': num_days, 'daily_tickets': [], 'tickets_on_weekdays': [], 'tickets_on_monthdays': []}
+
+    for number in range(num_routes):
+        cfg = {
+            'from_': f'Город {number % 97}',
+            'to_': f'Город {number}',
+            'when_': (rnd.randrange(24), rnd.randrange(0, 60, 5)),
+            'price': float(rnd.randrange(3000, 40000, 100)),
+        }
+        kind = number % 3
+        if kind == 0:
+            settings['daily_tickets'].append(cfg)
+        elif kind == 1:
+            cfg['weekdays'] = tuple(sorted(rnd.sample(range(7), 3)))
+            settings['tickets_on_weekdays'].append(cfg)
+        else:
+            cfg['monthdays'] = list(range(1, 31, rnd.randint(2, 5)))
+            settings['tickets_on_monthdays'].append(cfg)
+
+    return settings
+
+
+def load_with_orm(dispatcher, rows):
+    started = time.perf_counter()
+    with dispatcher._session_scope() as session:
+        session.add_all([Ticket(**row) for row in rows])
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк загрузки рейсов')
+    parser.add_argument('--routes', type=int, default=1000)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--chunk-size', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    settings = make_settings(args.routes, args.days, args.seed)
+    start_date = datetime.datetime.now()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        orm_dispatcher = Dispatcher(f'sqlite:///{os.path.join(tmp_dir, "orm.sqlite")}')
+        rows = list(orm_dispatcher._generate_schedule(start_date, args.days, settings))
+        orm_seconds = load_with_orm(orm_dispatcher, rows)
+        print(f'ORM add_all:            {len(rows)} строк, {orm_seconds:.2f} сек. '
+              f'({len(rows) / orm_seconds:.0f} строк/сек.)')
+
+        dispatcher = Dispatcher(f'sqlite:///{os.path.join(tmp_dir, "bulk.sqlite")}')
+        for title in ('пакетная запись:', 'повторный запуск:'):
+            stats = dispatcher._create_tickets_in_db(start_date=start_date, settings=settings,
+                                                     chunk_size=args.chunk_size)
+            print(f'{title:<23} {stats["rows"]} строк, записано {stats["inserted"]}, {stats["seconds"]:.2f} сек. '
+                  f'({stats["rows_per_second"]:.0f} строк/сек.)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+'''
+Скорость записи заказов: по одному заказу в транзакции (как если бы бот писал заказ на пути ответа)
+и групповая запись OrderWriter. Для каждого способа - заказов/сек. и время, на которое вызов задерживает
+поток обработки сообщения (p50/p99).
+Запуск из корня проекта: python -m benchmarks.bench_orders --orders 20000 --threads 8
+'''
+import argparse
+import datetime
+import os.path
+import tempfile
+import threading
+import time
+
+from benchmarks.bench_conversations import percentile
+from orders import OrderWriter
+from tickets import Dispatcher
+
+
+def make_order(peer_id):
+    return {
+        'peer_id': peer_id,
+        'from_': 'Москва',
+        'to_': 'Екатеринбург',
+        'flight_id': peer_id % 1000 + 1,
+        'flight_when_': datetime.datetime(2030, 1, 1, 9, 0),
+        'tickets_qty': 2,
+        'price': 4000.0,
+        'total': 8000.0,
+        'phone': '89991234567',
+        'comment': 'у окна',
+        'created_at': datetime.datetime.now(),
+    }
+
+
+def run(submit, num_orders, num_threads):
+    """ num_orders заказов из num_threads потоков. Возвращает задержки вызова submit, сек. """
+
+    latencies = [[] for _ in range(num_threads)]
+
+    def worker(index):
+        for peer_id in range(index, num_orders, num_threads):
+            order = make_order(peer_id)
+            started = time.perf_counter()
+            submit(order)
+            latencies[index].append(time.perf_counter() - started)
+
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sorted(value for values in latencies for value in values)
+
+
+def report(title, num_orders, seconds, latencies):
+    print(f'{title:<28} {num_orders / seconds:>9.0f} заказов/сек. {seconds:>7.2f} сек. '
+          f'задержка p50 {percentile(latencies, 0.50) * 1e6:>8.1f} мкс, p99 {percentile(latencies, 0.99) * 1e6:>9.1f} мкс')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк записи заказов')
+    parser.add_argument('--orders', type=int, default=20000)
+    parser.add_argument('--threads', type=int, default=8, help='потоки, оформляющие заказы')
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--flush-interval', type=float, default=0.05)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dispatcher = Dispatcher(f'sqlite:///{os.path.join(tmp_dir, "sync.sqlite")}')
+        started = time.perf_counter()
+        latencies = run(lambda order: dispatcher.add_orders([order]), args.orders, args.threads)
+        report('транзакция на заказ:', args.orders, time.perf_counter() - started, latencies)
+        dispatcher.close()
+
+        dispatcher = Dispatcher(f'sqlite:///{os.path.join(tmp_dir, "group.sqlite")}')
+        writer = OrderWriter(dispatcher.add_orders, batch_size=args.batch_size, flush_interval=args.flush_interval)
+        started = time.perf_counter()
+        latencies = run(writer.submit, args.orders, args.threads)
+        writer.close()  # время включает запись всех заказов в БД
+        report('групповая запись:', args.orders, time.perf_counter() - started, latencies)
+        print(f'{"":<28} пачек {writer.batches_written}, в БД {len(dispatcher.get_orders())} заказов')
+        dispatcher.close()
+
+
+if __name__ == '__main__':
+    main()
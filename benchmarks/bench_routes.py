@@ -0,0 +1,71 @@
+'''
+Запросы к БД и время на разговор: проверка маршрута запросом COUNT и по индексу маршрутов в памяти.
+Запуск из корня проекта: python -m benchmarks.bench_routes
+'''
+import argparse
+import os.path
+import random
+import tempfile
+import time
+
+from sqlalchemy import event
+
+from tickets import Dispatcher
+
+
+class QueryCounter:
+    """ Считает SQL-запросы, выполненные через engine """
+
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self._on_execute)
+
+    def _on_execute(self, *args, **kwargs):
+        self.count += 1
+
+
+def run_conversations(dispatcher, routes, num_conversations, seed):
+    """ Шаги сценария, обращающиеся к БД: проверка маршрута (handle_arrival) и поиск рейсов (handle_date) """
+
+    rnd = random.Random(seed)
+    for _ in range(num_conversations):
+        from_, to_ = rnd.choice(routes)
+        if dispatcher.is_route_available(from_=from_, to_=to_):
+            dispatcher.get_tickets(from_=from_, to_=to_, limit=5)
+
+
+def measure(db_url, routes, num_conversations, seed, use_route_index):
+    dispatcher = Dispatcher(db_url, use_route_index=use_route_index)
+    counter = QueryCounter(dispatcher.engine)
+
+    started = time.perf_counter()
+    run_conversations(dispatcher, routes, num_conversations, seed)
+    elapsed = time.perf_counter() - started
+
+    return counter.count / num_conversations, elapsed / num_conversations
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк проверки доступности маршрутов')
+    parser.add_argument('--conversations', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_url = f'sqlite:///{os.path.join(tmp_dir, "bench.sqlite")}'
+        Dispatcher(db_url)._create_tickets_in_db()
+
+        settings = Dispatcher.settings
+        routes = [(cfg['from_'], cfg['to_'])
+                  for key in ('daily_tickets', 'tickets_on_weekdays', 'tickets_on_monthdays')
+                  for cfg in settings[key]]
+        routes.append(('Москва', 'Краби'))  # недоступный маршрут
+
+        print(f'{"проверка маршрута":<20} {"запросов на разговор":>21} {"мс на разговор":>15}')
+        for title, use_route_index in (('запрос COUNT', False), ('индекс в памяти', True)):
+            queries, seconds = measure(db_url, routes, args.conversations, args.seed, use_route_index)
+            print(f'{title:<20} {queries:>21.2f} {seconds * 1e3:>15.3f}')
+
+
+if __name__ == '__main__':
+    main()
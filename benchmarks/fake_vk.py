@@ -0,0 +1,235 @@
+'''
+Локальный стенд VK API для нагрузочных тестов бота без группы и токена:
+groups.getLongPollServer, цикл long poll (act=a_check), messages.send и execute с вызовами messages.send.
+Бот подключается к стенду через settings.VK_API_URL (или параметр api_url класса Bot).
+Отдельный запуск из корня проекта: python -m benchmarks.fake_vk --port 8081
+'''
+import argparse
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+EXECUTE_SEND_CALL = 'API.messages.send('
+
+
+def parse_execute_code(code):
+    """ Параметры вызовов API.messages.send из кода VKScript, который формирует sender.build_execute_code """
+
+    decoder = json.JSONDecoder()
+    calls = []
+    position = code.find(EXECUTE_SEND_CALL)
+    while position >= 0:
+        params, end = decoder.raw_decode(code, position + len(EXECUTE_SEND_CALL))
+        calls.append(params)
+        position = code.find(EXECUTE_SEND_CALL, end)
+    return calls
+
+
+class FakeVkServer:
+    """
+    Стенд хранит входящие сообщения пользователей как события long poll (ts - номер события)
+    и передает ответы бота в on_reply(peer_id, message, received_at).
+    Повторная отправка с тем же random_id собеседнику не доставляется, как и в VK.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, group_id=1, on_reply=None, max_events=100000):
+        """
+        :param port: int - порт (0 - любой свободный)
+        :param on_reply: функция (peer_id, message, received_at), вызывается в потоке HTTP сервера
+        :param max_events: int - сколько последних событий хранится для long poll
+        """
+
+        self.group_id = group_id
+        self.on_reply = on_reply
+        self.max_events = max_events
+        self.key = 'fake-key'
+
+        self._events = []  # события с номерами от _first_ts
+        self._first_ts = 1
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._message_ids = itertools.count(1)
+        self._sent = {}  # (peer_id, random_id) -> id сообщения
+        self._sent_lock = threading.Lock()
+
+        # статистика
+        self.messages_received = 0
+        self.replies_sent = 0
+        self.duplicates = 0
+        self.execute_calls = 0
+
+        handler = type('RequestHandler', (FakeVkRequestHandler,), {'server_api': self})
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    @property
+    def api_url(self):
+        return f'{self.url}/method/'
+
+    @property
+    def ts(self):
+        """ ts, который получит следующее событие """
+        return self._first_ts + len(self._events)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='fake-vk', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True  # ожидающие long poll запросы сразу получают ответ
+            self._condition.notify_all()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def push_message(self, peer_id, text):
+        """ Сообщение пользователя боту: становится событием message_new в long poll """
+
+        with self._condition:
+            ts = self.ts
+            self._events.append({
+                'type': 'message_new',
+                'object': {
+                    'message': {'date': int(time.time()), 'from_id': peer_id, 'id': ts, 'out': 0, 'peer_id': peer_id,
+                                'text': text, 'conversation_message_id': ts, 'fwd_messages': [], 'important': False,
+                                'random_id': 0, 'attachments': [], 'is_hidden': False},
+                    'client_info': {'button_actions': ['text'], 'keyboard': True, 'inline_keyboard': True,
+                                    'lang_id': 0},
+                },
+                'group_id': self.group_id,
+                'event_id': f'fake-{ts}',
+            })
+            if len(self._events) > self.max_events:
+                trimmed = len(self._events) - self.max_events
+                del self._events[:trimmed]
+                self._first_ts += trimmed
+            self.messages_received += 1
+            self._condition.notify_all()
+        return ts
+
+    def get_updates(self, ts, wait):
+        """ Ответ на a_check: события начиная с ts, ожидание новых до wait секунд """
+
+        deadline = time.monotonic() + wait
+        with self._condition:
+            if ts < self._first_ts:
+                return {'failed': 1, 'ts': str(self.ts)}  # история событий устарела
+            while ts >= self.ts and not self._stopped:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            updates = self._events[ts - self._first_ts:]
+            return {'ts': str(self._first_ts + len(self._events)), 'updates': updates}
+
+    def send_message(self, params):
+        """ messages.send: id сообщения; повтор random_id собеседнику не доставляется """
+
+        peer_id, random_id = int(params['peer_id']), int(params.get('random_id', 0))
+        with self._sent_lock:
+            message_id = self._sent.get((peer_id, random_id)) if random_id else None
+            if message_id is not None:
+                self.duplicates += 1
+                return message_id
+            message_id = next(self._message_ids)
+            if random_id:
+                self._sent[(peer_id, random_id)] = message_id
+            self.replies_sent += 1
+
+        if self.on_reply is not None:
+            self.on_reply(peer_id, params.get('message', ''), time.monotonic())
+        return message_id
+
+    def call_method(self, method, params):
+        if method == 'groups.getLongPollServer':
+            return {'key': self.key, 'server': f'{self.url}/longpoll', 'ts': str(self.ts)}
+        if method == 'messages.send':
+            return self.send_message(params)
+        if method == 'execute':
+            self.execute_calls += 1
+            return [self.send_message(call) for call in parse_execute_code(params.get('code', ''))]
+        raise LookupError(method)
+
+
+class FakeVkRequestHandler(BaseHTTPRequestHandler):
+    server_api = None  # FakeVkServer
+    protocol_version = 'HTTP/1.1'  # соединения requests.Session переиспользуются
+    disable_nagle_algorithm = True  # иначе заголовки и тело ответа расходятся с задержкой ~40 мс
+
+    def _read_params(self):
+        parts = urlsplit(self.path)
+        params = dict(parse_qsl(parts.query))
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            params.update(parse_qsl(self.rfile.read(length).decode('utf8')))
+        return parts.path, params
+
+    def _send_json(self, data):
+        body = json.dumps(data, ensure_ascii=False).encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self):
+        path, params = self._read_params()
+        api = self.server_api
+
+        if path == '/longpoll':
+            if params.get('key') != api.key:
+                self._send_json({'failed': 2})
+                return
+            self._send_json(api.get_updates(int(params.get('ts', api.ts)), float(params.get('wait', 25))))
+            return
+
+        if path.startswith('/method/'):
+            method = path[len('/method/'):]
+            try:
+                self._send_json({'response': api.call_method(method, params)})
+            except LookupError:
+                self._send_json({'error': {'error_code': 3, 'error_msg': f'Unknown method passed: {method}',
+                                           'request_params': []}})
+            return
+
+        self.send_error(404)
+
+    do_GET = _handle
+    do_POST = _handle
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Локальный стенд VK API для бота')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    args = parser.parse_args()
+
+    def print_reply(peer_id, message, received_at):
+        print(f'<- {peer_id}: {message}')
+
+    server = FakeVkServer(args.host, args.port, on_reply=print_reply).start()
+    print(f'Стенд VK API: {server.api_url} (VK_API_URL в settings.py)')
+    print('Сообщения боту вводятся в формате "peer_id текст", Ctrl+C - выход')
+    try:
+        while True:
+            peer_id, _, text = input().partition(' ')
+            server.push_message(int(peer_id), text)
+    except (KeyboardInterrupt, EOFError):
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
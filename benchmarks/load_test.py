@@ -0,0 +1,238 @@
+'''
+Нагрузочный тест: тысячи пользователей ведут разговоры с ботом (заказ билета, помощь, непонятные сообщения)
+через локальный стенд VK API с заданной частотой сообщений. Задержка измеряется со стороны пользователя:
+от отправки сообщения в стенд до получения ответа бота.
+Запуск из корня проекта (бот в этом же процессе):
+    python -m benchmarks.load_test --users 2000 --rate 200 --duration 30 --async-workers 16 --batch-window 0.05
+Бот в отдельном процессе (в его settings.py VK_API_URL = 'http://127.0.0.1:8081/method/'):
+    python -m benchmarks.load_test --external --port 8081
+'''
+import argparse
+import heapq
+import json
+import logging
+import os.path
+import random
+import tempfile
+import threading
+import time
+from collections import deque
+
+import settings
+from benchmarks.bench_conversations import make_conversation, percentile
+from benchmarks.fake_vk import FakeVkServer
+from tickets import Dispatcher
+
+
+class VirtualUser:
+    def __init__(self, peer_id, conversation):
+        self.peer_id = peer_id
+        self.conversation = conversation
+        self.step, self.text = next(conversation)
+        self.sent_at = None  # время отправки сообщения, на которое еще нет ответа
+
+
+class LoadGenerator:
+    """
+    Пользователи отправляют сообщения по очереди готовности с общей частотой rate сообщений/сек.
+    Получив ответ, пользователь "думает" think_time сек. и снова становится готов; закончив разговор - начинает новый.
+    """
+
+    def __init__(self, server, routes, num_users, rate, think_time=0.0, seed=1):
+        self.server = server
+        self.routes = routes
+        self.rate = rate
+        self.think_time = think_time
+        self.rnd = random.Random(seed)
+        self._lock = threading.Lock()
+
+        self.users = {}
+        for number in range(num_users):
+            peer_id = 2000000 + number
+            self.users[peer_id] = VirtualUser(peer_id, make_conversation(self.rnd, routes))
+        self._ready = deque(self.users.values())
+        self._thinking = []  # куча (когда готов, peer_id)
+
+        # статистика
+        self.latencies = {}  # шаг сценария -> задержки ответа, сек.
+        self.sent = 0
+        self.replies = 0
+        self.unexpected_replies = 0
+        self.starved = 0  # моменты отправки, когда ни один пользователь не был готов
+        self.conversations_finished = 0
+
+    def on_reply(self, peer_id, message, received_at):
+        with self._lock:
+            user = self.users.get(peer_id)
+            if user is None or user.sent_at is None:
+                self.unexpected_replies += 1
+                return
+
+            self.replies += 1
+            self.latencies.setdefault(user.step, []).append(received_at - user.sent_at)
+            user.sent_at = None
+            try:
+                user.step, user.text = user.conversation.send(message)
+            except StopIteration:
+                self.conversations_finished += 1
+                user.conversation = make_conversation(self.rnd, self.routes)
+                user.step, user.text = next(user.conversation)
+            heapq.heappush(self._thinking, (received_at + self.think_time, peer_id))
+
+    def _next_user(self, now):
+        with self._lock:
+            while self._thinking and self._thinking[0][0] <= now:
+                self._ready.append(self.users[heapq.heappop(self._thinking)[1]])
+            if not self._ready:
+                return None
+            user = self._ready.popleft()
+            user.sent_at = time.monotonic()
+            return user
+
+    def run(self, duration):
+        interval = 1 / self.rate
+        started = next_send = time.monotonic()
+        while next_send < started + duration:
+            delay = next_send - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            next_send += interval
+
+            user = self._next_user(time.monotonic())
+            if user is None:
+                self.starved += 1
+                continue
+            self.server.push_message(user.peer_id, user.text)
+            self.sent += 1
+        return time.monotonic() - started
+
+    @property
+    def pending(self):
+        return sum(user.sent_at is not None for user in self.users.values())
+
+    def drain(self, timeout):
+        """ Дождаться ответов на уже отправленные сообщения. Возвращает кол-во оставшихся без ответа """
+
+        deadline = time.monotonic() + timeout
+        while self.pending and time.monotonic() < deadline:
+            time.sleep(0.05)
+        return self.pending
+
+
+def start_bot(server, db_url, async_workers, batch_window, send_rate):
+    """ Бот в этом же процессе, подключенный к стенду. Возвращает поток бота и событие для его остановки """
+
+    from bot import Bot
+
+    bot = Bot('', server.group_id, api_url=server.api_url)
+    logging.getLogger('bot_logger').setLevel(logging.WARNING)  # без записи о каждом заказе
+    bot.tickets_api = Dispatcher(db_url)
+    bot.warm_up()
+
+    stopped = threading.Event()
+
+    def events():
+        while not stopped.is_set():
+            yield from bot.poller.check()
+
+    thread = threading.Thread(target=bot.serve, name='bot', daemon=True,
+                              kwargs=dict(events=events(), async_workers=async_workers, batch_window=batch_window,
+                                          send_rate=send_rate))
+    thread.start()
+    return thread, stopped
+
+
+def summarize(latencies):
+    values = sorted(value for step_values in latencies.values() for value in step_values)
+    steps = {step: sorted(step_values) for step, step_values in latencies.items()}
+    result = {'all': values}
+    result.update(steps)
+    return {
+        step: {
+            'count': len(values),
+            'p50_ms': percentile(values, 0.50) * 1e3,
+            'p95_ms': percentile(values, 0.95) * 1e3,
+            'p99_ms': percentile(values, 0.99) * 1e3,
+            'max_ms': values[-1] * 1e3,
+        }
+        for step, values in result.items() if values
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный тест бота на локальном стенде VK API')
+    parser.add_argument('--users', type=int, default=2000, help='кол-во пользователей')
+    parser.add_argument('--rate', type=float, default=200, help='частота сообщений пользователей, в сек.')
+    parser.add_argument('--duration', type=float, default=30, help='длительность подачи нагрузки, сек.')
+    parser.add_argument('--think-time', type=float, default=1.0, help='пауза пользователя перед ответом, сек.')
+    parser.add_argument('--drain', type=float, default=30, help='сколько ждать ответов после подачи нагрузки, сек.')
+    parser.add_argument('--async-workers', type=int, default=16, help='потоки бота (для бота в этом процессе)')
+    parser.add_argument('--batch-window', type=float, default=settings.SEND_BATCH_WINDOW,
+                        help='окно пакетной отправки бота, сек. (для бота в этом процессе)')
+    parser.add_argument('--send-rate', type=float, default=settings.SEND_RATE,
+                        help='квота запросов отправки бота к VK API в сек. (для бота в этом процессе, 0 - без квоты)')
+    parser.add_argument('--external', action='store_true', help='бот запущен отдельно и подключится к стенду сам')
+    parser.add_argument('--port', type=int, default=0, help='порт стенда (0 - любой свободный)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default=None, help='файл для результатов в JSON')
+    args = parser.parse_args()
+
+    routes = [(cfg['from_'], cfg['to_'])
+              for key in ('daily_tickets', 'tickets_on_weekdays', 'tickets_on_monthdays')
+              for cfg in Dispatcher.settings[key]]
+
+    generator = None
+    server = FakeVkServer(port=args.port, group_id=settings.GROUP_ID,
+                          on_reply=lambda *reply: generator.on_reply(*reply))
+    generator = LoadGenerator(server, routes, args.users, args.rate, args.think_time, args.seed)
+    server.start()
+    print(f'Стенд VK API: {server.api_url}')
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        bot_thread = stopped = None
+        if not args.external:
+            db_url = f'sqlite:///{os.path.join(tmp_dir, "load.sqlite")}'
+            Dispatcher(db_url)._create_tickets_in_db()
+            bot_thread, stopped = start_bot(server, db_url, args.async_workers, args.batch_window, args.send_rate)
+        else:
+            input('Запустите бота с VK_API_URL стенда и нажмите Enter')
+
+        elapsed = generator.run(args.duration)
+        unanswered = generator.drain(args.drain)
+        if stopped is not None:
+            stopped.set()
+        server.stop()
+        if bot_thread is not None:
+            bot_thread.join(timeout=10)
+
+    result = {
+        'params': vars(args),
+        'sent': generator.sent,
+        'replies': generator.replies,
+        'unanswered': unanswered,
+        'duplicates': server.duplicates,
+        'unexpected_replies': generator.unexpected_replies,
+        'starved': generator.starved,
+        'conversations_finished': generator.conversations_finished,
+        'messages_per_second': generator.sent / elapsed,
+        'execute_calls': server.execute_calls,
+        'latency': summarize(generator.latencies),
+    }
+
+    print(f'Отправлено {result["sent"]} сообщений за {elapsed:.1f} сек. ({result["messages_per_second"]:.1f}/сек.), '
+          f'ответов {result["replies"]}, без ответа {unanswered}, завершено разговоров {generator.conversations_finished}')
+    if generator.starved:
+        print(f'Частота не достигнута {generator.starved} раз: все пользователи ждали ответа (увеличьте --users)')
+    print(f'{"шаг":<20} {"ответов":>8} {"p50, мс":>9} {"p95, мс":>9} {"p99, мс":>9} {"max, мс":>9}')
+    for step, stats in result['latency'].items():
+        print(f'{step:<20} {stats["count"]:>8} {stats["p50_ms"]:>9.1f} {stats["p95_ms"]:>9.1f} '
+              f'{stats["p99_ms"]:>9.1f} {stats["max_ms"]:>9.1f}')
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf8') as file:
+            json.dump(result, file, ensure_ascii=False, indent=2)
+        print(f'Результаты сохранены в {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,36 @@
 # run tickets.py first to create DB and tickets in it
 
-import logging
+import argparse
+import asyncio
+import time
 import vk_api
 from vk_api.bot_longpoll import VkBotLongPoll, VkBotEventType
-import random
-import handlers
-from tickets import Dispatcher
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from checkpoint import Checkpoint, get_random_id, read_long_poll
+from contextlib import contextmanager
+from engine import AsyncEngine
+from handlers import SLOT_HANDLERS, extract_slots
+from intents import IntentMatcher
+from locations import LocationCache
+from logs import setup_logging
+from metrics import Counter, Gauge, Histogram, start_metrics_server
+from orders import OrderWriter, get_order
+from scheduler import PRIORITY_BROADCAST, PRIORITY_REPLY, OutboundScheduler
+from scenarios import get_scenarios
+from sessions import UserState, create_session_store
+from supervisor import Supervisor, exit_on_sigterm
+from vk_client import create_vk_session, disable_builtin_rate_limit
 
 try:
     from settings import TOKEN, GROUP_ID # actual token required in settings.py.
     from settings import SCENARIOS, INTENTS, DEFAULT_ANSWER
+    from settings import SEND_BATCH_WINDOW, SEND_BATCH_SIZE, SEND_RATE, SEND_BURST, SEND_QUEUE_SIZE, SEND_MAX_RETRIES
+    from settings import SESSION_STORE, SESSION_DB, SESSION_MAX, SESSION_TTL
+    from settings import LOCATION_CACHE_TTL, MAINTENANCE_INTERVAL, TICKETS_BACKEND, METRICS_PORT
+    from settings import CHECKPOINT_PATH, CHECKPOINT_MAX_EVENTS, VK_API_URL
+    from settings import ORDER_BATCH_SIZE, ORDER_FLUSH_INTERVAL
+    from settings import LOG_FILE, LOG_ASYNC, LOG_JSON, LOG_MAX_BYTES, LOG_BACKUP_COUNT
 
 except ImportError:
     print(f'Ошибка импорта. Нужен файл settings.py с токеном и id группы в vk')
@@ -18,55 +39,180 @@ except ImportError:
 MAIN_TOKEN = SCENARIOS['ticket']['main_token']
 HELP_TOKEN = SCENARIOS['ticket']['help_token']
 QUIT_TOKEN = SCENARIOS['ticket']['quit_token']
+INTENT_MATCHER = IntentMatcher(INTENTS)
+LOCATION_GETTERS = {'departures': 'get_departure_locations', 'arrivals': 'get_arrival_locations'}
 
-
-class UserState:
-    '''Состояние пользователя в сценарии'''
-
-    def __init__(self, scenario, step, context=None):
-        self.scenario = scenario
-        self.step = step
-        self.context = context or {}
+EVENT_SECONDS = Histogram('bot_event_seconds', 'Время обработки события, сек.')
+HANDLER_SECONDS = Histogram('bot_handler_seconds', 'Время обработчика шага сценария, сек.', ('handler',))
+SEND_SECONDS = Histogram('bot_send_seconds', 'Время отправки ответа, сек.', ('mode',))
+INTENTS_TOTAL = Counter('bot_intents_total', 'Распознанные интенты (unknown - не распознан)', ('intent',))
+SCENARIOS_COMPLETED = Counter('bot_scenarios_completed_total', 'Завершенные сценарии', ('scenario',))
+STEP_FAILURES = Counter('bot_step_failures_total', 'Неверный ввод на шаге сценария', ('handler',))
+EVENT_ERRORS = Counter('bot_event_errors_total', 'События, обработка которых завершилась исключением')
+STARTUP_SECONDS = Gauge('bot_startup_seconds', 'Длительность этапов запуска бота, сек.', ('phase',))
+DUPLICATE_EVENTS = Counter('bot_duplicate_events_total', 'Повторно полученные события, обработанные ранее')
+READY = Gauge('bot_ready', '1 - бот загрузил все необходимое для ответа на сообщения')
 
 
 class Bot:
     """ Эхо бот для работы с vk api """
 
-    def __init__(self, token, group_id):
+    def __init__(self, token, group_id, poll=True, checkpoint_path=None, api_url=VK_API_URL):
+        """
+        :param poll: bool - подключаться к long poll (воркер супервизора получает события из очереди)
+        :param checkpoint_path: str - журнал обработанных событий и ts long poll для продолжения после
+        перезапуска без потерь и повторов (None - не вести)
+        :param api_url: str - адрес методов VK API (None - api.vk.com)
+        """
         self.token = token
         self.group_id = group_id
+        self.startup_timings = {}  # этап запуска -> длительность, сек.
+        self.ready = threading.Event()  # установлено, когда загружено все для ответа на сообщения
+        self._setup_logging()
 
-        self.vk = vk_api.VkApi(token=self.token)
-        self.poller = VkBotLongPoll(self.vk, self.group_id)
-        self.api = self.vk.get_api()
-
-        self.tickets_api = Dispatcher()
-        self.departures = self.tickets_api.get_departure_locations()
-        self.arrivals = self.tickets_api.get_arrival_locations()
+        # сценарии компилируются сразу (это быстро): с ошибкой в их описании бот не запускается
+        with self._startup_phase('scenarios'):
+            get_scenarios()
+
+        # сначала подключение к long poll: сообщения, пришедшие пока грузится остальное, не теряются
+        with self._startup_phase('long_poll'):
+            self.vk = create_vk_session(self.token, api_url)
+            # воркер многопроцессного запуска получает события от супервизора и не подключается к long poll
+            self.poller = VkBotLongPoll(self.vk, self.group_id) if poll else None
+            self.api = self.vk.get_api()
+
+        with self._startup_phase('sessions'):
+            self.user_states = create_session_store(SESSION_STORE, db_name=SESSION_DB, max_sessions=SESSION_MAX,
+                                                    ttl=SESSION_TTL)
+            self.checkpoint = Checkpoint(checkpoint_path, CHECKPOINT_MAX_EVENTS) if checkpoint_path else None
+
+        # БД рейсов и списки локаций загружаются при первом обращении или заранее в warm_up
+        self._lazy_lock = threading.RLock()
+        self._tickets_api = None
+        self._departures = None
+        self._arrivals = None
+
+        self.sender = None  # OutboundScheduler для отправки с квотой и пакетами, по умолчанию отправка напрямую
+        # заказы пишутся в БД в фоне пачками; БД рейсов подключается при записи первой пачки
+        self.order_writer = OrderWriter(lambda orders: self.tickets_api.add_orders(orders),
+                                        batch_size=ORDER_BATCH_SIZE, flush_interval=ORDER_FLUSH_INTERVAL)
+        self.events_processed = 0
+        self._events_lock = threading.Lock()
+
+    @contextmanager
+    def _startup_phase(self, name):
+        started = time.perf_counter()
+        yield
+        self.startup_timings[name] = time.perf_counter() - started
+        STARTUP_SECONDS.set(self.startup_timings[name], name)
+
+    def _get_lazy(self, attribute, load, phase):
+        """ Значение атрибута; при первом обращении загружается функцией load (один раз при обращении из потоков) """
+
+        value = getattr(self, attribute)
+        if value is None:
+            with self._lazy_lock:
+                value = getattr(self, attribute)
+                if value is None:
+                    with self._startup_phase(phase):
+                        value = load()
+                    setattr(self, attribute, value)
+        return value
+
+    def _set_lazy(self, attribute, value):
+        with self._lazy_lock:
+            setattr(self, attribute, value)
+
+    def _load_tickets_api(self):
+        from tickets import Dispatcher  # sqlalchemy импортируется только здесь
+        return Dispatcher(backend=TICKETS_BACKEND)
+
+    @property
+    def tickets_api(self):
+        return self._get_lazy('_tickets_api', self._load_tickets_api, 'tickets_db')
+
+    @tickets_api.setter
+    def tickets_api(self, tickets_api):
+        self._set_lazy('_tickets_api', tickets_api)
+
+    def _get_locations(self, locations):
+        # списки локаций обновляются в фоне: появляются новые рейсы, уходят вылетевшие
+        def load():
+            loader = getattr(self.tickets_api, LOCATION_GETTERS[locations])
+            return LocationCache(loader, LOCATION_CACHE_TTL, locations)
+        return self._get_lazy(f'_{locations}', load, locations)
+
+    @property
+    def departures_index(self):
+        return self._get_locations('departures').index
+
+    @property
+    def departures(self):
+        return self.departures_index.cities
+
+    @departures.setter
+    def departures(self, locations):
+        # список, заданный явно, не обновляется
+        self._set_lazy('_departures', LocationCache(lambda: locations, name='departures'))
+
+    @property
+    def arrivals_index(self):
+        return self._get_locations('arrivals').index
+
+    @property
+    def arrivals(self):
+        return self.arrivals_index.cities
+
+    @arrivals.setter
+    def arrivals(self, locations):
+        self._set_lazy('_arrivals', LocationCache(lambda: locations, name='arrivals'))
+
+    @property
+    def is_ready(self):
+        return self.ready.is_set()
+
+    def warm_up(self):
+        """
+        Загрузить заранее то, что иначе загрузится при первом сообщении: БД рейсов, списки локаций.
+        Списки вылета и прибытия загружаются параллельно. По окончании устанавливается ready.
+        """
+
+        started = time.perf_counter()
+        self.tickets_api
+
+        with ThreadPoolExecutor(max_workers=len(LOCATION_GETTERS), thread_name_prefix='bot-warmup') as executor:
+            for future in [executor.submit(self._get_locations, locations) for locations in LOCATION_GETTERS]:
+                future.result()
+
+        self.startup_timings['warm_up'] = time.perf_counter() - started
+        self.ready.set()
+        READY.set(1)
+        timings = ', '.join(f'{phase} {seconds:.3f}' for phase, seconds in self.startup_timings.items())
+        self.logger.info('Бот готов к работе, этапы запуска (сек.): %s', timings)
+
+    def start_warm_up(self, on_ready=None):
+        """
+        warm_up в фоновом потоке, чтобы не задерживать начало чтения событий.
+        :param on_ready: функция без параметров, вызывается после успешной загрузки
+        """
+
+        def warm_up():
+            try:
+                self.warm_up()
+                if on_ready is not None:
+                    on_ready()
+            except Exception as exc:
+                self.logger.exception('Ошибка загрузки при запуске бота: %s', (exc.__class__.__name__, exc.args))
 
-        self.user_states = {}
-        self._setup_logging()
+        thread = threading.Thread(target=warm_up, name='bot-warmup', daemon=True)
+        thread.start()
+        return thread
 
     def _setup_logging(self):
         """ Настройка логирования """
 
-        logger = logging.getLogger('bot_logger')
-        logger.setLevel(logging.DEBUG)
-        time_format = '%d-%m-%Y %H:%M'
-        formatter = logging.Formatter('{asctime} - {name} - {levelname} - {message}', datefmt=time_format, style='{')
-
-        stream_handler = logging.StreamHandler()
-        stream_handler.setLevel(logging.INFO)
-        stream_handler.setFormatter(formatter)
-
-        file_handler = logging.FileHandler('bot.log', 'a', 'utf8', True)
-        file_handler.setLevel(logging.DEBUG)
-        file_handler.setFormatter(formatter)
-
-        logger.addHandler(stream_handler)
-        logger.addHandler(file_handler)
-
-        self.logger = logger
+        self.logger = setup_logging('bot_logger', LOG_FILE, use_queue=LOG_ASYNC, use_json=LOG_JSON,
+                                    max_bytes=LOG_MAX_BYTES, backup_count=LOG_BACKUP_COUNT)
 
     @classmethod
     def get_help_message(cls):
@@ -74,34 +220,63 @@ class Bot:
             if intent['name'] == 'помощь':
                 return intent['answer']
 
-    def start_scenario(self, scenario_name, user_id):
-        scenario = SCENARIOS.get(scenario_name)
-        first_step = scenario['steps'].get(1)
-        text_to_send = first_step['text']
-        self.user_states[user_id] = UserState(scenario_name, first_step)
-        return text_to_send
+    def start_scenario(self, scenario_name, user_id, slots=None):
+        """
+        :param slots: dict - ответы на шаги из сообщения, начавшего сценарий (handlers.extract_slots):
+        шаги с ответами пропускаются, пользователь получает текст первого незаполненного шага
+        """
+
+        first_step = get_scenarios()[scenario_name].first_step
+        state = UserState(scenario_name, first_step)
+        self.user_states[user_id] = state
+
+        if slots:
+            state.context['slots'] = slots
+            if first_step.handler_name in slots:
+                return self.continue_scenario(user_id, slots.pop(first_step.handler_name))
+            self.user_states.save(user_id, state)
+        return first_step.text.render(state.context)
 
     def continue_scenario(self, user_id, text):
         state = self.user_states[user_id]
         context = state.context
-        steps = SCENARIOS[state.scenario]['steps']
         step = state.step
-        handler = getattr(handlers, step['handler'])
 
-        if handler(self, user_id, text):
+        if step.handler_name in SLOT_HANDLERS:
+            # ответы на следующие шаги в том же сообщении запоминаются: "москва казань 01-07-2020"
+            slots = context.setdefault('slots', {})
+            slots.update(extract_slots(self, text, expected=step.handler_name))
+            text = slots.pop(step.handler_name, text)
+
+        while True:
+            with HANDLER_SECONDS.time(step.handler_name):
+                success = step.handler(self, user_id, text)
+            if not success or step.next.is_final:
+                break
+
+            # шаг, ответ на который уже получен, выполняется сразу: пользователю уходит текст первого незаполненного
+            text = context.get('slots', {}).pop(step.next.handler_name, None)
+            if text is None:
+                break
+            step = step.next
+
+        if success:
 
             # обработать переход на следующий шаг
-            next_step_number = state.step['step_number'] + 1
-            next_step = steps[next_step_number]
-            text_to_send = next_step['text'].format(**state.context)
+            next_step = step.next
+            text_to_send = next_step.text.render(context)
             state.step = next_step
 
             # это последний шаг в сценарии
-            if next_step_number == len(steps):
+            if next_step.is_final:
+                SCENARIOS_COMPLETED.inc(state.scenario)
+                self.order_writer.submit(get_order(user_id, context))
                 summary = state.context['summary']
-                self.logger.info(
-                    f'{">>>>> оформлен новый заказ от пользователя".upper()} (ID: {user_id}):\n{summary}\n')
+                self.logger.info('>>>>> ОФОРМЛЕН НОВЫЙ ЗАКАЗ ОТ ПОЛЬЗОВАТЕЛЯ (ID: %s):\n%s\n', user_id, summary,
+                                 extra={'peer_id': user_id})
                 self.quit_scenario(user_id)
+            else:
+                self.user_states.save(user_id, state)
 
         # завершаем сценарий по сигналу от handler
         elif context.get('quit_message') is not None:
@@ -112,8 +287,17 @@ class Bot:
                 start_over_message = self.start_scenario('ticket', user_id)
                 text_to_send = f'{text_to_send}\n\n{start_over_message}'
 
+        # handler остался на том же шаге со своим текстом (например, следующая страница рейсов)
+        elif context.get('step_message') is not None:
+            text_to_send = context.pop('step_message')
+            state.step = step
+            self.user_states.save(user_id, state)
+
         else:
-            text_to_send = step['failure_text'].format(**state.context)
+            STEP_FAILURES.inc(step.handler_name)
+            text_to_send = step.failure_text.render(context)
+            state.step = step
+            self.user_states.save(user_id, state)
 
         return text_to_send
 
@@ -125,8 +309,8 @@ class Bot:
         """ Обработка событий """
 
         if event.type != VkBotEventType.MESSAGE_NEW:
-            self.logger.debug(f'Пришло неизвестное событие с типом: {event.type}')
-            self.logger.debug(f'Текст сообщения неизвестного события: {event.obj.text}')
+            self.logger.debug('Пришло неизвестное событие с типом: %s', event.type)
+            self.logger.debug('Текст сообщения неизвестного события: %s', event.obj.text)
             return
 
         user_id = event.obj.message['peer_id']
@@ -152,39 +336,185 @@ class Bot:
 
         else:
             # искать интент
-            for intent in INTENTS:
-                if any(token in user_text for token in intent['tokens']):
-                    # запустить новый интент
-                    if intent['answer']:
-                        text_to_send = intent['answer']
-                    else:
-                        text_to_send = self.start_scenario('ticket', user_id)
-                    break
-
+            intent = INTENT_MATCHER.match(user_text)
+            INTENTS_TOTAL.inc('unknown' if intent is None else intent['name'])
+            if intent is None:
+                # "из питера в казань завтра" - заказ билета без ключевых слов
+                slots = extract_slots(self, user_text, strict=True)
+                if slots:
+                    text_to_send = self.start_scenario('ticket', user_id, slots)
+                else:
+                    text_to_send = DEFAULT_ANSWER
+
+            # запустить новый интент
+            elif intent['answer']:
+                text_to_send = intent['answer']
             else:
-                text_to_send = DEFAULT_ANSWER
+                # слова интента ('заказ', 'хочу') не должны становиться городами
+                text_to_send = self.start_scenario('ticket', user_id, extract_slots(self, user_text, strict=True))
 
         # # отправим наше сообщение в ответ
-        random_id = random.randint(3 ** 20, 9 ** 20)
-        self.api.messages.send(peer_id=user_id,
-                               random_id=random_id,
-                               message=text_to_send
-                               )
+        event_id = event.raw.get('event_id')
+        self.send_message(user_id, text_to_send, get_random_id(event_id) if event_id else None)
+
+    def send_message(self, user_id, text_to_send, random_id=None, priority=PRIORITY_REPLY):
+
+        """
+        Отправка сообщения пользователю (напрямую или через планировщик отправки).
+        :param random_id: int - id для отсева повторной отправки на стороне VK (None - случайный)
+        :param priority: int - класс приоритета в планировщике (scheduler.PRIORITY_*)
+        """
+
+        if random_id is None:
+            random_id = vk_api.utils.get_random_id()
+        if self.sender is None:
+            with SEND_SECONDS.time('direct'):
+                return self.api.messages.send(peer_id=user_id,
+                                              random_id=random_id,
+                                              message=text_to_send
+                                              )
+
+        # ждем результата именно этого сообщения: ошибка отправки попадет в лог через process_event
+        with SEND_SECONDS.time('batch'):
+            return self.sender.send(priority, peer_id=user_id, random_id=random_id, message=text_to_send).result()
+
+    def broadcast(self, peer_ids, text_to_send):
+
+        """
+        Рассылка сообщения: через планировщик отправки уходит после ответов пользователям.
+        :return: list - concurrent.futures.Future отправки каждого сообщения (при отправке напрямую - результаты)
+        """
+
+        if self.sender is None:
+            return [self.send_message(peer_id, text_to_send) for peer_id in peer_ids]
+        return [self.sender.send(PRIORITY_BROADCAST, peer_id=peer_id, random_id=vk_api.utils.get_random_id(),
+                                 message=text_to_send)
+                for peer_id in peer_ids]
+
+    def process_event(self, event):
+
+        """ Обработка события с перехватом и логированием ошибок """
+
+        event_id = self._get_event_id(event)
+        if event_id is not None and self.checkpoint.is_processed(event_id):
+            DUPLICATE_EVENTS.inc()
+            self.logger.debug('Событие %s уже обработано, пропускаем', event_id)
+            return
 
-    def run(self):
+        try:
+            with EVENT_SECONDS.time():
+                self.on_event(event)
+        except SystemExit:
+            raise  # остановка процесса (exit_on_sigterm)
+        except BaseException as exc:
+            EVENT_ERRORS.inc()
+            self.logger.exception('Произошла ошибка (исключение): %s', (exc.__class__.__name__, exc.args))
+        finally:
+            with self._events_lock:
+                self.events_processed += 1
+            # и событие с ошибкой отмечается обработанным: повтор привел бы к той же ошибке
+            if event_id is not None:
+                self.checkpoint.mark_processed(event_id)
+
+    def _get_event_id(self, event):
+        """ id события для отсева повторов (None, если журнал не ведется) """
+
+        if self.checkpoint is None:
+            return None
+        raw = getattr(event, 'raw', None)
+        return raw.get('event_id') if isinstance(raw, dict) else None
+
+    def run(self, events=None):
 
         """ Запуск бота на исполнение """
 
-        for event in self.poller.listen():
-            try:
-                self.on_event(event)
-            except BaseException as exc:
-                self.logger.exception(f'Произошла ошибка (исключение): {exc.__class__.__name__, exc.args}')
+        for event in events if events is not None else self.read_events():
+            self.process_event(event)
+
+    def read_events(self):
+
+        """
+        События long poll. С журналом - с сохраненного ts (checkpoint.read_long_poll),
+        ts сохраняется после обработки всех событий до него.
+        """
+
+        if self.checkpoint is None:
+            return self.poller.listen()
+        return read_long_poll(self.poller, self.checkpoint)
+
+    def run_async(self, max_workers=16, events=None):
+
+        """ Запуск бота с конкурентной обработкой событий разных пользователей """
+
+        engine = AsyncEngine(self, max_workers=max_workers)
+        asyncio.run(engine.run(events if events is not None else self.read_events()))
+
+    def serve(self, events=None, async_workers=0, batch_window=0, batch_size=SEND_BATCH_SIZE, send_rate=SEND_RATE):
+
+        """
+        Запуск бота с выбранным режимом обработки событий.
+        :param events: итерируемый поток событий, по умолчанию - long poll бота
+        :param async_workers: кол-во потоков конкурентной обработки (0 - последовательная обработка)
+        :param batch_window: окно пакетной отправки через execute, сек. (0 - без пакетной отправки)
+        :param batch_size: макс. кол-во сообщений в одном execute
+        :param send_rate: квота запросов отправки к VK API в сек. (None - без планировщика, если нет пакетной отправки)
+        """
+
+        # пакетная отправка имеет смысл, только когда ответы формируются конкурентно
+        batch_window = batch_window if async_workers > 0 else 0
+        if send_rate or batch_window > 0:
+            if send_rate:
+                disable_builtin_rate_limit(self.vk)  # частотой управляет планировщик
+            self.sender = OutboundScheduler(self.api, rate=send_rate, burst=SEND_BURST, batch_window=batch_window,
+                                            batch_size=batch_size, max_queue=SEND_QUEUE_SIZE,
+                                            max_retries=SEND_MAX_RETRIES)
+        try:
+            if async_workers <= 0:
+                self.run(events)
+                return
+            self.run_async(max_workers=async_workers, events=events)
+        finally:
+            if self.sender is not None:
+                self.sender.close()
+            self.order_writer.close()  # дописать в БД принятые заказы
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='VK чат-бот для заказа авиабилетов')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='кол-во процессов-воркеров, события распределяются по peer_id (0 - один процесс)')
+    parser.add_argument('--async-workers', type=int, default=0,
+                        help='кол-во потоков для конкурентной обработки событий (0 - последовательная обработка)')
+    parser.add_argument('--batch-window', type=float, default=SEND_BATCH_WINDOW,
+                        help='окно накопления исходящих сообщений для execute, сек. (0 - без пакетной отправки)')
+    parser.add_argument('--batch-size', type=int, default=SEND_BATCH_SIZE,
+                        help='макс. кол-во сообщений в одном execute (до 25)')
+    parser.add_argument('--send-rate', type=float, default=SEND_RATE,
+                        help='квота запросов отправки к VK API в сек. на всю группу (0 - без ограничения)')
+    return parser.parse_args()
 
 
 def main():
-    bot = Bot(TOKEN, GROUP_ID)
-    bot.run()
+    args = parse_args()
+    exit_on_sigterm()
+    serve_options = dict(async_workers=args.async_workers, batch_window=args.batch_window, batch_size=args.batch_size,
+                         send_rate=args.send_rate)
+
+    if args.workers > 0:
+        supervisor = Supervisor(TOKEN, GROUP_ID, args.workers, serve_options=serve_options,
+                                maintenance_interval=MAINTENANCE_INTERVAL, metrics_port=METRICS_PORT,
+                                api_url=VK_API_URL, checkpoint_path=CHECKPOINT_PATH,
+                                checkpoint_max_events=CHECKPOINT_MAX_EVENTS)
+        supervisor.run()
+    else:
+        bot = None
+        if METRICS_PORT:
+            start_metrics_server(METRICS_PORT, is_ready=lambda: bot is not None and bot.is_ready)
+        bot = Bot(TOKEN, GROUP_ID, checkpoint_path=CHECKPOINT_PATH)
+        # обслуживание БД рейсов - после загрузки в фоне, чтобы не задерживать чтение событий
+        on_ready = (lambda: bot.tickets_api.start_maintenance(MAINTENANCE_INTERVAL)) if MAINTENANCE_INTERVAL else None
+        bot.start_warm_up(on_ready=on_ready)
+        bot.serve(**serve_options)
 
 
 if __name__ == '__main__':
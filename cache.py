@@ -0,0 +1,72 @@
+''' Кэш результатов запросов '''
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Ограниченный по размеру кэш с вытеснением давно неиспользуемых записей.
+    Каждая запись помнит версию данных, из которых получена: запись другой версии считается промахом.
+    """
+
+    def __init__(self, max_size=1024, ttl=None):
+        """
+        :param max_size: int - макс. кол-во записей
+        :param ttl: int - время жизни записи, сек. (None - без ограничения)
+        """
+
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = OrderedDict()  # ключ -> (версия, время записи, значение)
+        self._lock = threading.Lock()
+
+        # статистика
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, version=None, is_valid=None):
+        """
+        Значение из кэша или None.
+        :param is_valid: функция value -> bool для дополнительной проверки пригодности записи
+        """
+
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                item_version, stored_at, value = item
+                if item_version == version and (self.ttl is None or time.monotonic() - stored_at <= self.ttl) \
+                        and (is_valid is None or is_valid(value)):
+                    self._items.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._items[key]
+
+            self.misses += 1
+            return None
+
+    def put(self, key, value, version=None):
+        with self._lock:
+            self._items[key] = (version, time.monotonic(), value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            'size': len(self),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / requests if requests else 0.0,
+        }
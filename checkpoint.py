@@ -0,0 +1,161 @@
+''' Контрольная точка long poll: последний обработанный ts и id недавно обработанных событий '''
+import logging
+import os
+import threading
+import zlib
+from collections import OrderedDict, deque
+
+
+def get_random_id(event_id):
+    """
+    random_id ответа на событие: одинаковый при повторной обработке того же события,
+    поэтому VK не доставит повторный ответ дважды
+    """
+    return zlib.crc32(str(event_id).encode()) & 0x7fffffff
+
+
+class Checkpoint:
+    """
+    Журнал в файле: строки "e <event_id>" после обработки каждого события и "t <ts>" после каждой пачки long poll.
+    При запуске бот продолжает чтение с сохраненного ts, а события, уже обработанные до перезапуска, пропускает.
+    В памяти хранятся id только max_events последних событий; журнал периодически сжимается до них.
+    Пачки, события которых обрабатываются конкурентно (потоками или воркерами), регистрируются в track_batch:
+    ts пачки записывается, только когда обработаны все ее события и события всех предыдущих пачек.
+    """
+
+    def __init__(self, path, max_events=10000, fsync=False):
+        """
+        :param path: str - файл журнала (относительный путь - от каталога бота)
+        :param max_events: int - сколько id последних событий помнить для отсева повторов
+        :param fsync: bool - сбрасывать журнал на диск после каждой записи (надежнее при сбое питания, но медленнее)
+        """
+
+        self.path = os.path.normpath(os.path.join(os.path.dirname(__file__), path))
+        self.max_events = max_events
+        self.fsync = fsync
+
+        self.ts = None
+        self._event_ids = OrderedDict()  # id события -> None, от давних к свежим
+        self._lock = threading.Lock()
+        self._lines = 0
+        self._batches = deque()  # [ts, кол-во необработанных событий] пачек, ts которых еще не записан
+        self._batch_by_event = {}  # id необработанного события -> его пачка
+
+        is_complete = self._load()
+        self._file = open(self.path, 'a', encoding='utf8')
+        if not is_complete:
+            self._compact()  # иначе следующая запись продолжит недописанную строку
+
+    def _load(self):
+        """ Прочитать журнал. Возвращает False, если последняя строка не дописана (сбой во время записи) """
+
+        if not os.path.exists(self.path):
+            return True
+
+        with open(self.path, encoding='utf8') as file:
+            for line in file:
+                if not line.endswith('\n'):
+                    return False
+                kind, _, value = line[:-1].partition(' ')
+                if kind == 't':
+                    self.ts = value
+                elif kind == 'e':
+                    self._remember(value)
+                self._lines += 1
+        return True
+
+    def _remember(self, event_id):
+        self._event_ids[event_id] = None
+        self._event_ids.move_to_end(event_id)
+        while len(self._event_ids) > self.max_events:
+            self._event_ids.popitem(last=False)
+
+    def is_processed(self, event_id):
+        return event_id in self._event_ids
+
+    def mark_processed(self, event_id):
+        with self._lock:
+            self._remember(event_id)
+            self._write(f'e {event_id}\n')
+            batch = self._batch_by_event.pop(event_id, None)
+            if batch is not None:
+                batch[1] -= 1
+                self._save_completed()
+
+    def track_batch(self, ts, event_ids):
+        """ Пачка long poll до ts с событиями event_ids: ts запишется после mark_processed для всех них """
+
+        with self._lock:
+            batch = [ts, 0]
+            for event_id in event_ids:
+                if event_id is None or event_id in self._event_ids or event_id in self._batch_by_event:
+                    continue  # событие без id или повтор - его обработка не ожидается
+                self._batch_by_event[event_id] = batch
+                batch[1] += 1
+            self._batches.append(batch)
+            self._save_completed()
+
+    def _save_completed(self):
+        ts = None
+        while self._batches and self._batches[0][1] == 0:
+            ts = self._batches.popleft()[0]
+        if ts is not None and ts != self.ts:
+            self.ts = ts
+            self._write(f't {ts}\n')
+
+    def save_ts(self, ts):
+        """ Запомнить ts, с которого продолжать чтение long poll """
+
+        with self._lock:
+            if ts == self.ts:
+                return
+            self.ts = ts
+            self._write(f't {ts}\n')
+
+    def _write(self, line):
+        self._file.write(line)
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+        self._lines += 1
+        if self._lines > 2 * self.max_events:
+            self._compact()
+
+    def _compact(self):
+        """ Переписать журнал, оставив только текущий ts и помнимые id событий (атомарно через os.replace) """
+
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', encoding='utf8') as file:
+            lines = [f'e {event_id}\n' for event_id in self._event_ids]
+            if self.ts is not None:
+                lines.append(f't {self.ts}\n')
+            file.writelines(lines)
+            file.flush()
+            os.fsync(file.fileno())
+
+        self._file.close()
+        os.replace(tmp_path, self.path)
+        self._file = open(self.path, 'a', encoding='utf8')
+        self._lines = len(lines)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def read_long_poll(poller, checkpoint):
+    """
+    События long poll (VkBotLongPoll) с сохраненного в checkpoint ts: после перезапуска придут и события,
+    полученные VK за время простоя. Каждая пачка регистрируется в checkpoint.track_batch, поэтому ts сохраняется
+    и при конкурентной обработке только после обработки всех событий до него.
+    """
+
+    if checkpoint.ts is not None:
+        poller.ts = checkpoint.ts
+        logging.getLogger('bot_logger').info('Чтение long poll продолжается с ts %s', checkpoint.ts)
+
+    while True:
+        events = poller.check()
+        checkpoint.track_batch(poller.ts, [event.raw.get('event_id') for event in events])
+        yield from events
@@ -0,0 +1,91 @@
+''' Асинхронный движок обработки событий бота '''
+import asyncio
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+_STOP = object()  # маркер окончания потока событий
+
+
+class AsyncEngine:
+    """
+    Конкурентная обработка событий long poll на asyncio.
+    События разных собеседников (peer_id) обрабатываются параллельно в пуле потоков,
+    события одного собеседника - строго в порядке поступления.
+    """
+
+    def __init__(self, bot, max_workers=16, max_pending=1000):
+        self.bot = bot
+        self.max_workers = max_workers
+        self.max_pending = max_pending  # предел событий в обработке (защита от переполнения памяти)
+        self.logger = logging.getLogger('bot_logger')
+
+        self.queues = {}  # peer_id -> deque событий
+        self.tasks = {}  # peer_id -> asyncio.Task, разбирающая очередь собеседника
+        self.executor = None
+        self._pending = None
+
+    @staticmethod
+    def get_peer_id(event):
+        try:
+            return event.obj.message['peer_id']
+        except (AttributeError, KeyError, TypeError):
+            return None  # события без собеседника обрабатываются последовательно в общей очереди
+
+    async def submit(self, event):
+        """ Поставить событие в очередь его собеседника """
+
+        await self._pending.acquire()
+
+        peer_id = self.get_peer_id(event)
+        queue = self.queues.get(peer_id)
+        if queue is None:
+            queue = self.queues[peer_id] = deque()
+            self.tasks[peer_id] = asyncio.create_task(self._drain(peer_id, queue))
+        queue.append(event)
+
+    async def _drain(self, peer_id, queue):
+        loop = asyncio.get_running_loop()
+        try:
+            while queue:
+                event = queue.popleft()
+                try:
+                    # обработчик синхронный (запросы к БД, отправка сообщения) - выполняем вне цикла событий
+                    await loop.run_in_executor(self.executor, self.bot.process_event, event)
+                except Exception as exc:
+                    # ошибка одного события не должна останавливать очередь собеседника
+                    self.logger.exception('Ошибка обработки события собеседника %s: %s', peer_id,
+                                          (exc.__class__.__name__, exc.args))
+                finally:
+                    self._pending.release()
+        finally:
+            # между проверкой очереди и удалением нет await, поэтому новое событие не потеряется
+            self.queues.pop(peer_id, None)
+            self.tasks.pop(peer_id, None)
+
+    async def join(self):
+        """ Дождаться обработки всех поставленных в очередь событий """
+
+        while self.tasks:
+            await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+
+    async def run(self, events):
+        """ Обработать поток событий (например, poller.listen()) до его окончания """
+
+        loop = asyncio.get_running_loop()
+        self._pending = asyncio.Semaphore(self.max_pending)
+        self.executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix='bot-worker')
+        # long poll блокирует поток, поэтому читаем его в отдельном потоке
+        reader = ThreadPoolExecutor(1, thread_name_prefix='bot-reader')
+        iterator = iter(events)
+
+        try:
+            while True:
+                event = await loop.run_in_executor(reader, next, iterator, _STOP)
+                if event is _STOP:
+                    break
+                await self.submit(event)
+            await self.join()
+        finally:
+            reader.shutdown(wait=False)
+            self.executor.shutdown(wait=True)
@@ -2,10 +2,40 @@
 import datetime
 import re
 
+from settings import CITY_ALIASES, FLIGHTS_PAGE_SIZE, MORE_FLIGHTS_TOKENS
+
 LOCATION_PATTERN = re.compile(r'([a-яё-]{3,})([a-яё]+$)', re.IGNORECASE)
 YES_NO_PATTERN = re.compile(r'да|нет', re.IGNORECASE)
 PHONE_PATTERN = re.compile(r'\+7\d{10}$')
 
+# разбор нескольких ответов из одного сообщения: "из питера в казань завтра 2 билета"
+DATE_PATTERN = re.compile(r'\b(\d{1,2})[-./](\d{1,2})[-./](\d{4})\b')
+RELATIVE_DATES = {'сегодня': 0, 'завтра': 1, 'послезавтра': 2}
+QTY_WORDS = {'один': 1, 'одного': 1, 'два': 2, 'две': 2, 'двух': 2, 'три': 3, 'трех': 3, 'трёх': 3, 'четыре': 4,
+             'четырех': 4, 'четырёх': 4, 'пять': 5, 'пяти': 5}
+QTY_PATTERN = re.compile(rf'(?:\b|^)(\d+|{"|".join(QTY_WORDS)})\s+(?:авиа)?билет', re.IGNORECASE)
+WORD_PATTERN = re.compile(r'[а-яё][а-яё-]*', re.IGNORECASE)
+DEPARTURE_PREPOSITIONS = frozenset(('из', 'от', 'с'))
+ARRIVAL_PREPOSITIONS = frozenset(('в', 'во', 'до', 'на'))
+MIN_CITY_WORD = 4  # более короткие слова без предлога - не город (кроме CITY_ALIASES)
+
+# обработчики, ответ на которые можно дать заранее, вместе с ответами на другие шаги
+SLOT_HANDLERS = ('handle_departure', 'handle_arrival', 'handle_date', 'handle_tickets_qty')
+# какие шаги заполняют города без предлога, в зависимости от ожидаемого шага: "москва казань" на первом шаге
+UNNAMED_CITY_SLOTS = {'handle_departure': ('handle_departure', 'handle_arrival'), 'handle_arrival': ('handle_arrival',)}
+
+
+def provides(*keys, on_failure=()):
+    '''
+    Отмечает ключи контекста, которые обработчик заполняет при успехе (и on_failure - при неудаче).
+    По ним при компиляции сценария проверяются поля шаблонов текстов шагов.
+    '''
+    def decorator(handler):
+        handler.provides = keys
+        handler.provides_on_failure = tuple(on_failure)
+        return handler
+    return decorator
+
 
 def get_context(bot, user_id):
     return bot.user_states[user_id].context
@@ -20,6 +50,12 @@ def get_flights_as_str(flights):
     return '\n\n'.join(map(get_flight_as_str, flights.values()))
 
 
+def get_flights_cursor(flights):
+    ''' курсор следующей страницы рейсов (Dispatcher.get_tickets(after=...)): ключ сортировки последнего рейса '''
+    flight = flights[next(reversed(flights))]
+    return flight['when_'], flight['price'], flight['id']
+
+
 def get_summary_as_str(context):
     flight = context['flight']
     price = flight['price']
@@ -41,29 +77,115 @@ def get_summary_as_str(context):
     return result
 
 
+def find_city(index, word, strict=False):
+    '''
+    город из index (CityIndex) по слову сообщения, в том числе по сокращению из CITY_ALIASES ("питера").
+    :param strict: bool - только точное совпадение (CityIndex.find_exact), без поиска с опечатками
+    '''
+
+    for alias, city in CITY_ALIASES.items():
+        if word.startswith(alias):
+            return city if city in index.cities else None
+    if len(word) < MIN_CITY_WORD:
+        return None
+    return index.find_exact(word) if strict else index.find(word)
+
+
+def is_alias(word):
+    return any(word.startswith(alias) for alias in CITY_ALIASES)
+
+
+def extract_slots(bot, user_text, expected='handle_departure', strict=False):
+    '''
+    Ответы на несколько шагов сценария заказа из одного сообщения.
+    Город с предлогом "из"/"в" - город вылета/прибытия, города без предлога заполняют по порядку
+    города, начиная с ожидаемого шага expected (UNNAMED_CITY_SLOTS).
+    :param strict: bool - сообщение вне сценария: города ищутся только точным совпадением, и ответы возвращаются,
+    только если в сообщении есть признак заказа - город с предлогом или из CITY_ALIASES, два города или дата
+    ("позвоните в банк", "мост" - не заказ). Без такого признака индексы городов не загружаются.
+    :return: dict - имя обработчика шага (SLOT_HANDLERS) -> текст, который он примет, например
+    {'handle_departure': 'санкт-петербург', 'handle_date': '02-06-2020', 'handle_tickets_qty': '2'}
+    '''
+
+    text = user_text.lower()
+    slots = {}
+
+    match = DATE_PATTERN.search(text)
+    if match:
+        day, month, year = match.groups()
+        slots['handle_date'] = f'{int(day):02d}-{int(month):02d}-{year}'
+        text = text[:match.start()] + ' ' + text[match.end():]
+
+    match = QTY_PATTERN.search(text)
+    if match:
+        qty = match.group(1)
+        slots['handle_tickets_qty'] = str(QTY_WORDS.get(qty, qty))
+        text = text[:match.start()] + ' ' + text[match.end():]
+
+    words = WORD_PATTERN.findall(text)
+    if strict and 'handle_date' not in slots:
+        # дешевая проверка до обращения к индексам городов
+        has_marker = any(word in RELATIVE_DATES or word in DEPARTURE_PREPOSITIONS or word in ARRIVAL_PREPOSITIONS
+                         or is_alias(word) for word in words)
+        if not has_marker and sum(len(word) >= MIN_CITY_WORD for word in words) < 2:
+            return {}
+
+    unnamed = UNNAMED_CITY_SLOTS.get(expected, ())
+    marked = False  # найден город с предлогом или из CITY_ALIASES
+    previous = None
+    for word in words:
+        if 'handle_date' not in slots and word in RELATIVE_DATES:
+            today = datetime.datetime.now().date()
+            when_ = today + datetime.timedelta(days=RELATIVE_DATES[word])
+            slots['handle_date'] = when_.strftime('%d-%m-%Y')
+        elif word not in DEPARTURE_PREPOSITIONS | ARRIVAL_PREPOSITIONS:
+            if previous in DEPARTURE_PREPOSITIONS:
+                handler_name = 'handle_departure'
+            elif previous in ARRIVAL_PREPOSITIONS:
+                handler_name = 'handle_arrival'
+            else:
+                handler_name = next((name for name in unnamed if name not in slots), None)
+
+            if handler_name is not None and handler_name not in slots:
+                index = bot.departures_index if handler_name == 'handle_departure' else bot.arrivals_index
+                city = find_city(index, word, strict)
+                if city is not None:
+                    slots[handler_name] = city.lower()
+                    marked = marked or previous in DEPARTURE_PREPOSITIONS | ARRIVAL_PREPOSITIONS or is_alias(word)
+        previous = word
+
+    if strict:
+        cities = sum(name in slots for name in ('handle_departure', 'handle_arrival'))
+        if not cities or not (marked or cities == 2 or 'handle_date' in slots):
+            return {}
+    return slots
+
+
 def handle_location(bot, user_id, user_text, is_departure=True):
     locations = 'departures' if is_departure else 'arrivals'
     direction = 'from_' if is_departure else 'to_'
 
     context = get_context(bot, user_id)
-    actual_locations = getattr(bot, locations)  # departures или arrivals
+    index = getattr(bot, f'{locations}_index')  # CityIndex для departures или arrivals
     match = re.search(LOCATION_PATTERN, user_text)
 
     if match:
-        user_location = match.group(1)
-        for location in actual_locations:
-            if location.lower().startswith(user_location):  # 'москва' начинается с 'моск'
-                context[direction] = location
-                return True
+        # 'москв(а)' - по префиксу, 'масква' - с опечаткой, 'moskva' - транслитом
+        location = index.find(match.group())
+        if location is not None:
+            context[direction] = location
+            return True
 
-    context[locations] = '\n'.join(actual_locations)
+    context[locations] = '\n'.join(index.cities)
     return False
 
 
+@provides('from_', on_failure=('departures',))
 def handle_departure(bot, user_id, user_text):
     return handle_location(bot, user_id, user_text)
 
 
+@provides('to_', on_failure=('arrivals',))
 def handle_arrival(bot, user_id, user_text):
     result = handle_location(bot, user_id, user_text, False)
     if not result:
@@ -81,6 +203,7 @@ def handle_arrival(bot, user_id, user_text):
     return True
 
 
+@provides('when_', 'flights', 'flights_as_str')
 def handle_date(bot, user_id, user_text):
     try:
         user_datetime = datetime.datetime.strptime(user_text, '%d-%m-%Y')
@@ -96,7 +219,7 @@ def handle_date(bot, user_id, user_text):
 
     from_ = context['from_']
     to_ = context['to_']
-    flights = bot.tickets_api.get_tickets(from_=from_, to_=to_, when_=user_datetime, limit=5)
+    flights = bot.tickets_api.get_tickets(from_=from_, to_=to_, when_=user_datetime, limit=FLIGHTS_PAGE_SIZE)
     if not flights:
         context['quit_message'] = f'Вы ввели дату вылета {user_datetime}. Маршрут "{from_} - {to_}" не доступен на ' \
                                   f'указанную дату. Всего Вам хорошего!'
@@ -107,7 +230,31 @@ def handle_date(bot, user_id, user_text):
     return True
 
 
+def show_more_flights(bot, user_id):
+    '''
+    Следующая страница рейсов по команде "ещё" на шаге выбора рейса. Шаг не меняется: текст со списком
+    передается в context['step_message'], рейсы всех показанных страниц остаются доступны для выбора.
+    '''
+    context = get_context(bot, user_id)
+    flights = context['flights']
+    page = bot.tickets_api.get_tickets(from_=context['from_'], to_=context['to_'], when_=context['when_'],
+                                       limit=FLIGHTS_PAGE_SIZE, after=get_flights_cursor(flights))
+    if not page:
+        context['step_message'] = 'Других рейсов по Вашим параметрам нет. Введите, пожалуйста, ID рейса из списка выше:'
+        return False
+
+    context['flights'] = {**flights, **page}  # словарь страницы может быть в кэше Dispatcher - не изменяется
+    context['flights_as_str'] = get_flights_as_str(page)
+    context['step_message'] = f'Следующие рейсы:\n\n{context["flights_as_str"]}\n' \
+                              f'Введите, пожалуйста, ID нужного рейса или "ещё", чтобы посмотреть следующие рейсы:'
+    return False
+
+
+@provides('flight_id', 'flight', 'flight_when_')
 def handle_flight_id(bot, user_id, user_text):
+    if user_text in MORE_FLIGHTS_TOKENS:
+        return show_more_flights(bot, user_id)
+
     try:
         user_flight_id = int(user_text)
     except (ValueError, TypeError):
@@ -127,6 +274,7 @@ def handle_flight_id(bot, user_id, user_text):
     return True
 
 
+@provides('tickets_qty')
 def handle_tickets_qty(bot, user_id, user_text):
     min = 1
     max = 5
@@ -145,6 +293,7 @@ def handle_tickets_qty(bot, user_id, user_text):
     return result
 
 
+@provides('comment', 'summary')
 def handle_comment(bot, user_id, user_text):
     context = get_context(bot, user_id)
     context['comment'] = user_text
@@ -167,6 +316,7 @@ def handle_summary(bot, user_id, user_text):
         return False
 
 
+@provides('phone')
 def handle_phone(bot, user_id, user_text):
     match = re.search(PHONE_PATTERN, user_text)
 
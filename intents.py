@@ -0,0 +1,86 @@
+''' Поиск интентов в тексте пользователя (алгоритм Ахо-Корасик) '''
+
+_NO_MATCH = float('inf')
+
+
+class IntentMatcher:
+    """
+    Индекс токенов всех интентов, построенный один раз.
+    match() находит все вхождения токенов за один проход по тексту и возвращает интент
+    с наименьшим порядковым номером в INTENTS - как и последовательный перебор интентов.
+    На малом числе токенов перебор через встроенный `in` быстрее обхода автомата на Python,
+    поэтому до scan_threshold токенов используется перебор (см. benchmarks/bench_intents.py).
+    """
+
+    def __init__(self, intents, scan_threshold=128):
+        self.intents = list(intents)
+        self.use_scan = sum(len(intent['tokens']) for intent in self.intents) <= scan_threshold
+
+        # узлы бора: переходы по символам, суффиксные ссылки и лучший (минимальный) номер интента,
+        # токен которого заканчивается в узле (с учетом суффиксных ссылок)
+        self._goto = [{}]
+        self._fail = [0]
+        self._best = [_NO_MATCH]
+
+        for index, intent in enumerate(self.intents):
+            for token in intent['tokens']:
+                self._add_token(token, index)
+
+        self._build_links()
+
+    def _add_token(self, token, index):
+        node = 0
+        for char in token:
+            next_node = self._goto[node].get(char)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto[node][char] = next_node
+                self._goto.append({})
+                self._fail.append(0)
+                self._best.append(_NO_MATCH)
+            node = next_node
+
+        self._best[node] = min(self._best[node], index)
+
+    def _build_links(self):
+        # обход в ширину: суффиксная ссылка узла строится по уже готовым ссылкам предков
+        queue = list(self._goto[0].values())
+        position = 0
+
+        while position < len(queue):
+            node = queue[position]
+            position += 1
+
+            for char, child in self._goto[node].items():
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                child_fail = self._goto[fail].get(char, 0)
+                self._fail[child] = child_fail if child_fail != child else 0
+                self._best[child] = min(self._best[child], self._best[self._fail[child]])
+                queue.append(child)
+
+    def match(self, text):
+        """ Первый по порядку интент, токен которого входит в text, или None """
+
+        if self.use_scan:
+            for intent in self.intents:
+                if any(token in text for token in intent['tokens']):
+                    return intent
+            return None
+
+        goto, fail, best_by_node = self._goto, self._fail, self._best
+        best = best_by_node[0]  # пустой токен входит в любой текст
+        node = 0
+
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+
+            if best_by_node[node] < best:
+                best = best_by_node[node]
+                if best == 0:
+                    break  # интента с меньшим номером нет
+
+        return self.intents[best] if best != _NO_MATCH else None
@@ -0,0 +1,206 @@
+''' Рейсы в памяти по столбцам: ответы на запросы Dispatcher без обращения к БД '''
+import bisect
+import datetime
+import logging
+import threading
+import time
+from array import array
+
+EPOCH = datetime.datetime(1970, 1, 1)
+MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+def to_epoch(when_):
+    """ datetime.datetime -> целое кол-во микросекунд от начала эпохи (без потери точности) """
+    return (when_ - EPOCH) // MICROSECOND
+
+
+def from_epoch(value):
+    return EPOCH + value * MICROSECOND
+
+
+class TicketColumns:
+    """
+    Неизменяемый снимок таблицы tickets по столбцам: id, коды городов вылета и прибытия (номера в справочнике cities),
+    время вылета в микросекундах от начала эпохи, цена. Строки упорядочены по (when_, id), поэтому рейсы позже
+    заданного времени находятся двоичным поиском. Порядок результатов совпадает с запросами Dispatcher к БД.
+    """
+
+    def __init__(self, rows):
+        """ :param rows: iterable кортежей (id, from_, to_, when_, price), упорядоченных по (when_, id) """
+
+        self.cities = []  # код -> название
+        self._codes = {}  # название -> код
+
+        self.ids = array('q')
+        self.from_codes = array('l')
+        self.to_codes = array('l')
+        self.times = array('q')
+        self.prices = array('d')
+
+        self._routes = {}  # (код вылета, код прибытия) -> (номера строк, время вылета этих строк)
+        self._latest_from = {}  # код города -> время последнего вылета из него
+        self._latest_to = {}  # код города -> время последнего вылета в него
+
+        for position, (ticket_id, from_, to_, when_, price) in enumerate(rows):
+            from_code, to_code, epoch = self._get_code(from_), self._get_code(to_), to_epoch(when_)
+            self.ids.append(ticket_id)
+            self.from_codes.append(from_code)
+            self.to_codes.append(to_code)
+            self.times.append(epoch)
+            self.prices.append(price)
+
+            positions, times = self._routes.setdefault((from_code, to_code), (array('q'), array('q')))
+            positions.append(position)
+            times.append(epoch)
+            self._latest_from[from_code] = epoch  # строки идут по возрастанию времени - последнее и есть наибольшее
+            self._latest_to[to_code] = epoch
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _get_code(self, city):
+        code = self._codes.get(city)
+        if code is None:
+            code = self._codes[city] = len(self.cities)
+            self.cities.append(city)
+        return code
+
+    def _select(self, after, from_, to_):
+        """ Номера строк с рейсами позже after (в порядке when_, id), отобранные по городам, или None """
+
+        from_code = self._codes.get(from_) if from_ else None
+        to_code = self._codes.get(to_) if to_ else None
+        if (from_ and from_code is None) or (to_ and to_code is None):
+            return None
+
+        if from_ and to_:
+            route = self._routes.get((from_code, to_code))
+            if route is None:
+                return None
+            positions, times = route
+            return positions[bisect.bisect_right(times, after):]
+
+        start = bisect.bisect_right(self.times, after)
+        from_codes, to_codes = self.from_codes, self.to_codes
+        return (position for position in range(start, len(self.times))
+                if (from_code is None or from_codes[position] == from_code)
+                and (to_code is None or to_codes[position] == to_code))
+
+    def get_tickets(self, when_, from_=None, to_=None, limit=None, after=None):
+        """ Рейсы позже when_ (и позже курсора after) по времени вылета, цене и id, как в Dispatcher.get_tickets """
+
+        start = to_epoch(when_)
+        if after is not None:
+            after_key = (to_epoch(after[0]), after[1], after[2])
+            start = max(start, after_key[0] - 1)  # рейсы с тем же временем, что у курсора, сравниваются по цене и id
+        positions = self._select(start, from_, to_)
+        if positions is None:
+            return {}
+
+        times, prices, ids = self.times, self.prices, self.ids
+
+        def key(position):
+            return times[position], prices[position], ids[position]
+
+        # строки идут по времени вылета: нужны первые limit строк и строки с тем же временем, что у последней из них,
+        # поэтому страница на любой глубине стоит одинаково
+        selected = []
+        for position in positions:
+            if after is not None and times[position] == after_key[0] and key(position) <= after_key:
+                continue
+            if limit is not None and len(selected) >= limit and times[position] != times[selected[-1]]:
+                break
+            selected.append(position)
+        positions = sorted(selected, key=key)[:limit]
+
+        cities, from_codes = self.cities, self.from_codes
+        result = {}
+        for position in positions:
+            ticket_id = self.ids[position]
+            result[ticket_id] = {
+                'id': ticket_id,
+                'from_': cities[from_codes[position]],
+                'to_': cities[self.to_codes[position]],
+                'when_': from_epoch(self.times[position]),
+                'price': prices[position],
+            }
+        return result
+
+    def _get_locations(self, latest, when_, limit):
+        after = to_epoch(when_)
+        return sorted(self.cities[code] for code, epoch in latest.items() if epoch > after)[:limit]
+
+    def get_departure_locations(self, when_, limit=None):
+        return self._get_locations(self._latest_from, when_, limit)
+
+    def get_arrival_locations(self, when_, limit=None):
+        return self._get_locations(self._latest_to, when_, limit)
+
+    def is_route_available(self, from_, to_, when_):
+        route = self._routes.get((self._codes.get(from_), self._codes.get(to_)))
+        return route is not None and route[1][-1] > to_epoch(when_)
+
+
+class ColumnarInventory:
+    """
+    Снимок TicketColumns, который перестраивается в фоне после записи рейсов этим процессом и раз в max_age секунд
+    (чтобы учесть записи других процессов). Пока новый снимок строится, запросы получают предыдущий - ждёт
+    построения только самый первый запрос.
+    """
+
+    def __init__(self, loader, max_age=None):
+        """
+        :param loader: функция без параметров, возвращающая строки для TicketColumns
+        :param max_age: период перестроения снимка в фоне, сек. (None - не перестраивать)
+        """
+
+        self.loader = loader
+        self.max_age = max_age
+        self.logger = logging.getLogger('bot_logger')
+
+        self.rebuild_count = 0
+        self._columns = None
+        self._version = None  # версия inventory Dispatcher, по которой построен снимок
+        self._built_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def version(self):
+        """ Версия inventory, по которой построен текущий снимок (None - снимок ещё не построен) """
+        return self._version
+
+    @property
+    def is_stale(self):
+        return self.max_age is not None and time.monotonic() - self._built_at > self.max_age
+
+    def get(self, version):
+        """ Текущий снимок; если он построен не по версии inventory version или устарел - запускает перестроение """
+
+        if self._columns is None:
+            with self._lock:
+                # пока ждали блокировку, снимок мог построить другой поток
+                if self._columns is None:
+                    self.rebuild(version)
+        elif self._version != version or self.is_stale:
+            self.rebuild_in_background(version)
+        return self._columns
+
+    def rebuild(self, version):
+        columns = TicketColumns(self.loader())
+        self._columns, self._version, self._built_at = columns, version, time.monotonic()
+        self.rebuild_count += 1
+
+    def rebuild_in_background(self, version):
+        if not self._lock.acquire(blocking=False):
+            return
+
+        def rebuild_and_release():
+            try:
+                self.rebuild(version)
+            except Exception as exc:
+                self.logger.exception('Не удалось перестроить рейсы в памяти: %s', (exc.__class__.__name__, exc.args))
+            finally:
+                self._lock.release()
+
+        threading.Thread(target=rebuild_and_release, name='inventory-rebuild', daemon=True).start()
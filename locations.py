@@ -0,0 +1,268 @@
+''' Индекс городов для распознавания локаций, введенных пользователем '''
+import logging
+import threading
+import time
+
+# транслитерация латиницы в кириллицу: сначала более длинные сочетания
+TRANSLIT = (
+    ('shch', 'щ'), ('sch', 'щ'),
+    ('zh', 'ж'), ('kh', 'х'), ('ts', 'ц'), ('ch', 'ч'), ('sh', 'ш'),
+    ('yu', 'ю'), ('ju', 'ю'), ('ya', 'я'), ('ja', 'я'), ('yo', 'ё'), ('jo', 'ё'), ('ye', 'е'),
+    ('a', 'а'), ('b', 'б'), ('c', 'к'), ('d', 'д'), ('e', 'е'), ('f', 'ф'), ('g', 'г'), ('h', 'х'),
+    ('i', 'и'), ('j', 'й'), ('k', 'к'), ('l', 'л'), ('m', 'м'), ('n', 'н'), ('o', 'о'), ('p', 'п'),
+    ('q', 'к'), ('r', 'р'), ('s', 'с'), ('t', 'т'), ('u', 'у'), ('v', 'в'), ('w', 'в'), ('x', 'кс'),
+    ('y', 'ы'), ('z', 'з'), ("'", 'ь'),
+)
+
+
+def transliterate(text):
+    """ Латиница -> кириллица: moskva -> москва """
+
+    result = []
+    position = 0
+    while position < len(text):
+        for latin, cyrillic in TRANSLIT:
+            if text.startswith(latin, position):
+                result.append(cyrillic)
+                position += len(latin)
+                break
+        else:
+            result.append(text[position])
+            position += 1
+
+    return ''.join(result)
+
+
+def normalize(text):
+    return transliterate(text.strip().lower()).replace('ё', 'е')
+
+
+def levenshtein(first, second, max_distance):
+    """ Расстояние редактирования или max_distance + 1, если оно больше max_distance """
+
+    if abs(len(first) - len(second)) > max_distance:
+        return max_distance + 1
+
+    previous = list(range(len(second) + 1))
+    for row, first_char in enumerate(first, 1):
+        current = [row]
+        for column, second_char in enumerate(second, 1):
+            current.append(min(previous[column] + 1,
+                               current[column - 1] + 1,
+                               previous[column - 1] + (first_char != second_char)))
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+
+    return previous[-1]
+
+
+def get_ngrams(word):
+    """ Множество биграмм слова с маркерами начала и конца """
+
+    word = f'^{word}$'
+    return {word[position:position + 2] for position in range(len(word) - 1)}
+
+
+class CityIndex:
+    """
+    Предварительно построенный индекс списка городов:
+    поиск по префиксу (бор) и поиск с опечатками (индекс биграмм), ввод латиницей транслитерируется.
+    При равной оценке города ранжируются в порядке исходного списка.
+    """
+
+    def __init__(self, cities):
+        self.cities = list(cities)
+        self._trie = {}  # символ -> узел; в узле под ключом None - номера городов с этим префиксом
+        self._by_name = {}  # нормализованное название -> номера городов
+        self._ngrams = {}  # биграмма -> названия, в которых она встречается
+
+        for position, city in enumerate(self.cities):
+            name = normalize(city)
+            self._by_name.setdefault(name, []).append(position)
+            for ngram in get_ngrams(name):
+                self._ngrams.setdefault(ngram, set()).add(name)
+
+            node = self._trie
+            for char in name:
+                node = node.setdefault(char, {})
+                node.setdefault(None, []).append(position)
+
+    def __len__(self):
+        return len(self.cities)
+
+    @staticmethod
+    def max_distance(word):
+        """ Допустимое кол-во опечаток в зависимости от длины слова """
+
+        if len(word) < 5:
+            return 0
+        return 1 if len(word) < 8 else 2
+
+    def find_similar(self, word, max_distance):
+        """ [(кол-во опечаток, название), ...] для нормализованных названий не дальше max_distance от word """
+
+        # каждая правка затрагивает не больше двух биграмм, поэтому у подходящего названия
+        # не меньше len(ngrams) - 2 * max_distance общих с word биграмм
+        ngrams = get_ngrams(word)
+        min_common = len(ngrams) - 2 * max_distance
+
+        common = {}
+        for ngram in ngrams:
+            for name in self._ngrams.get(ngram, ()):
+                common[name] = common.get(name, 0) + 1
+
+        result = []
+        for name, count in common.items():
+            if count < min_common:
+                continue
+            distance = levenshtein(word, name, max_distance)
+            if distance <= max_distance:
+                result.append((distance, name))
+
+        return result
+
+    def find_by_prefix(self, prefix, limit=None):
+        """ Города, название которых начинается с prefix, в порядке исходного списка """
+
+        node = self._trie
+        for char in normalize(prefix):
+            node = node.get(char)
+            if node is None:
+                return []
+        return [self.cities[position] for position in node.get(None, [])[:limit]]
+
+    def find_exact(self, word):
+        """
+        Город, название которого начинается с word или отличается от него только последней буквой ("казани"), или None.
+        Без поиска с опечатками: "банк" не находит "Бангкок", "мост" - "Москву"
+        """
+
+        word = normalize(word)
+        if not word:
+            return None
+        cities = self.find_by_prefix(word, 1)
+        if cities:
+            return cities[0]
+        if len(word) > 3:
+            for city in self.find_by_prefix(word[:-1]):
+                if len(normalize(city)) == len(word):
+                    return city
+        return None
+
+    def search(self, word, limit=5):
+        """
+        Ранжированные кандидаты для введенного слова.
+        :return: список (город, кол-во опечаток): сначала совпадения по префиксу (0 опечаток),
+        затем найденные с опечатками по возрастанию их кол-ва.
+        """
+
+        word = normalize(word)
+        if not word:
+            return []
+
+        # последнюю букву отбрасываем - она может быть окончанием: "москву" -> "москв"
+        prefix = word[:-1] if len(word) > 3 else word
+        candidates = [(city, 0) for city in self.find_by_prefix(prefix, limit)]
+        if len(candidates) >= limit:
+            return candidates
+        found = {city for city, distance in candidates}
+
+        fuzzy = []
+        for distance, name in self.find_similar(word, self.max_distance(word)):
+            for position in self._by_name[name]:
+                if self.cities[position] not in found:
+                    fuzzy.append((distance, position))
+        fuzzy.sort()
+        candidates.extend((self.cities[position], distance) for distance, position in fuzzy)
+
+        return candidates[:limit]
+
+    def find(self, word):
+        """ Лучший кандидат для введенного слова или None """
+
+        candidates = self.search(word, limit=1)
+        return candidates[0][0] if candidates else None
+
+
+class LocationCache:
+    """
+    Список локаций (с индексом CityIndex), который обновляется в фоне по истечении ttl секунд.
+    Обращение к index никогда не ждет запроса к БД: пока идет обновление, возвращается прежний индекс,
+    новый подменяет его целиком одним присваиванием.
+    """
+
+    def __init__(self, loader, ttl=None, name='locations', retry_delay=5.0):
+        """
+        :param loader: функция без параметров, возвращающая список локаций
+        :param ttl: время жизни списка, сек. (None - не обновлять)
+        :param name: название кэша для логов
+        :param retry_delay: пауза перед повтором неудачного обновления, сек.;
+        удваивается после каждой следующей неудачи, но не больше ttl
+        """
+
+        self.loader = loader
+        self.ttl = ttl
+        self.name = name
+        self.retry_delay = retry_delay
+        self.logger = logging.getLogger('bot_logger')
+
+        self.refresh_count = 0
+        self.refresh_errors = 0
+        self._refreshing = threading.Lock()
+        self._index = None
+        self._loaded_at = None
+        self._retry_at = None  # после неудачного обновления - время, раньше которого новое не запускается
+        self._failures = 0  # неудачных обновлений подряд
+
+        self.refresh()  # первая загрузка - синхронно, без списка локаций бот не работает
+
+    @property
+    def age(self):
+        """ Сколько секунд прошло с последней загрузки списка """
+        return time.monotonic() - self._loaded_at
+
+    @property
+    def index(self):
+        index = self._index
+        if self.ttl is not None and self.age > self.ttl:
+            if self._retry_at is None or time.monotonic() >= self._retry_at:
+                self.refresh_in_background()
+        return index
+
+    def refresh(self):
+        """ Загрузить список и подменить индекс """
+
+        index = CityIndex(self.loader())
+        self._index, self._loaded_at = index, time.monotonic()
+        self._retry_at, self._failures = None, 0
+        self.refresh_count += 1
+
+    def refresh_in_background(self):
+        """ Запустить обновление в отдельном потоке, если оно еще не идет """
+
+        if not self._refreshing.acquire(blocking=False):
+            return
+        threading.Thread(target=self._refresh_and_release, name=f'{self.name}-refresh', daemon=True).start()
+
+    def _refresh_and_release(self):
+        try:
+            self.refresh()
+        except Exception as exc:
+            self.refresh_errors += 1
+            # пока БД недоступна, каждое сообщение запускало бы новую попытку: следующая - после паузы
+            self._failures += 1
+            delay = min(self.retry_delay * 2 ** (self._failures - 1), self.ttl)
+            self._retry_at = time.monotonic() + delay
+            self.logger.exception('Не удалось обновить список %s, повтор через %.0f сек.: %s', self.name, delay,
+                                  (exc.__class__.__name__, exc.args))
+        finally:
+            self._refreshing.release()
+
+    def stats(self):
+        return {
+            'size': len(self._index),
+            'age': self.age,
+            'refresh_count': self.refresh_count,
+            'refresh_errors': self.refresh_errors,
+        }
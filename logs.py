@@ -0,0 +1,110 @@
+''' Настройка логирования бота: запись в файл и консоль в фоновом потоке, строки JSON в файле, ротация по размеру '''
+import atexit
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+
+TEXT_FORMAT = '{asctime} - {name} - {levelname} - {message}'
+TIME_FORMAT = '%d-%m-%Y %H:%M'
+
+# атрибуты, которые есть у любой записи лога; остальные переданы через extra и попадают в JSON отдельными полями
+_RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """ Запись лога - одна строка JSON: time, level, logger, thread, message, поля из extra и exception """
+
+    def format(self, record):
+        data = {
+            'time': datetime.datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                data[key] = value
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        if record.stack_info:
+            data['stack'] = self.formatStack(record.stack_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Передает запись в очередь как есть: сообщение форматируется потоком записи и только обработчиком,
+    уровень которого ее пропускает. Стандартный QueueHandler форматирует запись в вызывающем потоке.
+    Очередь в памяти процесса, поэтому запись не нужно готовить к pickle.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def setup_logging(name='bot_logger', path='bot.log', use_queue=True, use_json=True, max_bytes=10 * 1024 * 1024,
+                  backup_count=5, console_level=logging.INFO, file_level=logging.DEBUG):
+    """
+    Настраивает логгер name (один раз на процесс, повторные вызовы возвращают уже настроенный логгер).
+    :param path: str - файл лога
+    :param use_queue: bool - писать в файл и консоль в фоновом потоке: вызов логгера только ставит запись в очередь
+    :param use_json: bool - в файл пишутся строки JSON, иначе - текст как в консоли
+    :param max_bytes: int - размер файла, после которого он переименовывается в path.1 и начинается новый
+    (0 - без ротации)
+    :param backup_count: int - сколько старых файлов хранить
+    """
+
+    logger = logging.getLogger(name)
+    if getattr(logger, 'listener_pid', None) not in (None, os.getpid()):
+        # процесс создан через fork после настройки: поток записи родителя в нем не работает
+        logger.handlers.clear()
+        logger.listener = logger.listener_pid = None
+    if getattr(logger, 'listener', None) is not None or logger.handlers:
+        return logger
+
+    logger.setLevel(min(console_level, file_level))
+    text_formatter = logging.Formatter(TEXT_FORMAT, datefmt=TIME_FORMAT, style='{')
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setLevel(console_level)
+    stream_handler.setFormatter(text_formatter)
+
+    file_handler = logging.handlers.RotatingFileHandler(path, 'a', max_bytes, backup_count, 'utf8', delay=True)
+    file_handler.setLevel(file_level)
+    file_handler.setFormatter(JsonFormatter() if use_json else text_formatter)
+
+    if not use_queue:
+        logger.addHandler(stream_handler)
+        logger.addHandler(file_handler)
+        return logger
+
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, stream_handler, file_handler, respect_handler_level=True)
+    logger.addHandler(DeferredQueueHandler(records))
+    # иначе обработчики корневого логгера форматировали бы и выводили запись в вызывающем потоке
+    logger.propagate = False
+    listener.start()
+    logger.listener, logger.listener_pid = listener, os.getpid()
+    atexit.register(stop_logging, name)  # дописать записи из очереди при завершении процесса
+    return logger
+
+
+def stop_logging(name='bot_logger'):
+    """ Дописать записи из очереди логгера name, остановить фоновый поток и закрыть файл лога """
+
+    logger = logging.getLogger(name)
+    listener, logger.listener = getattr(logger, 'listener', None), None
+    if listener is not None:
+        listener.stop()
+        handlers = listener.handlers
+    else:
+        handlers = logger.handlers[:]
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+    logger.propagate = True
+    for handler in handlers:
+        handler.close()
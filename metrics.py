@@ -0,0 +1,217 @@
+''' Метрики работы бота (счетчики и гистограммы) и их отдача по HTTP в текстовом формате Prometheus '''
+import bisect
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# границы корзин гистограмм длительности, сек.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    """ Набор метрик, которые отдаются вместе """
+
+    def __init__(self):
+        self.metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if any(registered.name == metric.name for registered in self.metrics):
+                raise ValueError(f'Метрика {metric.name} уже зарегистрирована')
+            self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """ Все метрики в текстовом формате Prometheus """
+        return ''.join(metric.render() for metric in list(self.metrics))
+
+
+REGISTRY = Registry()
+
+
+class Counter:
+    """ Монотонно растущий счетчик, отдельный для каждого набора значений меток """
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}  # значения меток -> счетчик
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def get(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}\n', f'# TYPE {self.name} {self.kind}\n']
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            lines.append(f'{self.name}{_format_labels(self.labels, label_values)} {_format_number(value)}\n')
+        return ''.join(lines)
+
+
+class Gauge(Counter):
+    """ Текущее значение, которое может как расти, так и уменьшаться """
+
+    kind = 'gauge'
+
+    def set(self, value, *label_values):
+        with self._lock:
+            self._values[label_values] = value
+
+
+class _Timer:
+    """ Замер длительности блока with или вызова функции (как декоратор) в гистограмму """
+
+    __slots__ = ('histogram', 'label_values', 'started')
+
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, *self.label_values)
+
+    def __call__(self, function):
+        histogram, label_values = self.histogram, self.label_values
+
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started, *label_values)
+
+        timed.__name__, timed.__doc__, timed.__wrapped__ = function.__name__, function.__doc__, function
+        return timed
+
+
+class Histogram:
+    """
+    Распределение значений (обычно длительностей, сек.) по корзинам.
+    Наблюдение - двоичный поиск корзины и несколько сложений под блокировкой, поэтому метрики можно не выключать.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # значения меток -> [кол-во в каждой корзине..., в +Inf, сумма]
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def observe(self, value, *label_values):
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            values = self._values.get(label_values)
+            if values is None:
+                values = self._values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            values[position] += 1
+            values[-1] += value
+
+    def time(self, *label_values):
+        """ with histogram.time('метка'): ... или @histogram.time('метка') """
+        return _Timer(self, label_values)
+
+    def count(self, *label_values):
+        values = self._values.get(label_values)
+        return sum(values[:-1]) if values else 0
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}\n', f'# TYPE {self.name} {self.kind}\n']
+        with self._lock:
+            items = sorted((label_values, list(values)) for label_values, values in self._values.items())
+
+        for label_values, values in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), values):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float('inf') else f'le="{bound!r}"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.labels, label_values, le)} {cumulative}\n')
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f'{self.name}_sum{labels} {_format_number(values[-1])}\n')
+            lines.append(f'{self.name}_count{labels} {cumulative}\n')
+        return ''.join(lines)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+    is_ready = None  # функция без параметров -> bool для GET /ready
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/metrics':
+            self._send(200, self.registry.render())
+        elif path == '/ready' and self.is_ready is not None:
+            # 503, пока бот не загрузил все необходимое для ответа на сообщения
+            ready = self.is_ready()
+            self._send(200 if ready else 503, 'ready\n' if ready else 'starting\n')
+        else:
+            self.send_error(404)
+
+    def _send(self, status, text):
+        body = text.encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # запросы сборщика метрик не пишем в лог
+
+
+def start_metrics_server(port, host='127.0.0.1', registry=REGISTRY, is_ready=None):
+    """
+    HTTP сервер метрик (GET /metrics) в фоновом потоке.
+    :param port: int - порт (0 - любой свободный, см. server.server_address)
+    :param is_ready: функция без параметров -> bool: готовность для GET /ready (None - без /ready)
+    :return: ThreadingHTTPServer - для остановки вызвать shutdown(), или None, если порт занят:
+    бот работает и без метрик
+    """
+
+    handler = type('RequestHandler', (MetricsRequestHandler,),
+                   {'registry': registry, 'is_ready': staticmethod(is_ready) if is_ready else None})
+    try:
+        server = ThreadingHTTPServer((host, port), handler)
+    except OSError as exc:
+        logging.getLogger('bot_logger').error('Сервер метрик не запущен на %s:%s: %s', host, port,
+                                              (exc.__class__.__name__, exc.args))
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
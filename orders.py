@@ -0,0 +1,146 @@
+''' Запись оформленных заказов в БД в фоне: пачками в одной транзакции, без ожидания записи на пути ответа '''
+import atexit
+import datetime
+import logging
+import queue
+import threading
+import time
+
+from metrics import Counter, Histogram
+
+_STOP = object()  # маркер остановки потока записи
+
+ORDERS_WRITTEN = Counter('orders_written_total', 'Заказы, записанные в БД')
+ORDERS_FAILED = Counter('orders_failed_total', 'Заказы, которые не удалось записать в БД')
+ORDER_COMMIT_SECONDS = Histogram('order_commit_seconds', 'Время записи пачки заказов в БД, сек.')
+
+
+def get_order(user_id, context, created_at=None):
+    """ Заказ (словарь с полями tickets.ORDER_FIELDS) по контексту завершенного сценария заказа билета """
+
+    flight = context['flight']
+    tickets_qty = context['tickets_qty']
+    return {
+        'peer_id': user_id,
+        'from_': context['from_'],
+        'to_': context['to_'],
+        'flight_id': context['flight_id'],
+        'flight_when_': flight['when_'],
+        'tickets_qty': tickets_qty,
+        'price': flight['price'],
+        'total': tickets_qty * flight['price'],
+        'phone': context['phone'],
+        'comment': context.get('comment', ''),
+        'created_at': created_at or datetime.datetime.now(),
+    }
+
+
+class OrderWriter:
+    """
+    Очередь заказов с групповой записью: поток записи собирает заказы в течение flush_interval секунд
+    (но не больше batch_size штук) и записывает их функцией write_batch (Dispatcher.add_orders) одной транзакцией.
+    Пачка, которую не удалось записать, повторяется с нарастающей паузой; после max_retries попыток
+    заказы пишутся в лог, чтобы не потеряться. close() дожидается записи всех поставленных заказов;
+    пока поток записи работает, close() зарегистрирован в atexit, поэтому заказы дописываются и при выходе из процесса.
+    """
+
+    def __init__(self, write_batch, batch_size=500, flush_interval=0.05, max_retries=5, retry_delay=0.1):
+        """
+        :param write_batch: функция (list заказов) - запись пачки в БД
+        :param batch_size: int - макс. кол-во заказов в одной транзакции
+        :param flush_interval: float - сколько ждать следующих заказов перед записью пачки, сек.
+        :param max_retries: int - кол-во повторов записи пачки при ошибке
+        :param retry_delay: float - пауза перед первым повтором, сек. (удваивается с каждым повтором)
+        """
+
+        if batch_size < 1:
+            raise ValueError(f'Размер пачки должен быть больше 0, передано: {batch_size}')
+
+        self.write_batch = write_batch
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.logger = logging.getLogger('bot_logger')
+
+        self.queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+        # статистика
+        self.batches_written = 0
+        self.orders_written = 0
+        self.orders_failed = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='order-writer', daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+
+    def close(self, timeout=None):
+        """ Записать все поставленные в очередь заказы и остановить поток записи """
+
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            atexit.unregister(self.close)
+            self.queue.put(_STOP)
+            thread.join(timeout)
+
+    def submit(self, order):
+        """ Поставить заказ в очередь записи. Не ждет записи в БД """
+
+        self.start()
+        self.queue.put(order)
+
+    def _collect(self, first_order):
+        batch = [first_order]
+        deadline = time.monotonic() + self.flush_interval
+
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                # заказы, уже стоящие в очереди, забираются и после окончания интервала
+                order = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if order is _STOP:
+                return batch, True
+            batch.append(order)
+
+        return batch, False
+
+    def _run(self):
+        stop = False
+        while not stop:
+            order = self.queue.get()
+            if order is _STOP:
+                break
+            batch, stop = self._collect(order)
+            self.flush(batch)
+
+    def flush(self, batch):
+        """ Записать пачку заказов, повторяя при ошибке """
+
+        delay = self.retry_delay
+        for attempt in range(self.max_retries + 1):
+            try:
+                with ORDER_COMMIT_SECONDS.time():
+                    self.write_batch(batch)
+            except Exception as exc:
+                if attempt == self.max_retries:
+                    self.orders_failed += len(batch)
+                    ORDERS_FAILED.inc(amount=len(batch))
+                    self.logger.error('Заказы не записаны в БД (%s): %r', (exc.__class__.__name__, exc.args), batch)
+                    return
+                self.logger.warning('Ошибка записи %s заказов в БД, повтор через %.1f сек.: %s', len(batch), delay,
+                                    (exc.__class__.__name__, exc.args))
+                time.sleep(delay)
+                delay *= 2
+            else:
+                self.batches_written += 1
+                self.orders_written += len(batch)
+                ORDERS_WRITTEN.inc(amount=len(batch))
+                return
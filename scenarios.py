@@ -0,0 +1,144 @@
+'''
+Сценарии settings.SCENARIOS, скомпилированные при запуске бота в неизменяемые шаги:
+обработчик шага уже найден, шаблоны текстов разобраны и проверены, у шага есть ссылка на следующий.
+Ошибка в описании сценария обнаруживается при компиляции, а не когда до шага дойдет пользователь.
+'''
+import string
+import threading
+from collections import namedtuple
+
+import handlers
+from settings import SCENARIOS
+
+
+class ScenarioError(Exception):
+    pass
+
+
+class Template:
+    """ Текст шага с полями str.format, которые берутся из контекста пользователя """
+
+    __slots__ = ('text', 'fields')
+
+    def __init__(self, text):
+        self.text = text
+        try:
+            # имя поля без индексов и атрибутов: {flight[id]} -> flight
+            self.fields = frozenset(field.split('.')[0].split('[')[0]
+                                    for _, field, _, _ in string.Formatter().parse(text) if field is not None)
+        except ValueError as exc:
+            raise ScenarioError(f'Некорректный шаблон {text!r}: {exc}') from exc
+        if '' in self.fields:
+            raise ScenarioError(f'Позиционное поле в шаблоне {text!r}')
+
+    def render(self, context):
+        return self.text.format_map(context) if self.fields else self.text
+
+    def __repr__(self):
+        return f'Template({self.text!r})'
+
+
+class Step(namedtuple('Step', 'scenario number handler_name handler text failure_text next')):
+    """
+    Шаг сценария. handler - функция обработчика (None у последнего шага), text - шаблон, который отправляется
+    при переходе на шаг, failure_text - при неверном вводе на шаге, next - следующий шаг (None у последнего).
+    """
+
+    __slots__ = ()
+
+    @property
+    def is_final(self):
+        return self.next is None
+
+
+Scenario = namedtuple('Scenario', 'name main_token help_token quit_token first_step steps')
+
+
+def _check_fields(template, available, where):
+    missing = template.fields - available
+    if missing:
+        raise ScenarioError(f'{where}: в контексте к этому шагу не будет полей {", ".join(sorted(missing))}')
+
+
+def compile_scenario(name, config, handlers_module=handlers):
+    """
+    Компилирует описание сценария из settings.SCENARIOS.
+    Поля шаблонов проверяются по ключам контекста, которые заполняют обработчики предыдущих шагов
+    (декоратор handlers.provides), а для failure_text - также обработчик самого шага при неудаче.
+    :raise ScenarioError: при ошибке в описании сценария
+    """
+
+    configs = config['steps']
+    if sorted(configs) != list(range(1, len(configs) + 1)):
+        raise ScenarioError(f'Сценарий {name}: шаги должны быть пронумерованы подряд с 1, заданы: {sorted(configs)}')
+
+    # ключи контекста, доступные при отправке текста каждого шага, и функции обработчиков
+    available, handler_functions = set(), {}
+    text_fields = {}
+    for number in sorted(configs):
+        step_config = configs[number]
+        where = f'Сценарий {name}, шаг {number}'
+        if step_config.get('step_number', number) != number:
+            raise ScenarioError(f'{where}: step_number = {step_config["step_number"]}')
+
+        text_fields[number] = frozenset(available)
+        handler_name = step_config.get('handler')
+        is_last = number == len(configs)
+        if is_last:
+            if handler_name is not None:
+                raise ScenarioError(f'{where}: у последнего шага не может быть обработчика')
+            continue
+
+        handler = getattr(handlers_module, handler_name or '', None)
+        if not callable(handler):
+            raise ScenarioError(f'{where}: не найден обработчик {handler_name!r}')
+        handler_functions[number] = handler
+        available |= set(getattr(handler, 'provides', ()))
+
+    # шаги собираются с конца, чтобы каждый сразу получил ссылку на следующий
+    steps, next_step = {}, None
+    for number in sorted(configs, reverse=True):
+        step_config = configs[number]
+        where = f'Сценарий {name}, шаг {number}'
+        handler = handler_functions.get(number)
+
+        text = Template(step_config['text'])
+        _check_fields(text, text_fields[number], f'{where}, text')
+
+        failure_text = None
+        if step_config.get('failure_text') is not None:
+            failure_text = Template(step_config['failure_text'])
+            on_failure = set(getattr(handler, 'provides_on_failure', ()))
+            _check_fields(failure_text, text_fields[number] | on_failure, f'{where}, failure_text')
+
+        next_step = steps[number] = Step(name, number, step_config.get('handler'), handler, text, failure_text,
+                                         next_step)
+
+    return Scenario(name, config.get('main_token'), config.get('help_token'), config.get('quit_token'),
+                    steps[1], steps)
+
+
+def compile_scenarios(scenarios=None, handlers_module=handlers):
+    """ Компилирует все сценарии: {название: Scenario} """
+
+    scenarios = SCENARIOS if scenarios is None else scenarios
+    return {name: compile_scenario(name, config, handlers_module) for name, config in scenarios.items()}
+
+
+_compiled = None
+_compile_lock = threading.Lock()
+
+
+def get_scenarios():
+    """ Скомпилированные settings.SCENARIOS (компилируются один раз при первом обращении) """
+
+    global _compiled
+    if _compiled is None:
+        with _compile_lock:
+            if _compiled is None:
+                _compiled = compile_scenarios()
+    return _compiled
+
+
+def get_scenario(name):
+    return get_scenarios()[name]
@@ -0,0 +1,237 @@
+''' Планировщик исходящих сообщений: квота запросов к VK API, приоритеты, повтор при "слишком много запросов" '''
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import Future
+
+from vk_api.exceptions import ApiError
+
+from metrics import Counter, Gauge
+from sender import EXECUTE_MAX_CALLS, BatchSender
+
+# классы приоритета: меньшее значение отправляется раньше
+PRIORITY_REPLY = 0  # ответы пользователям, в том числе в сценарии
+PRIORITY_BROADCAST = 1  # рассылки
+PRIORITIES = {PRIORITY_REPLY: 'reply', PRIORITY_BROADCAST: 'broadcast'}
+
+TOO_MANY_REQUESTS = 6  # код ошибки VK API "Too many requests per second"
+
+SEND_QUEUE_DEPTH = Gauge('bot_send_queue_depth', 'Сообщения в очереди отправки', ('priority',))
+SEND_DROPPED = Counter('bot_send_dropped_total', 'Сообщения, не отправленные планировщиком', ('priority', 'reason'))
+SEND_RATE_LIMITED = Counter('bot_send_rate_limited_total', 'Ответы VK "слишком много запросов" на отправку')
+SEND_RATE = Gauge('bot_send_rate', 'Текущий предел частоты запросов отправки к VK API, в сек.')
+
+
+class QueueFullError(Exception):
+    """ Очередь отправки сообщений этого приоритета заполнена, сообщение не принято """
+
+
+def is_rate_limited(exc):
+    return isinstance(exc, ApiError) and exc.code == TOO_MANY_REQUESTS
+
+
+class TokenBucket:
+    """
+    Ограничение частоты: rate токенов в секунду, накапливается не больше burst.
+    Частота подстраивается: при ответе VK "слишком много запросов" снижается вдвое (не ниже min_rate),
+    после каждого успешного запроса восстанавливается на recovery, но не выше исходной.
+    """
+
+    def __init__(self, rate, burst=None, min_rate=1.0, recovery=None, clock=time.monotonic, sleep=time.sleep):
+        if rate <= 0:
+            raise ValueError(f'Частота должна быть больше 0, передано: {rate}')
+
+        self.max_rate = self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.min_rate = min(min_rate, self.max_rate)
+        self.recovery = self.max_rate / 20 if recovery is None else recovery
+        self.clock = clock
+        self.sleep = sleep
+
+        self.tokens = self.burst
+        self.updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """ Взять токен, дождавшись его при необходимости. Возвращает время ожидания, сек. """
+
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill(self.clock())
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            self.sleep(delay)
+            waited += delay
+
+    def slow_down(self):
+        with self._lock:
+            self._refill(self.clock())
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0.0)  # накопленный запас тоже превысил бы квоту
+        return self.rate
+
+    def speed_up(self):
+        with self._lock:
+            self._refill(self.clock())
+            self.rate = min(self.max_rate, self.rate + self.recovery)
+        return self.rate
+
+
+Outgoing = namedtuple('Outgoing', 'params future priority attempts')
+
+
+class OutboundScheduler(BatchSender):
+    """
+    Очереди исходящих сообщений по приоритетам перед пакетной отправкой: сначала ответы, затем рассылки.
+    Каждый запрос к VK API (messages.send или execute до batch_size сообщений) берет токен TokenBucket,
+    поэтому частота запросов не превышает квоту группы. Пакет, на который VK ответил "слишком много запросов",
+    возвращается в начало своих очередей и повторяется при сниженной частоте (не больше max_retries раз).
+    Каждая очередь ограничена max_queue сообщениями: сообщение сверх предела сразу завершается QueueFullError.
+    """
+
+    def __init__(self, api, rate=20, burst=None, batch_window=0.05, batch_size=EXECUTE_MAX_CALLS, max_queue=1000,
+                 max_retries=5, retry_delay=0.1, min_rate=1.0):
+        """
+        :param rate: float - квота запросов к VK API в сек. (None - без ограничения частоты)
+        :param burst: int - сколько запросов можно отправить подряд после простоя (по умолчанию - rate)
+        :param batch_window: float - окно накопления сообщений для execute, сек. (0 - только уже ожидающие)
+        :param max_queue: int - предел сообщений в очереди каждого приоритета
+        :param max_retries: int - сколько раз повторять пакет после ответа "слишком много запросов"
+        :param retry_delay: float - пауза перед первым повтором, сек. (удваивается с каждым повтором)
+        """
+
+        super().__init__(api, batch_window=batch_window, batch_size=batch_size)
+        self.bucket = TokenBucket(rate, burst, min_rate) if rate else None
+        self.max_queue = max_queue
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+
+        self.queues = {priority: deque() for priority in sorted(PRIORITIES)}
+        self._condition = threading.Condition()
+        self._stopping = False
+
+        # статистика
+        self.rate_limited = 0
+        self.messages_dropped = 0
+
+        if self.bucket is not None:
+            SEND_RATE.set(self.bucket.rate)
+
+    def close(self, timeout=None):
+        """ Отправить сообщения из всех очередей и остановить поток отправки """
+
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            with self._condition:
+                self._stopping = True
+                self._condition.notify()
+            thread.join(timeout)
+
+    def send(self, priority=PRIORITY_REPLY, **params):
+        """ Поставить сообщение (параметры messages.send) в очередь приоритета. Возвращает Future с результатом """
+
+        if priority not in self.queues:
+            raise ValueError(f'Неизвестный приоритет: {priority}, допустимые: {", ".join(map(str, PRIORITIES))}')
+
+        future = Future()
+        self.start()
+        with self._condition:
+            queue = self.queues[priority]
+            if len(queue) >= self.max_queue:
+                self._drop(priority, 'queue_full')
+                future.set_exception(QueueFullError(f'Очередь отправки {PRIORITIES[priority]} заполнена'))
+                return future
+            queue.append(Outgoing(params, future, priority, 0))
+            SEND_QUEUE_DEPTH.set(len(queue), PRIORITIES[priority])
+            self._condition.notify()
+        return future
+
+    @property
+    def queued(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def _take(self):
+        """ До batch_size сообщений, начиная с самого срочного приоритета (вызывается под _condition) """
+
+        batch = []
+        for priority, queue in self.queues.items():
+            while queue and len(batch) < self.batch_size:
+                batch.append(queue.popleft())
+            SEND_QUEUE_DEPTH.set(len(queue), PRIORITIES[priority])
+        return batch
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self.queued and not self._stopping:
+                    self._condition.wait()
+                if not self.queued:
+                    self._stopping = False
+                    return
+
+            deadline = time.monotonic() + self.batch_window
+            if self.bucket is not None:
+                self.bucket.acquire()  # пока ждем токен, в очередь могут прийти более срочные сообщения
+
+            with self._condition:
+                while self.queued < self.batch_size and not self._stopping:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    self._condition.wait(timeout)
+                batch = self._take()
+            self.flush(batch)
+
+    def flush(self, batch):
+        """ Отправить пакет [Outgoing, ...] одним запросом и передать каждому future его результат """
+
+        try:
+            results = self._call_api([item.params for item in batch])
+        except Exception as exc:
+            if is_rate_limited(exc):
+                self._retry(batch, exc)
+                return
+            self.messages_failed += len(batch)
+            for item in batch:
+                item.future.set_exception(exc)
+            return
+
+        if self.bucket is not None:
+            SEND_RATE.set(self.bucket.speed_up())
+        self._deliver([(item.params, item.future) for item in batch], results)
+
+    def _retry(self, batch, exc):
+        self.rate_limited += 1
+        SEND_RATE_LIMITED.inc()
+        if self.bucket is not None:
+            SEND_RATE.set(self.bucket.slow_down())
+
+        retry = []
+        for item in batch:
+            if item.attempts >= self.max_retries:
+                self._drop(item.priority, 'retries')
+                item.future.set_exception(exc)
+            else:
+                retry.append(item._replace(attempts=item.attempts + 1))
+        if not retry:
+            return
+
+        time.sleep(self.retry_delay * 2 ** (max(item.attempts for item in retry) - 1))
+        with self._condition:
+            # в начало очередей в прежнем порядке: повтор уходит раньше сообщений, поставленных позже
+            for item in reversed(retry):
+                self.queues[item.priority].appendleft(item)
+            for priority, queue in self.queues.items():
+                SEND_QUEUE_DEPTH.set(len(queue), PRIORITIES[priority])
+
+    def _drop(self, priority, reason):
+        self.messages_dropped += 1
+        SEND_DROPPED.inc(PRIORITIES[priority], reason)
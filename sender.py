@@ -0,0 +1,128 @@
+''' Пакетная отправка исходящих сообщений через метод VK API execute '''
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+EXECUTE_MAX_CALLS = 25  # ограничение VK на кол-во вызовов API внутри одного execute
+
+_STOP = object()  # маркер остановки потока отправки
+
+
+class SendError(Exception):
+    """ Сообщение из пакета не отправлено (VK вернул false для вызова внутри execute) """
+
+
+def build_execute_code(messages):
+    """ Код VKScript для отправки нескольких сообщений одним запросом """
+
+    calls = ','.join(f'API.messages.send({json.dumps(params, ensure_ascii=False)})' for params in messages)
+    return f'return [{calls}];'
+
+
+class BatchSender:
+    """
+    Очередь исходящих сообщений: собирает сообщения в течение batch_window секунд
+    (но не больше batch_size штук) и отправляет их одним вызовом execute.
+    Результат отправки каждого сообщения возвращается через concurrent.futures.Future.
+    """
+
+    def __init__(self, api, batch_window=0.05, batch_size=EXECUTE_MAX_CALLS):
+        if not 1 <= batch_size <= EXECUTE_MAX_CALLS:
+            raise ValueError(f'Размер пакета должен быть от 1 до {EXECUTE_MAX_CALLS}, передано: {batch_size}')
+
+        self.api = api
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+
+        self.queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+        # статистика
+        self.batches_sent = 0
+        self.messages_sent = 0
+        self.messages_failed = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='bot-sender', daemon=True)
+                self._thread.start()
+
+    def close(self, timeout=None):
+        """ Отправить накопленные сообщения и остановить поток отправки """
+
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self.queue.put(_STOP)
+            thread.join(timeout)
+
+    def send(self, **params):
+        """ Поставить сообщение (параметры messages.send) в очередь. Возвращает Future с результатом отправки """
+
+        future = Future()
+        self.start()
+        self.queue.put((params, future))
+        return future
+
+    def _collect(self, first_item):
+        batch = [first_item]
+        deadline = time.monotonic() + self.batch_window
+
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+
+        return batch, False
+
+    def _run(self):
+        stop = False
+        while not stop:
+            item = self.queue.get()
+            if item is _STOP:
+                break
+            batch, stop = self._collect(item)
+            self.flush(batch)
+
+    def flush(self, batch):
+        """ Отправить пакет [(params, future), ...] и передать каждому future его результат """
+
+        try:
+            results = self._call_api([params for params, future in batch])
+        except Exception as exc:
+            self.messages_failed += len(batch)
+            for params, future in batch:
+                future.set_exception(exc)
+            return
+
+        self._deliver(batch, results)
+
+    def _call_api(self, messages):
+        """ Один запрос к VK API: messages.send для одного сообщения, execute - для нескольких """
+
+        if len(messages) == 1:
+            return [self.api.messages.send(**messages[0])]
+        return self.api.execute(code=build_execute_code(messages))
+
+    def _deliver(self, batch, results):
+        self.batches_sent += 1
+        results = list(results or [])
+        results += [None] * (len(batch) - len(results))  # на вызовы без ответа - ошибка отправки
+        for (params, future), result in zip(batch, results):
+            if result is False or result is None:
+                self.messages_failed += 1
+                future.set_exception(SendError(f'Сообщение для peer_id {params.get("peer_id")} не отправлено'))
+            else:
+                self.messages_sent += 1
+                future.set_result(result)
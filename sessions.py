@@ -0,0 +1,231 @@
+''' Хранилища состояний пользователей в сценариях '''
+import os.path
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from scenarios import get_scenario
+
+
+class UserState:
+    '''Состояние пользователя в сценарии'''
+
+    def __init__(self, scenario, step, context=None):
+        self.scenario = scenario
+        self.step = step
+        self.context = context or {}
+
+    def __getstate__(self):
+        # шаг сохраняем по номеру, описание шага при восстановлении берется из сценария
+        return {'scenario': self.scenario, 'step_number': self.step.number, 'context': self.context}
+
+    def __setstate__(self, state):
+        self.scenario = state['scenario']
+        self.step = get_scenario(self.scenario).steps[state['step_number']]
+        self.context = state['context']
+
+
+class MemorySessionStore:
+    """
+    Хранилище состояний в памяти процесса с вытеснением давно неиспользуемых (LRU)
+    при превышении max_sessions и удалением сессий, простаивающих дольше ttl секунд.
+    Поддерживает операции словаря, которые использует бот: in, [], []=, pop.
+    """
+
+    def __init__(self, max_sessions=100000, ttl=7200):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._states = OrderedDict()  # user_id -> (state, время последнего обращения), от давних к свежим
+        self._lock = threading.RLock()
+
+        # статистика
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0  # вытеснены при превышении max_sessions
+        self.expirations = 0  # удалены по ttl
+
+    def _purge_expired(self, now):
+        # порядок словаря - по времени обращения, поэтому устаревшие сессии всегда в начале
+        while self._states:
+            user_id, (state, accessed_at) = next(iter(self._states.items()))
+            if now - accessed_at <= self.ttl:
+                break
+            self._states.popitem(last=False)
+            self.expirations += 1
+            self._on_discard(user_id, state, expired=True)
+
+    def _on_discard(self, user_id, state, expired):
+        """ Вызывается при удалении сессии по ttl или вытеснении """
+
+    def _load(self, user_id):
+        """ Загрузить сессию, отсутствующую в памяти (для хранилищ с постоянным хранением) """
+        return None
+
+    def get(self, user_id, default=None):
+        """ Состояние пользователя или default. Учитывается в статистике попаданий """
+
+        with self._lock:
+            now = time.monotonic()
+            self._purge_expired(now)
+
+            item = self._states.get(user_id)
+            state = item[0] if item is not None else self._load(user_id)
+            if state is None:
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            self._put(user_id, state, now)
+            return state
+
+    def _put(self, user_id, state, now):
+        self._states[user_id] = (state, now)
+        self._states.move_to_end(user_id)
+        while len(self._states) > self.max_sessions:
+            evicted_id, (evicted_state, accessed_at) = self._states.popitem(last=False)
+            self.evictions += 1
+            self._on_discard(evicted_id, evicted_state, expired=False)
+
+    def save(self, user_id, state):
+        """ Зафиксировать изменения состояния пользователя (и продлить его сессию) """
+
+        with self._lock:
+            now = time.monotonic()
+            self._purge_expired(now)
+            self._put(user_id, state, now)
+
+    def pop(self, user_id, *default):
+        with self._lock:
+            item = self._states.pop(user_id, None)
+            if item is not None:
+                return item[0]
+            if default:
+                return default[0]
+            raise KeyError(user_id)
+
+    def __contains__(self, user_id):
+        return self.get(user_id) is not None
+
+    def __getitem__(self, user_id):
+        with self._lock:
+            item = self._states.get(user_id)
+            if item is None:
+                raise KeyError(user_id)
+            return item[0]
+
+    def __setitem__(self, user_id, state):
+        self.save(user_id, state)
+
+    def __len__(self):
+        return len(self._states)
+
+    def stats(self):
+        return {
+            'sessions': len(self),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+
+class SqliteSessionStore(MemorySessionStore):
+    """
+    Хранилище состояний в SQLite: переживает перезапуск бота и доступно нескольким процессам.
+    В памяти держится LRU-кэш активных сессий, каждое изменение сразу записывается в БД.
+    Кэш рассчитан на то, что собеседник обрабатывается одним процессом (см. supervisor.py).
+    """
+
+    purge_interval = 60  # как часто удалять устаревшие сессии из БД, сек.
+
+    def __init__(self, db_path, max_sessions=100000, ttl=7200):
+        super().__init__(max_sessions=max_sessions, ttl=ttl)
+        self.db_path = db_path
+        self._local = threading.local()
+        self._purged_at = 0
+
+        with self._connection() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS sessions '
+                               '(user_id INTEGER PRIMARY KEY, state BLOB NOT NULL, updated_at REAL NOT NULL)')
+
+    def _connection(self):
+        # соединение sqlite3 нельзя использовать из разных потоков - у каждого потока свое
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=10)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+        return connection
+
+    def _on_discard(self, user_id, state, expired):
+        # вытесненная из кэша сессия остается в БД, устаревшая - удаляется
+        if expired:
+            with self._connection() as connection:
+                connection.execute('DELETE FROM sessions WHERE user_id = ?', (user_id,))
+
+    def _load(self, user_id):
+        row = self._connection().execute('SELECT state, updated_at FROM sessions WHERE user_id = ?',
+                                         (user_id,)).fetchone()
+        if row is None:
+            return None
+
+        state, updated_at = row
+        if time.time() - updated_at > self.ttl:
+            self._on_discard(user_id, None, expired=True)
+            self.expirations += 1
+            return None
+
+        return pickle.loads(state)
+
+    def _purge_db(self):
+        now = time.time()
+        if now - self._purged_at < self.purge_interval:
+            return
+
+        self._purged_at = now
+        with self._connection() as connection:
+            cursor = connection.execute('DELETE FROM sessions WHERE updated_at < ?', (now - self.ttl,))
+            self.expirations += cursor.rowcount
+
+    def save(self, user_id, state):
+        with self._lock:
+            super().save(user_id, state)
+            with self._connection() as connection:
+                connection.execute('INSERT OR REPLACE INTO sessions (user_id, state, updated_at) VALUES (?, ?, ?)',
+                                   (user_id, pickle.dumps(state), time.time()))
+            self._purge_db()
+
+    def pop(self, user_id, *default):
+        with self._lock:
+            state = super().pop(user_id, None)
+            with self._connection() as connection:
+                connection.execute('DELETE FROM sessions WHERE user_id = ?', (user_id,))
+            if state is not None:
+                return state
+            if default:
+                return default[0]
+            raise KeyError(user_id)
+
+    def __len__(self):
+        return self._connection().execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
+
+
+def create_session_store(kind='memory', db_name='sessions.sqlite', max_sessions=100000, ttl=7200):
+    """
+    Хранилище состояний по настройкам.
+    :param kind: str - 'memory' (в памяти процесса) или 'sqlite' (в файле БД)
+    :param db_name: str - имя файла БД рядом с модулем (для 'sqlite')
+    :param max_sessions: int - макс. кол-во сессий в памяти
+    :param ttl: int - время простоя сессии до удаления, сек.
+    """
+
+    if kind == 'memory':
+        return MemorySessionStore(max_sessions=max_sessions, ttl=ttl)
+
+    if kind == 'sqlite':
+        db_path = os.path.normpath(os.path.join(os.path.dirname(__file__), db_name))
+        return SqliteSessionStore(db_path, max_sessions=max_sessions, ttl=ttl)
+
+    raise ValueError(f'Неизвестный тип хранилища сессий: {kind}')
@@ -32,9 +32,9 @@ SCENARIOS = {
                 'step_number': 3,
             },
             4: {
-                'text': 'Вы ввели {when_}.\nВот доступные рейсы по Вашим параметрам (показаны 5 рейсов):\n\n' \
+                'text': 'Вы ввели {when_}.\nВот ближайшие рейсы по Вашим параметрам:\n\n' \
                         '{flights_as_str}\n' \
-                        'Введите, пожалуйста, ID нужного рейса:',
+                        'Введите, пожалуйста, ID нужного рейса или "ещё", чтобы посмотреть следующие рейсы:',
                 'failure_text': 'Введен некорректный ID рейса. Попробуйте снова:',
                 'handler': 'handle_flight_id',
                 'step_number': 4,
@@ -103,3 +103,64 @@ INTENTS = [
 DEFAULT_ANSWER = f'Давайте уточним, о чем речь.\nДля заказа авиабилета напишите {TICKET_SCENARIO["main_token"]}.\n' \
                  f'Для справки напишите {TICKET_SCENARIO["help_token"]}.\nДля выхода из процесса заказа на любом этапе ' \
                  f'напишите {TICKET_SCENARIO["quit_token"]}.'
+
+# пакетная отправка ответов через execute (при конкурентной обработке событий)
+SEND_BATCH_WINDOW = 0.05  # окно накопления сообщений, сек.
+SEND_BATCH_SIZE = 25  # макс. кол-во сообщений в одном execute (ограничение VK - 25)
+
+# планировщик отправки: квота запросов группы к VK API, сначала ответы пользователям, затем рассылки
+SEND_RATE = 20  # запросов в сек. (messages.send или execute), None - без ограничения
+SEND_BURST = 5  # сколько запросов можно отправить подряд после простоя
+SEND_QUEUE_SIZE = 1000  # предел сообщений в очереди каждого приоритета, сверх него сообщение не принимается
+SEND_MAX_RETRIES = 5  # повторы пакета после ответа VK "слишком много запросов"
+
+# хранилище состояний пользователей в сценариях
+SESSION_STORE = 'memory'  # 'memory' - в памяти процесса, 'sqlite' - в файле БД (переживает перезапуск)
+SESSION_DB = 'sessions.sqlite'  # файл БД для хранилища 'sqlite'
+SESSION_MAX = 100000  # макс. кол-во сессий в памяти, давно неактивные вытесняются
+SESSION_TTL = 2 * 60 * 60  # сессия удаляется после указанного времени простоя, сек.
+
+# списки городов вылета и прибытия обновляются в фоне не реже указанного периода, сек.
+LOCATION_CACHE_TTL = 5 * 60
+
+# обслуживание БД рейсов: дополнение расписания и перенос вылетевших рейсов в архив, период в сек. (None - выключено)
+MAINTENANCE_INTERVAL = 60 * 60
+
+# источник ответов на запросы рейсов: 'sql' - запросы к БД, 'columnar' - снимок рейсов в памяти по столбцам
+TICKETS_BACKEND = 'sql'
+
+# порт локального HTTP сервера метрик в формате Prometheus (GET /metrics), None - не запускать.
+# Воркеры супервизора - на портах METRICS_PORT + номер воркера. Не 9100: это порт node_exporter
+METRICS_PORT = None  # например, 9464
+
+# журнал обработанных событий long poll: после перезапуска чтение продолжается с последнего ts без повторов
+CHECKPOINT_PATH = 'longpoll.checkpoint'  # относительный путь - от каталога бота, None - не вести
+CHECKPOINT_MAX_EVENTS = 10000  # сколько id последних событий помнить для отсева повторов
+
+# адрес методов VK API, None - api.vk.com. Для нагрузочных тестов - локальный стенд benchmarks/fake_vk.py,
+# например 'http://127.0.0.1:8081/method/'
+VK_API_URL = None
+
+# запись заказов в БД в фоне: пачка пишется одной транзакцией
+ORDER_BATCH_SIZE = 500  # макс. кол-во заказов в пачке
+ORDER_FLUSH_INTERVAL = 0.05  # сколько ждать следующих заказов перед записью пачки, сек.
+
+# лог бота: запись в файл и консоль в фоновом потоке, чтобы ввод-вывод не задерживал ответы
+LOG_FILE = 'bot.log'
+LOG_ASYNC = True  # False - запись в потоке, который вызвал логгер
+LOG_JSON = True  # в файле строки JSON (поля time, level, logger, thread, message, ...), False - текст
+LOG_MAX_BYTES = 10 * 1024 * 1024  # размер файла лога для ротации (0 - без ротации)
+LOG_BACKUP_COUNT = 5  # сколько прежних файлов лога хранить (bot.log.1, bot.log.2, ...)
+
+# рейсов на странице списка на шаге выбора рейса и команды показа следующей страницы
+FLIGHTS_PAGE_SIZE = 5
+MORE_FLIGHTS_TOKENS = ('ещё', 'еще')
+
+# разговорные названия городов для разбора сообщений вида "из питера в казань завтра":
+# начало слова -> город из расписания рейсов
+CITY_ALIASES = {
+    'питер': 'Санкт-Петербург',
+    'спб': 'Санкт-Петербург',
+    'мск': 'Москва',
+    'екб': 'Екатеринбург',
+}
@@ -0,0 +1,274 @@
+''' Многопроцессный запуск бота с распределением событий по воркерам по peer_id '''
+import logging
+import multiprocessing
+import signal
+import threading
+import time
+import zlib
+
+from vk_api.bot_longpoll import VkBotLongPoll
+
+from checkpoint import Checkpoint, read_long_poll
+from vk_client import create_vk_session
+
+_STOP = None  # маркер остановки воркера
+
+
+def get_shard(peer_id, num_workers):
+    """ Номер воркера для собеседника. crc32, в отличие от встроенного hash(), стабилен между запусками """
+
+    if peer_id is None:
+        return 0
+    return zlib.crc32(str(peer_id).encode()) % num_workers
+
+
+def get_event_peer_id(raw_event):
+    message = (raw_event.get('object') or {}).get('message') or {}
+    return message.get('peer_id')
+
+
+def parse_event(raw_event):
+    """ Событие VkBotEvent из словаря, полученного от long poll сервера """
+
+    event_class = VkBotLongPoll.CLASS_BY_EVENT_TYPE.get(raw_event['type'], VkBotLongPoll.DEFAULT_EVENT_CLASS)
+    return event_class(raw_event)
+
+
+def exit_on_sigterm():
+    """
+    SIGTERM (обычная остановка сервиса) завершает процесс через SystemExit, как и Ctrl+C: выполняются блоки finally,
+    в которых дописываются в БД принятые заказы и останавливаются воркеры. Без обработчика процесс завершается сразу.
+    """
+
+    def handler(signum, frame):
+        raise SystemExit(128 + signum)
+
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, handler)
+
+
+def report_throughput(bot, worker_index, interval, stop):
+    """ Периодический отчет воркера о пропускной способности """
+
+    last_count, last_time = 0, time.monotonic()
+    while not stop.wait(interval):
+        count, now = bot.events_processed, time.monotonic()
+        rate = (count - last_count) / (now - last_time)
+        bot.logger.info('Воркер %s: всего обработано событий %s, %.1f событий/сек.', worker_index, count, rate)
+        last_count, last_time = count, now
+
+
+class WorkerCheckpoint:
+    """
+    Журнал событий воркера: ts long poll и отсев повторов ведет супервизор (Checkpoint),
+    воркер только сообщает ему id обработанных событий через очередь.
+    """
+
+    def __init__(self, done_queue):
+        self.done_queue = done_queue
+
+    def is_processed(self, event_id):
+        return False  # повторы отсеивает супервизор до передачи события воркеру
+
+    def mark_processed(self, event_id):
+        self.done_queue.put(event_id)
+
+    def close(self):
+        pass
+
+
+def worker_main(worker_index, events_queue, token, group_id, serve_options=None, report_interval=60,
+                metrics_port=None, ready_event=None, done_queue=None):
+    """
+    Точка входа процесса-воркера: свой Bot и Dispatcher, события из очереди супервизора.
+    :param ready_event: multiprocessing.Event - устанавливается, когда бот воркера загрузил все для работы
+    :param done_queue: multiprocessing.Queue - куда сообщать id обработанных событий (журнал супервизора)
+    """
+
+    from bot import Bot  # bot.py сам импортирует этот модуль
+
+    exit_on_sigterm()
+    bot = None
+    if metrics_port:
+        from metrics import start_metrics_server
+        start_metrics_server(metrics_port, is_ready=lambda: bot is not None and bot.is_ready)
+
+    bot = Bot(token, group_id, poll=False)
+    if done_queue is not None:
+        bot.checkpoint = WorkerCheckpoint(done_queue)
+    bot.start_warm_up(on_ready=ready_event.set if ready_event is not None else None)
+    stop = threading.Event()
+    reporter = threading.Thread(target=report_throughput, args=(bot, worker_index, report_interval, stop),
+                                name='bot-throughput', daemon=True)
+    reporter.start()
+
+    events = (parse_event(raw_event) for raw_event in iter(events_queue.get, _STOP))
+    try:
+        bot.serve(events, **(serve_options or {}))
+    finally:
+        stop.set()
+        bot.logger.info('Воркер %s остановлен, всего обработано событий: %s', worker_index, bot.events_processed)
+
+
+class Supervisor:
+    """
+    Один процесс читает long poll и передает каждое событие воркеру, выбранному по хешу peer_id,
+    поэтому переписка с пользователем (и его состояние в сценарии) всегда обрабатывается одним воркером.
+    """
+
+    def __init__(self, token, group_id, num_workers, serve_options=None, report_interval=60, queue_size=10000,
+                 maintenance_interval=None, metrics_port=None, api_url=None, checkpoint_path=None,
+                 checkpoint_max_events=10000, watch_interval=1.0):
+        if num_workers < 1:
+            raise ValueError(f'Кол-во воркеров должно быть не меньше 1, передано: {num_workers}')
+
+        self.token = token
+        self.group_id = group_id
+        self.num_workers = num_workers
+        self.serve_options = dict(serve_options or {})
+        if self.serve_options.get('send_rate'):
+            # квота запросов - на всю группу, каждый воркер получает свою долю
+            self.serve_options['send_rate'] = self.serve_options['send_rate'] / num_workers
+        self.report_interval = report_interval
+        self.maintenance_interval = maintenance_interval  # обслуживание БД рейсов выполняет только супервизор
+        self.metrics_port = metrics_port  # метрики каждого воркера - на своем порту: metrics_port + номер воркера
+        self.api_url = api_url  # адрес методов VK API для чтения long poll (None - api.vk.com)
+        # журнал ts long poll и обработанных событий ведет супервизор, воркеры сообщают об обработке через done_queue
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_max_events = checkpoint_max_events
+        self.done_queue = multiprocessing.Queue() if checkpoint_path else None
+        self.logger = logging.getLogger('bot_logger')
+
+        # ограниченные очереди: если воркер не успевает, чтение long poll притормаживает
+        self.queues = [multiprocessing.Queue(queue_size) for _ in range(num_workers)]
+        self.processes = [None] * num_workers
+        self.ready_events = [None] * num_workers
+        # упавший воркер перезапускается сразу, а не при следующем событии его собеседников
+        self.watch_interval = watch_interval
+        self._workers_lock = threading.Lock()
+
+    def _start_worker(self, index):
+        self.ready_events[index] = multiprocessing.Event()
+        process = multiprocessing.Process(
+            target=worker_main,
+            name=f'bot-worker-{index}',
+            args=(index, self.queues[index], self.token, self.group_id, self.serve_options, self.report_interval,
+                  self.metrics_port + index if self.metrics_port else None, self.ready_events[index], self.done_queue),
+            daemon=True
+        )
+        process.start()
+        self.processes[index] = process
+
+    def start(self):
+        for index in range(self.num_workers):
+            self._start_worker(index)
+
+    def is_ready(self):
+        """ Все воркеры запущены и загрузили все необходимое для ответа на сообщения """
+
+        return all(process is not None and process.is_alive() and ready.is_set()
+                   for process, ready in zip(self.processes, self.ready_events))
+
+    def wait_ready(self, timeout=None):
+        """ Дождаться готовности воркеров. Возвращает True, если все готовы """
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for ready in self.ready_events:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if ready is None or not ready.wait(remaining):
+                return False
+        return self.is_ready()
+
+    def _restart_if_dead(self, index):
+        with self._workers_lock:
+            if not self.processes[index].is_alive():
+                # очередь воркера сохраняется, поэтому новый процесс продолжит с необработанных событий
+                self.logger.error('Воркер %s завершился с кодом %s, перезапуск', index, self.processes[index].exitcode)
+                self._start_worker(index)
+
+    def _watch_workers(self, stop):
+        """ Проверять воркеры раз в watch_interval секунд и перезапускать завершившиеся """
+
+        while not stop.wait(self.watch_interval):
+            for index in range(self.num_workers):
+                try:
+                    self._restart_if_dead(index)
+                except Exception as exc:
+                    self.logger.exception('Не удалось перезапустить воркер %s: %s', index,
+                                          (exc.__class__.__name__, exc.args))
+
+    def dispatch(self, raw_event):
+        """ Передать событие воркеру его собеседника. Возвращает номер воркера """
+
+        index = get_shard(get_event_peer_id(raw_event), self.num_workers)
+        self._restart_if_dead(index)
+        self.queues[index].put(raw_event)
+        return index
+
+    def stop(self, timeout=None):
+        """ Остановить воркеры после обработки уже переданных им событий """
+
+        for queue in self.queues:
+            queue.put(_STOP)
+        for process in self.processes:
+            if process is not None:
+                process.join(timeout)
+
+    def _start_maintenance(self):
+        try:
+            from tickets import Dispatcher  # sqlalchemy и БД рейсов - не на пути к первому событию
+            Dispatcher().start_maintenance(self.maintenance_interval)
+        except Exception as exc:
+            self.logger.exception('Не удалось запустить обслуживание БД рейсов: %s', (exc.__class__.__name__, exc.args))
+
+    def _collect_processed(self, checkpoint):
+        """ Отмечать в журнале события, обработанные воркерами """
+
+        for event_id in iter(self.done_queue.get, _STOP):
+            checkpoint.mark_processed(event_id)
+
+    def read_events(self, poller, checkpoint):
+        """ События long poll; с журналом - с сохраненного ts и без уже обработанных событий """
+
+        if checkpoint is None:
+            yield from poller.listen()
+            return
+        for event in read_long_poll(poller, checkpoint):
+            event_id = event.raw.get('event_id')
+            if event_id is not None and checkpoint.is_processed(event_id):
+                self.logger.debug('Событие %s уже обработано, пропускаем', event_id)
+                continue
+            yield event
+
+    def run(self):
+        from scenarios import get_scenarios
+        get_scenarios()  # с ошибкой в описании сценариев воркеры не запускаются
+
+        checkpoint = collector = None
+        if self.checkpoint_path:
+            checkpoint = Checkpoint(self.checkpoint_path, self.checkpoint_max_events)
+            collector = threading.Thread(target=self._collect_processed, args=(checkpoint,),
+                                         name='checkpoint-collector', daemon=True)
+            collector.start()
+
+        # воркеры запускаются до подключения к long poll, чтобы не наследовать его соединение
+        self.start()
+        stop_watching = threading.Event()
+        threading.Thread(target=self._watch_workers, args=(stop_watching,), name='workers-watchdog',
+                         daemon=True).start()
+        try:
+            vk = create_vk_session(self.token, self.api_url)
+            poller = VkBotLongPoll(vk, self.group_id)
+            if self.maintenance_interval:
+                threading.Thread(target=self._start_maintenance, name='tickets-maintenance-start',
+                                 daemon=True).start()
+            for event in self.read_events(poller, checkpoint):
+                self.dispatch(event.raw)
+        finally:
+            stop_watching.set()  # воркеры, остановленные по _STOP, перезапускать не нужно
+            with self._workers_lock:
+                self.stop()
+            if checkpoint is not None:
+                self.done_queue.put(_STOP)  # воркеры остановлены - сообщений об обработке больше не будет
+                collector.join()
+                checkpoint.close()
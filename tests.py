@@ -1,9 +1,40 @@
+import asyncio
 import datetime
+import json
+import logging
+import os.path
+import queue
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import urllib.error
+import urllib.request
 from copy import deepcopy
 from unittest.mock import Mock, patch
+from sqlalchemy import event
 from vk_api.bot_longpoll import VkBotMessageEvent
+from vk_api.exceptions import ApiError
+import bot
 from bot import Bot
+from benchmarks.fake_vk import FakeVkServer
+from checkpoint import Checkpoint, get_random_id
+from engine import AsyncEngine
+from intents import IntentMatcher
+from locations import CityIndex, LocationCache
+from logs import setup_logging, stop_logging
+from metrics import Counter, Histogram, Registry, start_metrics_server
+from orders import OrderWriter, get_order
+from scheduler import PRIORITY_BROADCAST, OutboundScheduler, QueueFullError, TokenBucket
+from sender import BatchSender, SendError
+from scenarios import ScenarioError, compile_scenario, get_scenario
+from sessions import MemorySessionStore, SqliteSessionStore, UserState
+from supervisor import Supervisor, WorkerCheckpoint, get_shard, worker_main
+from tickets import Dispatcher, Ticket
 import settings
 import handlers
 
@@ -165,6 +196,1059 @@ class BotTester(unittest.TestCase):
         with self.assertRaises(BaseException):
             bot.send_mock.assert_called_with('some message')
 
+    def test_multi_slot_message_skips_steps(self):
+        when_ = (handlers.datetime.datetime.now() + datetime.timedelta(days=30)).replace(hour=0, minute=0, second=0,
+                                                                                         microsecond=0)
+        tickets_api_mock = Mock(get_tickets=Mock(return_value=self.FAKE_FLIGHTS),
+                                is_route_available=Mock(return_value=True))
+        with patch('bot.VkBotLongPoll'):
+            bot = Bot('', '')
+        bot.api = Mock()
+        bot.tickets_api = tickets_api_mock
+        bot.departures = self.DEPARTURES + ['Санкт-Петербург']
+        bot.arrivals = self.ARRIVALS
+
+        slots = handlers.extract_slots(bot, 'из Питера в Сочи завтра два билета')
+        tomorrow = handlers.datetime.datetime.now().date() + datetime.timedelta(days=1)
+        self.assertEqual(slots, {'handle_departure': 'санкт-петербург', 'handle_arrival': 'сочи',
+                                 'handle_date': tomorrow.strftime('%d-%m-%Y'), 'handle_tickets_qty': '2'})
+
+        events = []
+        for text in (f'Москва Сочи {when_.strftime("%d-%m-%Y")} 2 билета', str(self.CONTEXT['flight_id'])):
+            event = deepcopy(self.RAW_EVENT)
+            event['object']['message']['text'] = text
+            events.append(VkBotMessageEvent(event))
+        bot.run(events)
+
+        context = dict(self.CONTEXT, from_='Москва', to_='Сочи', when_=when_, tickets_qty=2)
+        sent = [kwargs['message'] for args, kwargs in bot.api.messages.send.call_args_list]
+        self.assertEqual(sent, [self.STEPS[4]['text'].format(**context), self.STEPS[6]['text'].format(**context)])
+        tickets_api_mock.get_tickets.assert_called_once_with(from_='Москва', to_='Сочи', when_=when_, limit=5)
+
+    def test_strict_slots_outside_scenario(self):
+        index = CityIndex(['Бангкок', 'Москва', 'Казань', 'Санкт-Петербург'])
+        bot = Mock(departures_index=index, arrivals_index=index)
+        for text in ('позвоните в банк', 'мост', 'москва', 'добрый день'):
+            self.assertEqual(handlers.extract_slots(bot, text, strict=True), {}, text)
+        self.assertEqual(handlers.extract_slots(bot, 'мост'), {'handle_departure': 'москва'})
+
+        self.assertEqual(handlers.extract_slots(bot, 'в казани', strict=True), {'handle_arrival': 'казань'})
+        self.assertEqual(handlers.extract_slots(bot, 'питер москва', strict=True),
+                         {'handle_departure': 'санкт-петербург', 'handle_arrival': 'москва'})
+
+        # без признака заказа индексы городов не нужны
+        bot = Mock(spec=[])
+        self.assertEqual(handlers.extract_slots(bot, 'перезвоните мне', strict=True), {})
+
+        # слова интента не похожи на города при точном поиске
+        index = CityIndex(['Закаменск', 'Хочтаун', 'Москва'])
+        bot = Mock(departures_index=index, arrivals_index=index)
+        self.assertEqual(handlers.extract_slots(bot, 'хочу заказ билета', strict=True), {})
+        self.assertEqual(handlers.extract_slots(bot, 'хочу заказ билета из москвы', strict=True),
+                         {'handle_departure': 'москва'})
+
+    def test_more_flights(self):
+        next_flight = dict(self.FAKE_FLIGHTS[777], id=888, price=5000.0)
+        tickets_api_mock = Mock(get_tickets=Mock(side_effect=[self.FAKE_FLIGHTS, {888: next_flight}, {}]),
+                                is_route_available=Mock(return_value=True))
+        with patch('bot.VkBotLongPoll'):
+            bot = Bot('', '')
+        bot.api = Mock()
+        bot.tickets_api = tickets_api_mock
+        bot.departures = self.DEPARTURES
+        bot.arrivals = self.ARRIVALS
+
+        when_ = (handlers.datetime.datetime.now() + datetime.timedelta(days=30)).replace(hour=0, minute=0, second=0,
+                                                                                         microsecond=0)
+        events = []
+        for text in (f'Москва Екатеринбург {when_.strftime("%d-%m-%Y")}', 'ещё', 'еще', '888'):
+            event = deepcopy(self.RAW_EVENT)
+            event['object']['message']['text'] = text
+            events.append(VkBotMessageEvent(event))
+        bot.run(events)
+
+        sent = [kwargs['message'] for args, kwargs in bot.api.messages.send.call_args_list]
+        self.assertIn(handlers.get_flight_as_str(next_flight), sent[1])
+        self.assertNotIn(handlers.get_flight_as_str(self.FAKE_FLIGHTS[777]), sent[1])
+        self.assertTrue(sent[2].startswith('Других рейсов по Вашим параметрам нет'))
+        self.assertEqual(sent[3], self.STEPS[5]['text'].format(flight_id=888))
+        self.assertEqual(list(self.FAKE_FLIGHTS), [555, 777])
+
+        after = tickets_api_mock.get_tickets.call_args_list[1][1]['after']
+        self.assertEqual(after, (self.FAKE_FLIGHTS[777]['when_'], 4500.0, 777))
+
+    def test_lazy_startup_and_warm_up(self):
+        with patch('bot.VkBotLongPoll'):
+            bot = Bot('', '')
+        self.assertIsNone(bot._tickets_api)
+        self.assertFalse(bot.is_ready)
+        self.assertEqual(list(bot.startup_timings), ['scenarios', 'long_poll', 'sessions'])
+
+        loaded = []
+
+        def get_departure_locations():
+            loaded.append('departures')
+            time.sleep(0.05)
+            return self.DEPARTURES
+
+        bot.tickets_api = Mock(get_departure_locations=get_departure_locations,
+                               get_arrival_locations=Mock(return_value=self.ARRIVALS))
+        threads = [threading.Thread(target=getattr, args=(bot, 'departures')) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        bot.warm_up()
+        for thread in threads:
+            thread.join()
+
+        self.assertTrue(bot.is_ready)
+        self.assertEqual(loaded, ['departures'])  # загружено один раз при одновременных обращениях
+        self.assertEqual(bot.departures, self.DEPARTURES)
+        self.assertEqual(bot.arrivals, self.ARRIVALS)
+        self.assertTrue({'scenarios', 'departures', 'arrivals', 'warm_up'} <= set(bot.startup_timings))
+
+    def test_broken_scenario_stops_startup(self):
+        with patch('bot.VkBotLongPoll') as long_poll, patch('bot.get_scenarios', side_effect=ScenarioError('шаг 1')):
+            with self.assertRaises(ScenarioError):
+                Bot('', '')
+        long_poll.assert_not_called()
+
+
+class AsyncEngineTester(unittest.TestCase):
+
+    def _make_event(self, peer_id, text):
+        event = deepcopy(BotTester.RAW_EVENT)
+        event['object']['message']['peer_id'] = peer_id
+        event['object']['message']['text'] = text
+        return VkBotMessageEvent(event)
+
+    def test_run_keeps_peer_order(self):
+        help_token = settings.SCENARIOS['ticket']['help_token']
+        inputs = ['привет', help_token, 'что-то непонятное', help_token]
+        expected = [settings.DEFAULT_ANSWER, Bot.get_help_message(), settings.DEFAULT_ANSWER, Bot.get_help_message()]
+        peers = list(range(1, 21))
+        events = [self._make_event(peer_id, text) for text in inputs for peer_id in peers]
+
+        send_mock = Mock()
+        with patch('bot.VkBotLongPoll'):
+            bot = Bot('', '')
+        bot.api = Mock()
+        bot.api.messages.send = send_mock
+
+        engine = AsyncEngine(bot, max_workers=8)
+        asyncio.run(engine.run(events))
+
+        messages_by_peer = {}
+        for call in send_mock.call_args_list:
+            args, kwargs = call
+            messages_by_peer.setdefault(kwargs['peer_id'], []).append(kwargs['message'])
+
+        self.assertEqual(send_mock.call_count, len(events))
+        for peer_id in peers:
+            self.assertEqual(messages_by_peer[peer_id], expected)
+        self.assertEqual(engine.tasks, {})
+
+    def test_handler_error_keeps_peer_queue(self):
+        events = [self._make_event(1, text) for text in ('сбой', 'привет', 'пока')]
+        processed = []
+
+        def process_event(event):
+            if event.obj.message['text'] == 'сбой':
+                raise RuntimeError('сбой обработчика')
+            processed.append(event.obj.message['text'])
+
+        engine = AsyncEngine(Mock(process_event=process_event))
+        with self.assertLogs('bot_logger', level='ERROR') as logs:
+            asyncio.run(engine.run(events))
+
+        self.assertEqual(processed, ['привет', 'пока'])
+        self.assertIn('RuntimeError', logs.output[0])
+        self.assertEqual(engine.tasks, {})
+
+
+class BatchSenderTester(unittest.TestCase):
+
+    def test_send_batches_through_execute(self):
+        api = Mock()
+        api.execute = Mock(return_value=[101, False, 103])
+        sender = BatchSender(api, batch_window=0.5, batch_size=3)
+
+        futures = [sender.send(peer_id=peer_id, random_id=peer_id, message=f'текст {peer_id}') for peer_id in (1, 2, 3)]
+        sender.close()
+
+        api.execute.assert_called_once()
+        api.messages.send.assert_not_called()
+        code = api.execute.call_args[1]['code']
+        self.assertEqual(code.count('API.messages.send('), 3)
+        self.assertIn('"message": "текст 2"', code)
+
+        self.assertEqual(futures[0].result(), 101)
+        with self.assertRaises(SendError):
+            futures[1].result()
+        self.assertEqual(futures[2].result(), 103)
+        self.assertEqual((sender.messages_sent, sender.messages_failed), (2, 1))
+
+    def test_execute_failure_fails_whole_batch(self):
+        api = Mock()
+        api.execute = Mock(side_effect=ConnectionError('нет связи'))
+        sender = BatchSender(api, batch_window=0.5, batch_size=2)
+
+        futures = [sender.send(peer_id=peer_id, random_id=peer_id, message='текст') for peer_id in (1, 2)]
+        sender.close()
+
+        for future in futures:
+            with self.assertRaises(ConnectionError):
+                future.result()
+
+
+class OutboundSchedulerTester(unittest.TestCase):
+
+    def test_token_bucket_adapts_rate(self):
+        now = [0.0]
+
+        def sleep(delay):
+            now[0] += delay
+
+        bucket = TokenBucket(rate=10, burst=2, clock=lambda: now[0], sleep=sleep)
+        self.assertEqual([bucket.acquire() for _ in range(3)], [0.0, 0.0, 0.1])
+        self.assertEqual(bucket.slow_down(), 5)
+        self.assertAlmostEqual(bucket.acquire(), 0.2)  # вдвое реже
+        self.assertEqual(bucket.speed_up(), 5.5)
+
+    def test_replies_go_before_broadcast(self):
+        sent = []
+        api = Mock()
+        api.messages.send = Mock(side_effect=lambda **params: sent.append(params['message']) or len(sent))
+        scheduler = OutboundScheduler(api, rate=10, burst=1, batch_window=0, batch_size=1)
+
+        scheduler.send(PRIORITY_BROADCAST, peer_id=1, message='рассылка 1').result()
+        futures = [scheduler.send(PRIORITY_BROADCAST, peer_id=peer_id, message=f'рассылка {peer_id}')
+                   for peer_id in (2, 3)]
+        futures.append(scheduler.send(peer_id=4, message='ответ'))  # ждет токен вместе с рассылками
+        scheduler.close()
+
+        self.assertEqual(sent, ['рассылка 1', 'ответ', 'рассылка 2', 'рассылка 3'])
+        self.assertTrue(all(future.done() for future in futures))
+
+    def test_rate_limited_batch_is_retried(self):
+        too_many = ApiError(None, 'execute', {}, False, {'error_code': 6, 'error_msg': 'Too many requests per second'})
+        api = Mock()
+        api.execute = Mock(side_effect=[too_many, [11, 12]])
+        scheduler = OutboundScheduler(api, rate=100, batch_window=0.2, batch_size=2, max_queue=2, retry_delay=0.01)
+
+        futures = [scheduler.send(peer_id=peer_id, message='текст') for peer_id in (1, 2, 3)]
+        scheduler.close()
+
+        self.assertEqual([future.result() for future in futures[:2]], [11, 12])
+        with self.assertRaises(QueueFullError):
+            futures[2].result()
+        self.assertEqual((scheduler.rate_limited, scheduler.messages_dropped), (1, 1))
+        self.assertEqual(scheduler.bucket.rate, 50 + 5)  # снижена вдвое и частично восстановлена
+
+
+class IntentMatcherTester(unittest.TestCase):
+    INTENTS = [
+        {'name': 'первый', 'tokens': ('билет', 'заказ билета')},
+        {'name': 'второй', 'tokens': ('заказ', 'как')},
+        {'name': 'третий', 'tokens': ('лет', 'акт')},
+    ]
+
+    def _match_by_scan(self, intents, text):
+        for intent in intents:
+            if any(token in text for token in intent['tokens']):
+                return intent
+        return None
+
+    def test_match_keeps_intent_priority(self):
+        matcher = IntentMatcher(self.INTENTS, scan_threshold=0)
+        texts = ['как сделать заказ билета', 'как дела', 'контакт', 'полет', 'ничего', '', 'заказ']
+        for text in texts:
+            self.assertIs(matcher.match(text), self._match_by_scan(self.INTENTS, text), text)
+
+        for text in ('/help', 'хочу заказать', 'расскажите', 'привет'):
+            self.assertIs(IntentMatcher(settings.INTENTS, scan_threshold=0).match(text),
+                          self._match_by_scan(settings.INTENTS, text), text)
+
+
+class CityIndexTester(unittest.TestCase):
+    CITIES = ['Анталья', 'Бангкок', 'Владивосток', 'Екатеринбург', 'Казань', 'Краби', 'Краснодар', 'Москва',
+              'Санкт-Петербург', 'Токио']
+
+    def test_find(self):
+        index = CityIndex(self.CITIES)
+        for user_text, city in (('моск', 'Москва'), ('москву', 'Москва'), ('масква', 'Москва'),
+                                ('moskva', 'Москва'), ('sankt-peterburg', 'Санкт-Петербург'),
+                                ('екатеринбурк', 'Екатеринбург'), ('владивасток', 'Владивосток'), ('лондон', None)):
+            self.assertEqual(index.find(user_text), city, user_text)
+
+    def test_search_ranks_prefix_before_typos(self):
+        index = CityIndex(['Красногорск', 'Краснодар', 'Краснадар'])
+        self.assertEqual(index.search('краснодар'), [('Краснодар', 0), ('Краснадар', 1)])
+        self.assertEqual(index.search('крас', limit=2), [('Красногорск', 0), ('Краснодар', 0)])
+
+
+class LocationCacheTester(unittest.TestCase):
+
+    def test_refresh_in_background(self):
+        loads = [['Москва'], ['Москва', 'Казань']]
+        loader = Mock(side_effect=loads)
+        cache = LocationCache(loader, ttl=60)
+        self.assertEqual(cache.index.cities, ['Москва'])
+
+        with patch('locations.time.monotonic', return_value=cache._loaded_at + 61):
+            stale_index = cache.index  # просроченный список отдается сразу, обновление - в фоне
+        self.assertEqual(stale_index.cities, ['Москва'])
+
+        cache._refreshing.acquire(timeout=5)  # дождаться окончания фонового обновления
+        cache._refreshing.release()
+        self.assertEqual(cache.index.cities, ['Москва', 'Казань'])
+        self.assertEqual(cache.refresh_count, 2)
+        self.assertLess(cache.age, 60)
+
+    def test_failed_refresh_backs_off(self):
+        loader = Mock(side_effect=[['Москва'], OSError('database is locked'), ['Москва', 'Казань']])
+        cache = LocationCache(loader, ttl=60, retry_delay=5)
+        now = [cache._loaded_at + 61]
+
+        def wait_refresh():
+            cache._refreshing.acquire(timeout=5)
+            cache._refreshing.release()
+
+        with patch('locations.time.monotonic', side_effect=lambda: now[0]):
+            with self.assertLogs('bot_logger', 'ERROR'):
+                cache.index
+                wait_refresh()
+            for _ in range(10):
+                self.assertEqual(cache.index.cities, ['Москва'])  # до конца паузы новых попыток нет
+            wait_refresh()
+            self.assertEqual((loader.call_count, cache.refresh_errors), (2, 1))
+
+            now[0] += 6
+            cache.index
+            wait_refresh()
+        self.assertEqual(cache.index.cities, ['Москва', 'Казань'])
+        self.assertEqual(loader.call_count, 3)
+
+
+class DispatcherTester(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_url = f'sqlite:///{os.path.join(self.tmp_dir.name, "tickets.sqlite")}'
+        self.dispatcher = Dispatcher(self.db_url)
+        self.dispatcher._create_tickets_in_db()
+
+    def tearDown(self):
+        self.dispatcher.close()
+        self.tmp_dir.cleanup()
+
+    def _count(self, dispatcher, table='tickets'):
+        return dispatcher.engine.execute(f'SELECT COUNT(*) FROM {table}').scalar()
+
+    def test_route_index_matches_query(self):
+        sql_dispatcher = Dispatcher(self.db_url, use_route_index=False)
+        cities = sorted(set(self.dispatcher.get_departure_locations() + self.dispatcher.get_arrival_locations()))
+        when_ = datetime.datetime.now() + datetime.timedelta(days=30)
+
+        for from_ in cities:
+            for to_ in cities:
+                for date in (None, when_):
+                    self.assertEqual(self.dispatcher.is_route_available(from_, to_, date),
+                                     sql_dispatcher.is_route_available(from_, to_, date), (from_, to_, date))
+
+        self.dispatcher.add_tickets([{'from_': 'Казань', 'to_': 'Москва', 'when_': when_, 'price': 3000.0}])
+        self.assertTrue(self.dispatcher.is_route_available('Казань', 'Москва'))
+        self.assertEqual(self.dispatcher.route_index.rebuild_count, 1)
+
+    def test_tickets_cache(self):
+        from_, to_ = 'Москва', 'Екатеринбург'
+        when_ = datetime.datetime.now() + datetime.timedelta(days=10)
+        next_day = when_ + datetime.timedelta(days=1)
+
+        first = self.dispatcher.get_tickets(from_=from_, to_=to_, when_=when_, limit=5)
+        self.assertEqual(self.dispatcher.get_tickets(from_=from_, to_=to_, when_=when_, limit=5), first)
+        self.assertEqual(self.dispatcher.tickets_cache.stats()['hits'], 1)
+
+        self.assertEqual(self.dispatcher.get_tickets(from_=from_, to_=to_, when_=when_, limit=5, use_cache=False),
+                         first)
+        self.assertEqual(self.dispatcher.tickets_cache.stats()['hits'], 1)
+
+        self.dispatcher.add_tickets([{'from_': from_, 'to_': to_, 'when_': next_day, 'price': 100.0}])
+
+        result = self.dispatcher.get_tickets(from_=from_, to_=to_, when_=when_, limit=5)
+        self.assertIn(next_day, [ticket['when_'] for ticket in result.values()])
+        self.assertEqual(result, self.dispatcher.get_tickets(from_=from_, to_=to_, when_=when_, limit=5,
+                                                             use_cache=False))
+        self.assertEqual(self.dispatcher.tickets_cache.stats()['misses'], 2)
+
+    def test_create_tickets_is_idempotent(self):
+        count = self._count(self.dispatcher)
+        start_date = datetime.datetime.now()
+        expected_daily = len(Dispatcher.settings['daily_tickets']) * (Dispatcher.settings['num_days'] + 1)
+        self.assertGreater(count, expected_daily)
+
+        stats = self.dispatcher._create_tickets_in_db(start_date=start_date, chunk_size=50)
+        self.assertEqual(stats['inserted'], 0)
+        self.assertEqual(stats['rows'], count)
+        self.assertEqual(self._count(self.dispatcher), count)
+
+        stats = self.dispatcher._create_tickets_in_db(num_days=Dispatcher.settings['num_days'] + 1,
+                                                      start_date=start_date)
+        self.assertGreaterEqual(stats['inserted'], len(Dispatcher.settings['daily_tickets']))
+
+    def test_maintenance_keeps_rolling_window(self):
+        settings = {'num_days': 3, 'daily_tickets': [{'from_': 'Москва', 'to_': 'Сочи', 'when_': (10, 0),
+                                                      'price': 5000.0}]}
+        today = datetime.date.today()
+        dispatcher = Dispatcher(f'sqlite:///{os.path.join(self.tmp_dir.name, "rolling.sqlite")}')
+        dispatcher._create_tickets_in_db(start_date=today - datetime.timedelta(days=5), settings=settings)
+
+        self.assertEqual(dispatcher.extend_schedule(settings=settings, today=today), 4)  # сегодня и 3 дня вперед
+        self.assertEqual(dispatcher.extend_schedule(settings=settings, today=today), 0)
+
+        archived = dispatcher.archive_departed(batch_size=2, now=datetime.datetime.combine(today, datetime.time()))
+        self.assertEqual(archived, 4)
+        self.assertEqual([self._count(dispatcher), self._count(dispatcher, 'archived_tickets')], [4, 4])
+        dispatcher.close()
+
+    def test_extend_schedule_completes_partial_day(self):
+        settings = {'num_days': 2, 'daily_tickets': [
+            {'from_': 'Москва', 'to_': 'Сочи', 'when_': (10, 0), 'price': 5000.0},
+            {'from_': 'Москва', 'to_': 'Сочи', 'when_': (18, 0), 'price': 6000.0},
+        ]}
+        today = datetime.date.today()
+        dispatcher = Dispatcher(f'sqlite:///{os.path.join(self.tmp_dir.name, "partial.sqlite")}')
+        self.assertEqual(dispatcher.extend_schedule(settings=settings, today=today), 6)
+
+        # загрузка последнего дня прервалась после первого рейса
+        last_day = datetime.datetime.combine(today + datetime.timedelta(days=2), datetime.time(18, 0))
+        dispatcher.engine.execute(Ticket.__table__.delete().where(Ticket.when_ == last_day))
+        self.assertEqual(dispatcher.extend_schedule(settings=settings, today=today), 1)
+        self.assertEqual(self._count(dispatcher), 6)
+        dispatcher.close()
+
+    def test_queries_use_indexes(self):
+        dispatcher = Dispatcher(self.db_url, use_route_index=False, tickets_cache_size=0)
+        engine = dispatcher.engine
+        statements = []
+
+        def on_execute(connection, cursor, statement, parameters, context, executemany):
+            statements.append((statement, parameters))
+
+        event.listen(engine, 'before_cursor_execute', on_execute)
+        when_ = datetime.datetime.now() + datetime.timedelta(days=3)
+        dispatcher.get_tickets(from_='Москва', to_='Екатеринбург', when_=when_, limit=5)
+        dispatcher.get_tickets(from_='Москва', when_=when_, limit=5)
+        dispatcher.get_departure_locations()
+        dispatcher.get_arrival_locations()
+        dispatcher.is_route_available(from_='Москва', to_='Екатеринбург')
+        with dispatcher._session_scope() as session:
+            self.dispatcher.route_index.rebuild(session)
+        event.remove(engine, 'before_cursor_execute', on_execute)
+
+        self.assertEqual(len(statements), 6)
+        connection = engine.raw_connection()
+        cursor = connection.cursor()
+        for statement, parameters in statements:
+            for row in cursor.execute(f'EXPLAIN QUERY PLAN {statement}', parameters).fetchall():
+                detail = row[-1]
+                # полный проход допустим только по покрывающему индексу, без чтения таблицы
+                if detail.startswith('SCAN') and 'COVERING INDEX' not in detail:
+                    self.fail(f'Полный проход таблицы ({detail}) в запросе:\n{statement}')
+        connection.close()
+
+    def test_migrate_adds_indexes(self):
+        db_path = os.path.join(self.tmp_dir.name, 'old.sqlite')
+        with sqlite3.connect(db_path) as connection:
+            connection.execute('CREATE TABLE tickets (id INTEGER PRIMARY KEY, from_ VARCHAR(100) NOT NULL, '
+                               'to_ VARCHAR(100) NOT NULL, when_ DATETIME NOT NULL, price FLOAT NOT NULL)')
+
+        Dispatcher(f'sqlite:///{db_path}').close()
+
+        with sqlite3.connect(db_path) as connection:
+            indexes = {row[1] for row in connection.execute("PRAGMA index_list('tickets')")}
+        self.assertTrue({'ix_tickets_route_when', 'ix_tickets_when'} <= indexes)
+
+    def test_columnar_backend_matches_sql(self):
+        sql_dispatcher = Dispatcher(self.db_url, use_route_index=False, tickets_cache_size=0)
+        columnar = Dispatcher(self.db_url, tickets_cache_size=0, backend='columnar')
+        cities = sorted(set(sql_dispatcher.get_departure_locations() + sql_dispatcher.get_arrival_locations()))
+        now = datetime.datetime.now()
+
+        for days in (None, 1, 20, 45):
+            when_ = now + datetime.timedelta(days=days) if days else None
+            for limit in (None, 1, 3):
+                self.assertEqual(columnar.get_departure_locations(when_, limit),
+                                 sql_dispatcher.get_departure_locations(when_, limit))
+                self.assertEqual(columnar.get_arrival_locations(when_, limit),
+                                 sql_dispatcher.get_arrival_locations(when_, limit))
+                for from_ in [None, 'Краби'] + cities:
+                    for to_ in [None] + cities:
+                        expected = sql_dispatcher.get_tickets(when_, from_, to_, limit)
+                        actual = columnar.get_tickets(when_, from_, to_, limit)
+                        self.assertEqual(list(actual.items()), list(expected.items()), (when_, from_, to_, limit))
+                        if from_ and to_:
+                            self.assertEqual(columnar.is_route_available(from_, to_, when_),
+                                             sql_dispatcher.is_route_available(from_, to_, when_))
+
+        when_ = now + datetime.timedelta(days=5)
+        columnar.add_tickets([{'from_': 'Казань', 'to_': 'Москва', 'when_': when_, 'price': 3000.0}])
+        # новый снимок строится в фоне, а запрос сразу получает предыдущий
+        self.assertFalse(columnar.is_route_available('Казань', 'Москва'))
+        deadline = time.monotonic() + 5
+        while columnar.inventory.version != columnar.inventory_version and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(columnar.is_route_available('Казань', 'Москва'))
+        self.assertIn('Москва', columnar.get_arrival_locations())
+        self.assertEqual(columnar.inventory.rebuild_count, 2)
+
+        with self.assertRaises(ValueError):
+            Dispatcher(self.db_url, backend='numpy')
+
+    def test_keyset_pagination(self):
+        from_, to_ = 'Москва', 'Екатеринбург'
+        when_ = datetime.datetime.now() + datetime.timedelta(days=3)
+        # рейсы с одинаковым временем вылета и ценой различаются только id
+        departure = (when_ + datetime.timedelta(days=1)).replace(second=0, microsecond=0)
+        self.dispatcher.add_tickets([{'from_': from_, 'to_': to_, 'when_': departure, 'price': price}
+                                     for price in (5000.0, 100.0, 100.0, 100.0)])
+        columnar = Dispatcher(self.db_url, backend='columnar')
+        sql_uncached = Dispatcher(self.db_url, tickets_cache_size=0)
+
+        for dispatcher in (self.dispatcher, columnar, sql_uncached):
+            for route in ((from_, to_), (from_, None), (None, None)):
+                expected = dispatcher.get_tickets(when_, *route)
+                keys = [(ticket['when_'], ticket['price'], ticket['id']) for ticket in expected.values()]
+                self.assertEqual(keys, sorted(keys))
+
+                pages, after = [], None
+                while True:
+                    page = dispatcher.get_tickets(when_, *route, limit=3, after=after)
+                    if not page:
+                        break
+                    pages.append(page)
+                    after = handlers.get_flights_cursor(page)
+                self.assertTrue(all(len(page) == 3 for page in pages[:-1]))
+                self.assertEqual([ticket_id for page in pages for ticket_id in page], list(expected))
+
+        columnar.close()
+        sql_uncached.close()
+
+    def test_readers_run_while_loader_writes(self):
+        self.assertEqual(self.dispatcher.engine.execute('PRAGMA journal_mode').scalar(), 'wal')
+
+        start_date = datetime.datetime.now() + datetime.timedelta(days=Dispatcher.settings['num_days'])
+        errors, loaded = [], threading.Event()
+
+        def load():
+            try:
+                for day in range(5):
+                    self.dispatcher._create_tickets_in_db(num_days=1, start_date=start_date + datetime.timedelta(days=day),
+                                                          chunk_size=10)
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                loaded.set()
+
+        def read():
+            try:
+                when_ = datetime.datetime.now() + datetime.timedelta(days=3)
+                while not loaded.is_set():
+                    self.dispatcher.get_tickets(from_='Москва', to_='Екатеринбург', when_=when_, use_cache=False)
+                    self.dispatcher.get_departure_locations()
+                    self.dispatcher.is_route_available('Москва', 'Екатеринбург', when_)
+            except Exception as exc:
+                errors.append(exc)
+
+        threads = [threading.Thread(target=load)] + [threading.Thread(target=read) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(30)
+
+        self.assertEqual(errors, [])
+        self.assertTrue(self.dispatcher.get_tickets(from_='Москва', to_='Екатеринбург',
+                                                    when_=start_date + datetime.timedelta(days=2), use_cache=False))
+
+
+class OrderWriterTester(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.dispatcher = Dispatcher(f'sqlite:///{os.path.join(self.tmp_dir.name, "tickets.sqlite")}')
+
+    def tearDown(self):
+        self.dispatcher.close()
+        self.tmp_dir.cleanup()
+
+    def _make_order(self, peer_id):
+        context = dict(BotTester.CONTEXT, tickets_qty=2, phone='89991234567', comment='у окна')
+        context['flight'] = BotTester.FAKE_FLIGHTS[context['flight_id']]
+        return get_order(peer_id, context)
+
+    def test_orders_are_group_committed(self):
+        writer = OrderWriter(self.dispatcher.add_orders, batch_size=100, flush_interval=0.2)
+
+        def submit(first_peer_id):
+            for peer_id in range(first_peer_id, first_peer_id + 150):
+                writer.submit(self._make_order(peer_id))
+
+        threads = [threading.Thread(target=submit, args=(index * 1000,)) for index in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        writer.close()  # все принятые заказы записаны до остановки
+
+        self.assertEqual(writer.orders_written, 600)
+        self.assertLessEqual(writer.batches_written, 12)
+        self.assertEqual(len(self.dispatcher.get_orders()), 600)
+
+        order = self.dispatcher.get_orders(peer_id=3001)[0]
+        self.assertEqual((order['flight_id'], order['tickets_qty'], order['total']),
+                         (BotTester.CONTEXT['flight_id'], 2, 8000.0))
+
+    def test_failed_batch_is_retried(self):
+        write_batch = Mock(side_effect=[OSError('database is locked'), 1])
+        writer = OrderWriter(write_batch, retry_delay=0.01)
+        writer.submit(self._make_order(1))
+        writer.close()
+
+        self.assertEqual(write_batch.call_count, 2)
+        self.assertEqual((writer.orders_written, writer.orders_failed), (1, 0))
+
+    def test_orders_are_written_on_sigterm(self):
+        path = os.path.join(self.tmp_dir.name, 'orders.txt')
+        script = (
+            'import os, signal, time\n'
+            'from orders import OrderWriter\n'
+            'from supervisor import exit_on_sigterm\n'
+            'exit_on_sigterm()\n'
+            f'writer = OrderWriter(lambda orders: open({path!r}, "a").write(f"{{len(orders)}}\\n"), flush_interval=5)\n'
+            'for peer_id in range(3):\n'
+            '    writer.submit({"peer_id": peer_id})\n'
+            'os.kill(os.getpid(), signal.SIGTERM)\n'
+            'time.sleep(10)\n'
+        )
+        process = subprocess.run([sys.executable, '-c', script], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                 timeout=30)
+        self.assertEqual(process.returncode, 128 + signal.SIGTERM)
+        with open(path) as file:
+            self.assertEqual(file.read(), '3\n')  # пачка записана до истечения flush_interval
+
+
+class LoggingTester(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'test.log')
+
+    def tearDown(self):
+        stop_logging('test_logger')
+        self.tmp_dir.cleanup()
+
+    def test_records_are_formatted_by_listener(self):
+        formatted_in = []
+
+        class Value:
+            def __init__(self, label):
+                self.label = label
+
+            def __str__(self):
+                formatted_in.append((self.label, threading.current_thread().name))
+                return 'значение'
+
+        logger = setup_logging('test_logger', self.path, console_level=logging.CRITICAL, max_bytes=300,
+                               backup_count=2)
+        self.assertIs(setup_logging('test_logger', self.path), logger)  # настраивается один раз
+        self.assertFalse(logger.propagate)  # корневые обработчики не получают запись в вызывающем потоке
+        logger.setLevel(logging.INFO)
+        logger.debug('не записывается: %s', Value('debug'))
+        for number in range(5):
+            logger.info('запись %s: %s', number, Value('info'), extra={'peer_id': number})
+        stop_logging('test_logger')
+
+        self.assertEqual({label for label, thread_name in formatted_in}, {'info'})
+        self.assertNotIn(threading.current_thread().name, {thread_name for label, thread_name in formatted_in})
+        self.assertTrue(os.path.exists(f'{self.path}.1'))  # файл ротирован по размеру
+
+        with open(self.path, encoding='utf8') as file:
+            record = json.loads(file.readlines()[-1])
+        self.assertEqual((record['level'], record['message'], record['peer_id']), ('INFO', 'запись 4: значение', 4))
+
+
+class CheckpointTester(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'longpoll.checkpoint')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _make_event(self, event_id, text='привет'):
+        event = deepcopy(BotTester.RAW_EVENT)
+        event['event_id'] = event_id
+        event['object']['message']['text'] = text
+        return VkBotMessageEvent(event)
+
+    def _make_bot(self):
+        with patch('bot.VkBotLongPoll'):
+            bot = Bot('', '', checkpoint_path=self.path)
+        bot.api = Mock()
+        return bot
+
+    def test_duplicates_are_skipped_after_restart(self):
+        bot = self._make_bot()
+        bot.run([self._make_event('a'), self._make_event('a'), self._make_event('b')])
+        sent = [kwargs['random_id'] for args, kwargs in bot.api.messages.send.call_args_list]
+        self.assertEqual(sent, [get_random_id('a'), get_random_id('b')])
+        bot.checkpoint.close()
+
+        restarted = self._make_bot()
+        restarted.run([self._make_event('b'), self._make_event('c')])
+        sent = [kwargs['random_id'] for args, kwargs in restarted.api.messages.send.call_args_list]
+        self.assertEqual(sent, [get_random_id('c')])
+        restarted.checkpoint.close()
+
+    def test_long_poll_resumes_from_saved_ts(self):
+        batches = [(['a', 'b'], '11'), (['c'], '12')]
+
+        def check():
+            if not batches:
+                raise KeyboardInterrupt  # остановить бесконечный цикл чтения
+            event_ids, bot.poller.ts = batches.pop(0)
+            return [self._make_event(event_id) for event_id in event_ids]
+
+        bot = self._make_bot()
+        bot.poller.check = check
+        with self.assertRaises(KeyboardInterrupt):
+            bot.run()
+        self.assertEqual(bot.api.messages.send.call_count, 3)
+        bot.checkpoint.close()
+
+        with open(self.path, 'a', encoding='utf8') as file:
+            file.write('t 1')  # сбой во время записи
+        restarted = self._make_bot()
+        restarted.poller.check = Mock(side_effect=KeyboardInterrupt)
+        with self.assertRaises(KeyboardInterrupt):
+            restarted.run()
+        self.assertEqual(restarted.poller.ts, '12')
+        self.assertTrue(restarted.checkpoint.is_processed('c'))
+        restarted.checkpoint.close()
+
+    def test_ts_waits_for_concurrent_events(self):
+        checkpoint = Checkpoint(self.path)
+        checkpoint.track_batch('11', ['a', 'b', None])
+        checkpoint.track_batch('12', ['c'])
+        checkpoint.mark_processed('c')
+        checkpoint.mark_processed('a')
+        self.assertIsNone(checkpoint.ts)  # 'b' из первой пачки еще обрабатывается
+        checkpoint.mark_processed('b')
+        self.assertEqual(checkpoint.ts, '12')
+        checkpoint.track_batch('13', ['c'])  # повтор уже обработанного события
+        self.assertEqual(checkpoint.ts, '13')
+        checkpoint.close()
+
+    def test_async_run_saves_ts(self):
+        batches = [(['a', 'b'], '11'), (['c'], '12')]
+
+        def check():
+            if not batches:
+                deadline = time.monotonic() + 5
+                while bot.events_processed < 3 and time.monotonic() < deadline:
+                    time.sleep(0.01)  # дождаться обработки прочитанных событий перед остановкой
+                raise KeyboardInterrupt
+            event_ids, bot.poller.ts = batches.pop(0)
+            return [self._make_event(event_id) for event_id in event_ids]
+
+        bot = self._make_bot()
+        bot.poller.check = check
+        with self.assertRaises(KeyboardInterrupt):
+            bot.serve(async_workers=4)
+        self.assertEqual(bot.api.messages.send.call_count, 3)
+        self.assertEqual(bot.checkpoint.ts, '12')
+        bot.checkpoint.close()
+
+    def test_supervisor_skips_processed_events(self):
+        checkpoint = Checkpoint(self.path)
+        checkpoint.mark_processed('a')
+        poller = Mock(ts='11')
+        poller.check = Mock(side_effect=[[self._make_event('a'), self._make_event('b')], KeyboardInterrupt])
+
+        supervisor = Supervisor('', '', num_workers=1, checkpoint_path=self.path)
+        events = supervisor.read_events(poller, checkpoint)
+        self.assertEqual(next(events).raw['event_id'], 'b')
+        self.assertIsNone(checkpoint.ts)
+
+        # воркер сообщает об обработке, супервизор отмечает событие и сохраняет ts пачки
+        WorkerCheckpoint(supervisor.done_queue).mark_processed('b')
+        supervisor.done_queue.put(None)
+        supervisor._collect_processed(checkpoint)
+        self.assertTrue(checkpoint.is_processed('b'))
+        self.assertEqual(checkpoint.ts, '11')
+        checkpoint.close()
+
+    def test_journal_is_compacted(self):
+        checkpoint = Checkpoint(self.path, max_events=3)
+        for number in range(20):
+            checkpoint.mark_processed(str(number))
+            checkpoint.save_ts(str(number))
+        checkpoint.close()
+
+        with open(self.path, encoding='utf8') as file:
+            self.assertLessEqual(len(file.readlines()), 7)
+        restored = Checkpoint(self.path, max_events=3)
+        self.assertEqual(restored.ts, '19')
+        self.assertTrue(restored.is_processed('19'))
+        self.assertFalse(restored.is_processed('15'))
+        restored.close()
+
+
+class FakeVkTester(unittest.TestCase):
+
+    def setUp(self):
+        self.replies = []
+        self.server = FakeVkServer(on_reply=lambda peer_id, message, received_at:
+                                   self.replies.append((peer_id, message))).start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_bot_talks_to_fake_vk(self):
+        bot = Bot('', self.server.group_id, api_url=self.server.api_url)
+        self.server.push_message(1, 'привет')
+        self.server.push_message(2, 'привет')
+        bot.run(bot.poller.check())
+        self.assertEqual([peer_id for peer_id, message in self.replies], [1, 2])
+
+        # пакет execute и повтор random_id, который не доставляется
+        sender = BatchSender(bot.api, batch_window=0.5, batch_size=3)
+        futures = [sender.send(peer_id=3, random_id=random_id, message='текст') for random_id in (7, 7, 8)]
+        sender.close()
+        self.assertEqual(futures[0].result(), futures[1].result())
+        self.assertEqual((self.server.execute_calls, self.server.duplicates), (1, 1))
+        self.assertEqual(len(self.replies), 4)
+
+
+class SupervisorTester(unittest.TestCase):
+
+    def test_dispatch_keeps_peer_on_one_worker(self):
+        supervisor = Supervisor('', '', num_workers=4)
+        supervisor.processes = [Mock(is_alive=Mock(return_value=True)) for _ in range(4)]
+        supervisor.queues = [Mock() for _ in range(4)]
+
+        for peer_id in range(100):
+            event = deepcopy(BotTester.RAW_EVENT)
+            event['object']['message']['peer_id'] = peer_id
+            self.assertEqual(supervisor.dispatch(event), get_shard(peer_id, 4))
+            self.assertEqual(supervisor.dispatch(event), get_shard(peer_id, 4))
+
+        sent = sum(worker_queue.put.call_count for worker_queue in supervisor.queues)
+        self.assertEqual(sent, 200)
+        self.assertTrue(all(worker_queue.put.called for worker_queue in supervisor.queues))
+
+    def test_dead_worker_restarts_without_events(self):
+        supervisor = Supervisor('', '', num_workers=2, watch_interval=0.01)
+        supervisor.processes = [Mock(is_alive=Mock(return_value=True)), Mock(is_alive=Mock(return_value=False))]
+        restarted = threading.Event()
+        stop = threading.Event()
+
+        def start_worker(index):
+            supervisor.processes[index] = Mock(is_alive=Mock(return_value=True))
+            restarted.set()
+
+        with patch.object(supervisor, '_start_worker', side_effect=start_worker) as start_mock:
+            watchdog = threading.Thread(target=supervisor._watch_workers, args=(stop,), daemon=True)
+            watchdog.start()
+            self.assertTrue(restarted.wait(5))
+            stop.set()
+            watchdog.join(5)
+
+        start_mock.assert_called_once_with(1)
+        self.assertTrue(supervisor.processes[1].is_alive())
+
+    def test_worker_processes_queued_events(self):
+        events_queue = queue.Queue()
+        for text in ('привет', settings.SCENARIOS['ticket']['help_token']):
+            event = deepcopy(BotTester.RAW_EVENT)
+            event['object']['message']['text'] = text
+            events_queue.put(event)
+        events_queue.put(None)
+
+        vk_mock = Mock()
+        with patch('bot.vk_api.VkApi', return_value=vk_mock):
+            worker_main(0, events_queue, '', '', report_interval=60)
+
+        send_mock = vk_mock.get_api.return_value.messages.send
+        messages = [kwargs['message'] for args, kwargs in send_mock.call_args_list]
+        self.assertEqual(messages, [settings.DEFAULT_ANSWER, Bot.get_help_message()])
+
+
+class SessionStoreTester(unittest.TestCase):
+    STEPS = get_scenario('ticket').steps
+
+    def test_memory_store_evicts_and_expires(self):
+        store = MemorySessionStore(max_sessions=2, ttl=60)
+        with patch('sessions.time.monotonic', return_value=1000):
+            for user_id in (1, 2, 3):
+                store[user_id] = UserState('ticket', self.STEPS[1])
+
+            self.assertNotIn(1, store)  # вытеснен как самый давний
+            self.assertIn(2, store)
+            self.assertIn(3, store)
+
+        with patch('sessions.time.monotonic', return_value=1061):
+            self.assertNotIn(3, store)
+
+        self.assertEqual(store.stats(), {'sessions': 0, 'hits': 2, 'misses': 2, 'evictions': 1, 'expirations': 2})
+
+    def test_sqlite_store_survives_restart(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = os.path.join(tmp_dir, 'sessions.sqlite')
+            store = SqliteSessionStore(db_path)
+            state = UserState('ticket', self.STEPS[1], {'from_': 'Москва'})
+            store[42] = state
+            state.step = self.STEPS[2]
+            store.save(42, state)
+
+            restarted_store = SqliteSessionStore(db_path)
+            restored_state = restarted_store.get(42)
+            self.assertEqual(restored_state.step, self.STEPS[2])
+            self.assertEqual(restored_state.context, {'from_': 'Москва'})
+            self.assertEqual(len(restarted_store), 1)
+
+            restarted_store.pop(42)
+            self.assertNotIn(42, SqliteSessionStore(db_path))
+
+
+class ScenarioTester(unittest.TestCase):
+    CONFIG = settings.SCENARIOS['ticket']
+
+    def _broken_config(self, number, **changes):
+        config = deepcopy(self.CONFIG)
+        config['steps'][number].update(changes)
+        return config
+
+    def test_compiled_steps(self):
+        scenario = get_scenario('ticket')
+        step = scenario.first_step
+        numbers = []
+        while step is not None:
+            numbers.append(step.number)
+            self.assertEqual(step.handler is None, step.is_final)
+            step = step.next
+
+        self.assertEqual(numbers, sorted(self.CONFIG['steps']))
+        self.assertIs(scenario.steps[1].handler, handlers.handle_departure)
+        self.assertIs(scenario.steps[2].next, scenario.steps[3])
+        self.assertEqual(scenario.steps[2].text.fields, {'from_'})
+        self.assertEqual(scenario.steps[2].text.render({'from_': 'Москва'}),
+                         self.CONFIG['steps'][2]['text'].format(from_='Москва'))
+
+    def test_broken_scenario_fails_compilation(self):
+        broken_configs = (
+            self._broken_config(3, handler='handle_nothing'),  # нет обработчика
+            self._broken_config(3, text='Вы ввели {flight_id}'),  # ID рейса вводится позже
+            self._broken_config(2, failure_text='Доступны:\n{departures'),  # незакрытая скобка
+            self._broken_config(9, handler='handle_phone'),  # обработчик у последнего шага
+        )
+        for config in broken_configs:
+            with self.assertRaises(ScenarioError):
+                compile_scenario('ticket', config)
+
+        config = deepcopy(self.CONFIG)
+        del config['steps'][5]
+        with self.assertRaises(ScenarioError):
+            compile_scenario('ticket', config)
+
+
+class MetricsTester(unittest.TestCase):
+
+    def test_render_prometheus_text(self):
+        registry = Registry()
+        histogram = Histogram('step_seconds', 'Время шага', ('handler',), buckets=(0.1, 1.0), registry=registry)
+        counter = Counter('intents_total', 'Интенты', ('intent',), registry=registry)
+
+        for value in (0.05, 0.1, 0.5, 3.0):
+            histogram.observe(value, 'handle_date')
+        with histogram.time('handle_phone'):
+            pass
+        counter.inc('помощь')
+        counter.inc('помощь')
+        counter.inc('a"b')
+
+        text = registry.render()
+        for line in ('# TYPE step_seconds histogram',
+                     'step_seconds_bucket{handler="handle_date",le="0.1"} 2',
+                     'step_seconds_bucket{handler="handle_date",le="1.0"} 3',
+                     'step_seconds_bucket{handler="handle_date",le="+Inf"} 4',
+                     'step_seconds_sum{handler="handle_date"} 3.65',
+                     'step_seconds_count{handler="handle_date"} 4',
+                     'step_seconds_count{handler="handle_phone"} 1',
+                     '# TYPE intents_total counter',
+                     'intents_total{intent="помощь"} 2',
+                     'intents_total{intent="a\\"b"} 1'):
+            self.assertIn(line + '\n', text)
+
+        with self.assertRaises(ValueError):
+            Counter('intents_total', 'Повтор', registry=registry)
+
+    def test_bot_scenario_metrics_endpoint(self):
+        handler_count = bot.HANDLER_SECONDS.count('handle_phone')
+        failures = bot.STEP_FAILURES.get('handle_phone')
+        completed = bot.SCENARIOS_COMPLETED.get('ticket')
+        help_intents = bot.INTENTS_TOTAL.get('помощь')
+
+        inputs = list(BotTester.INPUTS)
+        inputs[5] = (datetime.date.today() + datetime.timedelta(days=30)).strftime('%d-%m-%Y')
+        events = []
+        for text in inputs:
+            event = deepcopy(BotTester.RAW_EVENT)
+            event['object']['message']['text'] = text
+            events.append(VkBotMessageEvent(event))
+
+        with patch('bot.VkBotLongPoll'):
+            test_bot = Bot('', '')
+        test_bot.api = Mock()
+        test_bot.tickets_api = Mock(get_tickets=Mock(return_value=BotTester.FAKE_FLIGHTS),
+                                    is_route_available=Mock(return_value=True))
+        test_bot.departures = BotTester.DEPARTURES
+        test_bot.arrivals = BotTester.ARRIVALS
+        test_bot.run(events)
+
+        self.assertEqual(bot.HANDLER_SECONDS.count('handle_phone'), handler_count + 2)
+        self.assertEqual(bot.STEP_FAILURES.get('handle_phone'), failures + 1)
+        self.assertEqual(bot.SCENARIOS_COMPLETED.get('ticket'), completed + 1)
+        self.assertEqual(bot.INTENTS_TOTAL.get('помощь'), help_intents + 1)
+
+        server = start_metrics_server(0, is_ready=lambda: test_bot.is_ready)
+        try:
+            url = f'http://127.0.0.1:{server.server_address[1]}'
+            with urllib.request.urlopen(f'{url}/metrics') as response:
+                text = response.read().decode('utf8')
+
+            with self.assertRaises(urllib.error.HTTPError) as error:
+                urllib.request.urlopen(f'{url}/ready')
+            self.assertEqual(error.exception.code, 503)
+            error.exception.close()
+            test_bot.ready.set()
+            with urllib.request.urlopen(f'{url}/ready') as response:
+                self.assertEqual(response.status, 200)
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertIn('bot_scenarios_completed_total{scenario="ticket"}', text)
+        self.assertIn('# TYPE dispatcher_call_seconds histogram', text)
+
+    def test_metrics_server_port_in_use(self):
+        server = start_metrics_server(0)
+        try:
+            with self.assertLogs('bot_logger', 'ERROR'):
+                self.assertIsNone(start_metrics_server(server.server_address[1]))
+        finally:
+            server.shutdown()
+            server.server_close()
+
 
 if __name__ == '__main__':
     unittest.main()
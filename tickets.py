@@ -1,16 +1,52 @@
+import argparse
+import logging
 import os.path
-from sqlalchemy import Column, String, Integer, Float, DateTime
-from sqlalchemy import create_engine
-from sqlalchemy import and_
+import threading
+import time
+from contextlib import contextmanager
+from sqlalchemy import Column, String, Integer, Float, DateTime, Index
+from sqlalchemy import create_engine, event
+from sqlalchemy import and_, func, literal, select, tuple_
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 import datetime
+from cache import LRUCache
+from inventory import ColumnarInventory
+from metrics import Histogram
 
 Base = declarative_base()
 
+DB_NAME = 'tickets_api_db.sqlite'
+
+# источники ответов на запросы рейсов и локаций: 'sql' - запросы к БД, 'columnar' - снимок рейсов в памяти
+BACKENDS = ('sql', 'columnar')
+
+DISPATCHER_SECONDS = Histogram('dispatcher_call_seconds', 'Время вызова API Dispatcher, сек.', ('method',))
+
+# настройки соединений SQLite: WAL позволяет читать БД во время записи другим соединением
+SQLITE_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',  # в режиме WAL безопасно и без fsync на каждую транзакцию
+    'PRAGMA busy_timeout=30000',  # ждать снятия блокировки записи, а не сразу падать с "database is locked"
+    'PRAGMA cache_size=-16000',  # 16 Мб кэша страниц на соединение
+    'PRAGMA temp_store=MEMORY',
+)
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
 
 class Ticket(Base):
     __tablename__ = 'tickets'
+    __table_args__ = (
+        Index('ix_tickets_route_when', 'from_', 'to_', 'when_'),  # get_tickets, is_route_available
+        Index('ix_tickets_when', 'when_'),  # запросы локаций и рейсов без маршрута
+    )
 
     id = Column(Integer, primary_key=True)
     from_ = Column(String(100), nullable=False)
@@ -29,6 +65,123 @@ class Ticket(Base):
         return self.__info()
 
 
+class ArchivedTicket(Base):
+    ''' вылетевшие рейсы, перенесенные из tickets обслуживанием Dispatcher.run_maintenance '''
+    __tablename__ = 'archived_tickets'
+    __table_args__ = (
+        Index('ix_archived_tickets_ticket_id', 'ticket_id'),
+    )
+
+    # свой ключ: SQLite может выдать id удаленного из tickets рейса новому рейсу, и его архивная запись повторит id
+    id = Column(Integer, primary_key=True)
+    ticket_id = Column(Integer, nullable=False)  # id рейса в tickets
+    from_ = Column(String(100), nullable=False)
+    to_ = Column(String(100), nullable=False)
+    when_ = Column(DateTime, nullable=False)
+    price = Column(Float, nullable=False)
+    archived_at = Column(DateTime, nullable=False)
+
+
+class Order(Base):
+    ''' оформленные заказы билетов, записываются пачками через orders.OrderWriter '''
+    __tablename__ = 'orders'
+    __table_args__ = (
+        Index('ix_orders_peer_id_created_at', 'peer_id', 'created_at'),  # заказы пользователя
+        Index('ix_orders_created_at', 'created_at'),  # выгрузка заказов за период
+    )
+
+    id = Column(Integer, primary_key=True)
+    peer_id = Column(Integer, nullable=False)
+    from_ = Column(String(100), nullable=False)
+    to_ = Column(String(100), nullable=False)
+    flight_id = Column(Integer, nullable=False)  # id рейса в tickets
+    flight_when_ = Column(DateTime, nullable=False)
+    tickets_qty = Column(Integer, nullable=False)
+    price = Column(Float, nullable=False)
+    total = Column(Float, nullable=False)
+    phone = Column(String(32), nullable=False)
+    comment = Column(String(1000), nullable=False, default='')
+    created_at = Column(DateTime, nullable=False)  # оформление заказа пользователем
+    stored_at = Column(DateTime, nullable=False)  # запись в БД
+
+
+ORDER_FIELDS = ('peer_id', 'from_', 'to_', 'flight_id', 'flight_when_', 'tickets_qty', 'price', 'total', 'phone',
+                'comment', 'created_at')
+
+
+class RouteIndex:
+    """
+    Время последнего вылета по каждому маршруту (from_, to_) в памяти:
+    проверка доступности маршрута без запроса к БД.
+    """
+
+    def __init__(self, max_age=None):
+        """ :param max_age: через сколько секунд перестраивать индекс в фоне (учесть записи других процессов) """
+
+        self.max_age = max_age
+        self.logger = logging.getLogger('bot_logger')
+        self.rebuild_count = 0
+        self._latest = {}  # (from_, to_) -> datetime.datetime последнего вылета
+        self._built_at = None
+        self._rebuilding = threading.Lock()
+
+    @property
+    def is_built(self):
+        return self._built_at is not None
+
+    def rebuild(self, session):
+        """ Построить индекс одним агрегирующим запросом """
+
+        rows = session.query(Ticket.from_, Ticket.to_, func.max(Ticket.when_)) \
+            .filter(Ticket.when_ > datetime.datetime.now()) \
+            .group_by(Ticket.from_, Ticket.to_)
+        self._latest, self._built_at = {(from_, to_): when_ for from_, to_, when_ in rows}, time.monotonic()
+        self.rebuild_count += 1
+
+    def rebuild_in_background(self, session_scope):
+        """ :param session_scope: контекстный менеджер, выдающий сессию (Dispatcher._session_scope) """
+
+        if not self._rebuilding.acquire(blocking=False):
+            return
+
+        def rebuild_and_release():
+            try:
+                with session_scope() as session:
+                    self.rebuild(session)
+            except Exception as exc:
+                self.logger.exception('Не удалось перестроить индекс маршрутов: %s', (exc.__class__.__name__, exc.args))
+            finally:
+                self._rebuilding.release()
+
+        threading.Thread(target=rebuild_and_release, name='route-index-rebuild', daemon=True).start()
+
+    @property
+    def is_stale(self):
+        return self.max_age is not None and time.monotonic() - self._built_at > self.max_age
+
+    def add(self, from_, to_, when_):
+        """ Учесть новый рейс """
+
+        key = (from_, to_)
+        latest = self._latest.get(key)
+        if latest is None or when_ > latest:
+            self._latest[key] = when_
+
+    def is_available(self, from_, to_, when_):
+        """ Есть ли рейсы по маршруту позже when_ """
+
+        key = (from_, to_)
+        latest = self._latest.get(key)
+        if latest is None:
+            return False
+
+        if latest <= datetime.datetime.now():
+            self._latest.pop(key, None)  # все рейсы маршрута уже вылетели
+            return False
+
+        return latest > when_
+
+
 class Dispatcher:
     # расписание для формирования рейсов в БД
     settings = {
@@ -93,28 +246,94 @@ class Dispatcher:
         ]
     }
 
-    @classmethod
-    def _create_engine(cls):
-
-        db_dialect = 'sqlite:///'
-        db_name = 'tickets_api_db.sqlite'
-        db_full_path = os.path.normpath(os.path.join(os.path.dirname(__file__), db_name))
-        engine = create_engine(f'{db_dialect}{db_full_path}')
-
-        Base.metadata.create_all(engine)
-        Base.metadata.bind = engine
-
-        return engine
+    # engine с пулом соединений - один на БД для всех экземпляров Dispatcher процесса
+    _engines = {}
+    _engines_lock = threading.Lock()
 
     @classmethod
-    def _create_session(cls):
-        engine = Dispatcher._create_engine()
-        DBSession = sessionmaker(bind=engine)
-        session = DBSession()
-        return session
+    def _create_engine(cls, db_url=None, pool_size=5, max_overflow=10):
+
+        if db_url is None:
+            db_dialect = 'sqlite:///'
+            db_full_path = os.path.normpath(os.path.join(os.path.dirname(__file__), DB_NAME))
+            db_url = f'{db_dialect}{db_full_path}'
+
+        with cls._engines_lock:
+            engine = cls._engines.get(db_url)
+            if engine is not None:
+                return engine
+
+            if db_url.startswith('sqlite:///') and db_url != 'sqlite:///:memory:':
+                # соединения из пула переходят между потоками, но одновременно используются только одним
+                engine = create_engine(db_url, poolclass=QueuePool, pool_size=pool_size, max_overflow=max_overflow,
+                                       connect_args={'check_same_thread': False, 'timeout': 30})
+                event.listen(engine, 'connect', _set_sqlite_pragmas)
+            else:
+                engine = create_engine(db_url)
+
+            # схема создается и обновляется один раз, а не при каждом создании Dispatcher
+            Base.metadata.create_all(engine)
+            Base.metadata.bind = engine
+            cls._migrate(engine)
+
+            cls._engines[db_url] = engine
+            return engine
 
-    def __init__(self):
-        self.session = Dispatcher._create_session()
+    @classmethod
+    def _migrate(cls, engine):
+        ''' добавляет в БД, созданную прежней версией, индексы (create_all создает их только вместе с таблицей) '''
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                columns = ', '.join(column.name for column in index.columns)
+                engine.execute(f'CREATE INDEX IF NOT EXISTS {index.name} ON {table.name} ({columns})')
+
+    def __init__(self, db_url=None, use_route_index=True, route_index_max_age=60, tickets_cache_size=1024,
+                 tickets_cache_ttl=60, pool_size=5, max_overflow=10, backend='sql', inventory_max_age=60):
+        """
+        :param db_url: str - адрес БД для sqlalchemy, по умолчанию - файл tickets_api_db.sqlite рядом с модулем
+        :param backend: str - 'sql' - запросы к БД, 'columnar' - ответы по снимку рейсов в памяти (inventory.py)
+        :param inventory_max_age: int - период обновления снимка 'columnar' в фоне, сек.: ограничивает устаревание
+        при записи рейсов другими процессами (None - не обновлять)
+        :param pool_size: int - кол-во постоянных соединений в пуле (учитывается при первом подключении к БД)
+        :param max_overflow: int - кол-во дополнительных соединений сверх pool_size при пиковой нагрузке
+        :param use_route_index: bool - проверять доступность маршрутов по индексу в памяти, а не запросом к БД
+        :param route_index_max_age: int - период перестроения индекса маршрутов, сек. (None - не перестраивать)
+        :param tickets_cache_size: int - кол-во запросов get_tickets в кэше (0 - без кэша)
+        :param tickets_cache_ttl: int - время жизни результата в кэше, сек.: ограничивает устаревание
+        при записи рейсов другими процессами (None - без ограничения)
+        """
+        if backend not in BACKENDS:
+            raise ValueError(f'Неизвестный источник рейсов: {backend}, допустимые: {", ".join(BACKENDS)}')
+
+        self.engine = Dispatcher._create_engine(db_url, pool_size=pool_size, max_overflow=max_overflow)
+        self.session_factory = sessionmaker(bind=self.engine)
+        self.backend = backend
+        self.inventory = ColumnarInventory(self._load_inventory, inventory_max_age) if backend == 'columnar' else None
+        # снимок 'columnar' сам отвечает на проверку маршрутов, отдельный индекс ему не нужен
+        self.route_index = RouteIndex(route_index_max_age) if use_route_index and self.inventory is None else None
+        self.tickets_cache = LRUCache(tickets_cache_size, tickets_cache_ttl) if tickets_cache_size else None
+        self.inventory_version = 0  # увеличивается при каждой записи рейсов этим процессом
+
+    def close(self):
+        ''' закрывает соединения пула с БД (например, перед удалением файла БД) '''
+        with Dispatcher._engines_lock:
+            for db_url, engine in list(Dispatcher._engines.items()):
+                if engine is self.engine:
+                    del Dispatcher._engines[db_url]
+        self.engine.dispose()
+
+    @contextmanager
+    def _session_scope(self):
+        ''' сессия на одну операцию: безопасно для вызовов из разных потоков, соединение сразу возвращается в пул '''
+        session = self.session_factory()
+        try:
+            yield session
+            session.commit()
+        except BaseException:
+            session.rollback()
+            raise
+        finally:
+            session.close()
 
     def _get_date(self, start_date, num_days):
         result = datetime.date(year=start_date.year, month=start_date.month, day=start_date.day) + \
@@ -125,90 +344,211 @@ class Dispatcher:
         result = datetime.time(hour=hr_min_tuple[0], minute=hr_min_tuple[1])
         return result
 
-    def _instantiate_ticket(self, cfg, date):
-
-        time = self._get_time(cfg['when_'])
-        ticket = Ticket(
-            from_=cfg['from_'],
-            to_=cfg['to_'],
-            when_=datetime.datetime.combine(date, time),
-            price=cfg['price']
-        )
-        return ticket
-
-    def _create_daily_tickets(self, start_date):
-
-        num_days = Dispatcher.settings['num_days']
-        configs = Dispatcher.settings['daily_tickets']
-
-        for cfg in configs:
-
-            tickets = []
-            for day in range(0, num_days + 1):
-                curr_date = self._get_date(start_date, day)
-                ticket = self._instantiate_ticket(cfg, curr_date)
-                tickets.append(ticket)
-
-            self.session.add_all(tickets)
-
-    def _create_tickets_on_weekdays(self, start_date):
-
-        num_days = Dispatcher.settings['num_days']
-        configs = Dispatcher.settings['tickets_on_weekdays']
-
-        for cfg in configs:
-
-            tickets = []
-            for day in range(0, num_days + 1):
-
-                curr_date = self._get_date(start_date, day)
-                weekday_num = curr_date.timetuple().tm_wday
-
-                if not weekday_num in cfg['weekdays']:
-                    continue
-
-                ticket = self._instantiate_ticket(cfg, curr_date)
-                tickets.append(ticket)
-
-            if tickets:
-                self.session.add_all(tickets)
-
-    def _create_tickets_on_monthdays(self, start_date):
-
-        num_days = Dispatcher.settings['num_days']
-        configs = Dispatcher.settings['tickets_on_monthdays']
-
-        for cfg in configs:
-            tickets = []
-
-            for day in range(0, num_days + 1):
-
-                curr_date = self._get_date(start_date, day)
-                monthday_num = curr_date.timetuple().tm_mday
-
-                if not monthday_num in cfg['monthdays']:
-                    continue
+    def _generate_schedule(self, start_date, num_days, settings=None):
+        '''
+        генерирует строки таблицы tickets (словари) по расписанию settings на даты
+        от start_date до start_date + num_days включительно - день за днем, все маршруты дня
+        '''
+        settings = settings or Dispatcher.settings
+
+        # все, что не зависит от даты, вычисляем один раз
+        def prepare(cfg, days_key=None):
+            days = frozenset(cfg[days_key]) if days_key else None
+            return cfg['from_'], cfg['to_'], self._get_time(cfg['when_']), cfg['price'], days
+
+        daily = [prepare(cfg) for cfg in settings.get('daily_tickets', ())]
+        on_weekdays = [prepare(cfg, 'weekdays') for cfg in settings.get('tickets_on_weekdays', ())]
+        on_monthdays = [prepare(cfg, 'monthdays') for cfg in settings.get('tickets_on_monthdays', ())]
+
+        for day in range(0, num_days + 1):
+            curr_date = self._get_date(start_date, day)
+            weekday_num, monthday_num = curr_date.weekday(), curr_date.day
+
+            for configs, day_num in ((daily, None), (on_weekdays, weekday_num), (on_monthdays, monthday_num)):
+                for from_, to_, departure_time, price, days in configs:
+                    if days is not None and day_num not in days:
+                        continue
+                    yield {
+                        'from_': from_,
+                        'to_': to_,
+                        'when_': datetime.datetime.combine(curr_date, departure_time),
+                        'price': price,
+                    }
+
+    def add_tickets(self, rows, chunk_size=5000):
+        '''
+        Пакетная запись рейсов в БД (executemany), частями по chunk_size строк в отдельных транзакциях.
+        Рейс, уже существующий в БД (тот же маршрут и время вылета), повторно не записывается,
+        поэтому загрузку можно безопасно перезапускать.
+        :param rows: iterable словарей с полями from_, to_, when_, price
+        :return: dict - статистика загрузки: rows, inserted, seconds, rows_per_second
+        '''
+        started = time.perf_counter()
+        total = inserted = 0
+        chunk = []
+
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                inserted += self._insert_chunk(chunk)
+                total += len(chunk)
+                chunk = []
+
+        if chunk:
+            inserted += self._insert_chunk(chunk)
+            total += len(chunk)
+
+        seconds = time.perf_counter() - started
+        return {
+            'rows': total,
+            'inserted': inserted,
+            'seconds': seconds,
+            'rows_per_second': total / seconds if seconds else 0.0,
+        }
+
+    def _insert_chunk(self, rows):
+        with self._session_scope() as session:
+            # уже загруженные рейсы из диапазона дат части - одним запросом по индексу when_
+            existing = session.query(Ticket.from_, Ticket.to_, Ticket.when_).filter(
+                Ticket.when_.between(min(row['when_'] for row in rows), max(row['when_'] for row in rows)))
+            existing = set(existing)
+
+            new_rows = []
+            for row in rows:
+                key = (row['from_'], row['to_'], row['when_'])
+                if key not in existing:
+                    existing.add(key)
+                    new_rows.append(row)
+
+            if new_rows:
+                session.execute(Ticket.__table__.insert(), new_rows)
+
+        if new_rows:
+            self._on_tickets_added(new_rows)
+        return len(new_rows)
+
+    def _create_tickets_in_db(self, num_days=None, start_date=None, settings=None, chunk_size=5000):
+        ''' заполняет по настройкам таблицу tickets в базе данных, возвращает статистику загрузки '''
+        settings = settings or Dispatcher.settings
+        start_date = start_date or datetime.datetime.now()
+        num_days = settings['num_days'] if num_days is None else num_days
+
+        rows = self._generate_schedule(start_date, num_days, settings)
+        return self.add_tickets(rows, chunk_size=chunk_size)
+
+    def extend_schedule(self, horizon_days=None, settings=None, today=None):
+        '''
+        Дополняет рейсы по расписанию settings по одному дню, пока расписание не покроет
+        horizon_days дней от сегодняшнего (по умолчанию - settings['num_days']).
+        :return: int - кол-во записанных рейсов
+        '''
+        settings = settings or Dispatcher.settings
+        horizon_days = settings['num_days'] if horizon_days is None else horizon_days
+        today = today or datetime.date.today()
 
-                ticket = self._instantiate_ticket(cfg, curr_date)
-                tickets.append(ticket)
+        with self._session_scope() as session:
+            last_when_ = session.query(func.max(Ticket.when_)).scalar()
+        # день последнего рейса генерируется заново: загрузка могла прерваться посреди него,
+        # а уже записанные рейсы add_tickets пропускает
+        next_date = max(today, last_when_.date()) if last_when_ else today
+        last_date = today + datetime.timedelta(days=horizon_days)
 
-            if tickets:
-                self.session.add_all(tickets)
+        inserted = 0
+        while next_date <= last_date:
+            inserted += self.add_tickets(self._generate_schedule(next_date, 0, settings))['inserted']
+            next_date += datetime.timedelta(days=1)
 
-    def _create_tickets_in_db(self):
-        ''' заполняет по настройкам таблицу tickets в базе данных'''
-        start_date = datetime.datetime.now()
+        return inserted
 
-        self._create_daily_tickets(start_date)
-        self._create_tickets_on_weekdays(start_date)
-        self._create_tickets_on_monthdays(start_date)
+    def archive_departed(self, batch_size=1000, pause=0.0, now=None):
+        '''
+        Переносит вылетевшие рейсы из tickets в archived_tickets частями по batch_size строк,
+        каждая часть - в своей короткой транзакции, с паузой pause сек. между частями,
+        чтобы не блокировать запросы бота.
+        :return: int - кол-во перенесенных рейсов
+        '''
+        now = now or datetime.datetime.now()
+        tickets = Ticket.__table__
+        archived = 0
+
+        while True:
+            with self._session_scope() as session:
+                ids = [row.id for row in session.query(Ticket.id).filter(Ticket.when_ <= now)
+                       .order_by(Ticket.when_).limit(batch_size)]
+                if not ids:
+                    break
+
+                departed = select([tickets.c.id, tickets.c.from_, tickets.c.to_, tickets.c.when_, tickets.c.price,
+                                   literal(now, DateTime)]).where(tickets.c.id.in_(ids))
+                session.execute(ArchivedTicket.__table__.insert().from_select(
+                    ['ticket_id', 'from_', 'to_', 'when_', 'price', 'archived_at'], departed))
+                session.execute(tickets.delete().where(tickets.c.id.in_(ids)))
+            # версию inventory не меняем: вылетевшие рейсы не попадают ни в один запрос API
+
+            archived += len(ids)
+            if len(ids) < batch_size:
+                break
+            time.sleep(pause)
+
+        return archived
+
+    def run_maintenance(self, batch_size=1000, pause=0.05):
+        '''
+        Обслуживание скользящего окна рейсов: расписание дополняется до горизонта settings['num_days'],
+        вылетевшие рейсы переносятся в архив.
+        :return: dict - кол-во добавленных (added) и перенесенных в архив (archived) рейсов
+        '''
+        added = self.extend_schedule()
+        archived = self.archive_departed(batch_size=batch_size, pause=pause)
+        return {'added': added, 'archived': archived}
 
-        self.session.commit()
+    def start_maintenance(self, interval=60 * 60, batch_size=1000):
+        '''
+        Запускает run_maintenance в фоновом потоке каждые interval сек. (первый запуск - сразу).
+        :return: threading.Event - установить, чтобы остановить обслуживание
+        '''
+        logger = logging.getLogger('bot_logger')
+        stop = threading.Event()
+
+        def maintain():
+            while not stop.is_set():
+                try:
+                    stats = self.run_maintenance(batch_size=batch_size)
+                    logger.info('Обслуживание БД рейсов: добавлено %s, перенесено в архив %s',
+                                stats['added'], stats['archived'])
+                except Exception as exc:
+                    logger.exception('Ошибка обслуживания БД рейсов: %s', (exc.__class__.__name__, exc.args))
+                stop.wait(interval)
+
+        threading.Thread(target=maintain, name='tickets-maintenance', daemon=True).start()
+        return stop
+
+    def _on_tickets_added(self, rows):
+        ''' обновляет кэши в памяти после записи новых рейсов (словари с полями from_, to_, when_) в БД '''
+        self._bump_inventory_version()
+        if self.route_index is not None and self.route_index.is_built:
+            for row in rows:
+                self.route_index.add(row['from_'], row['to_'], row['when_'])
+
+    def _bump_inventory_version(self):
+        ''' делает недействительными результаты запросов в кэше - вызывается после каждой записи в tickets '''
+        self.inventory_version += 1
+
+    def _load_inventory(self):
+        ''' строки для снимка рейсов в памяти: (id, from_, to_, when_, price) по возрастанию (when_, id) '''
+        tickets = Ticket.__table__
+        with self._session_scope() as session:
+            return session.execute(select([tickets.c.id, tickets.c.from_, tickets.c.to_, tickets.c.when_,
+                                           tickets.c.price]).order_by(tickets.c.when_, tickets.c.id)).fetchall()
+
+    def _columns(self):
+        return self.inventory.get(self.inventory_version)
 
     def _get_date_for_query(self, when_):
         return datetime.datetime.now() if when_ is None else max(datetime.datetime.now(), when_)
 
-    def get_tickets(self, when_=None, from_=None, to_=None, limit=None):
+    @DISPATCHER_SECONDS.time('get_tickets')
+    def get_tickets(self, when_=None, from_=None, to_=None, limit=None, use_cache=True, after=None):
 
         '''
         API получения доступных рейсов (полетов) по данным из БД.
@@ -218,31 +558,75 @@ class Dispatcher:
         :param from_ : str - город вылета
         :param to_ : str - город назначения
         :param limit: int > 0 - ограничение на кол-во записей в результате.
+        :param use_cache: bool - использовать кэш результатов (False - всегда запрос к БД).
+        :param after: tuple (when_, price, id) последнего рейса предыдущей страницы - вернуть рейсы после него.
+        Следующая страница находится по индексу, а не пропуском предыдущих, поэтому стоит одинаково на любой глубине.
 
         :return: dict - cловарь доступных билетов (с ограничением limit),
-        отсортированных по возрастающей дате вылета и возрастающей цене c датой вылета сегодня и позднее.
+        отсортированных по возрастающей дате вылета, цене и ID c датой вылета сегодня и позднее.
         Ключ: ID билета - int
         Значение: словарь с полями id, from_, to_, when_, price (цена)
         '''
         when_ = self._get_date_for_query(when_)
-        tickets = self.session.query(Ticket).filter(and_( \
-            Ticket.from_ == from_ if from_ else True, \
-            Ticket.to_ == to_ if to_ else True, \
-            Ticket.when_ > when_)) \
-            .order_by(Ticket.from_.asc(), Ticket.price.asc()).limit(limit)
+
+        if not use_cache or self.tickets_cache is None:
+            return self._query_tickets(when_, from_, to_, limit, after)
+
+        # один ключ на маршрут, день и страницу: в кэше хранится результат для самого раннего when_ этого дня
+        key = (from_, to_, when_.date(), limit, after)
+        version = self.inventory_version
+        cached = self.tickets_cache.get(key, version, lambda entry: self._is_cached_tickets_valid(entry, when_, limit))
+        if cached is not None:
+            return self._filter_departed(cached[1], when_)
+
+        if self.inventory is not None:
+            # снимок перестраивается в фоне и может отставать от записей: результат кэшируется по версии снимка
+            self._columns()
+            version = self.inventory.version
+        result = self._query_tickets(when_, from_, to_, limit, after)
+        self.tickets_cache.put(key, (when_, result), version)
+        return result
+
+    def _filter_departed(self, tickets, when_):
+        return {ticket_id: ticket for ticket_id, ticket in tickets.items() if ticket['when_'] > when_}
+
+    def _is_cached_tickets_valid(self, entry, when_, limit):
+        ''' подходит ли закэшированный результат запроса (cached_when_, tickets) для запроса с when_ '''
+        cached_when_, tickets = entry
+        if when_ < cached_when_:
+            return False  # в кэше нет рейсов между when_ и cached_when_
+
+        # рейсы, вылетевшие до when_, отбрасываются; если результат был обрезан по limit, в БД могут быть замены
+        is_complete = limit is None or len(tickets) < limit
+        return is_complete or all(ticket['when_'] > when_ for ticket in tickets.values())
+
+    def _query_tickets(self, when_, from_, to_, limit, after=None):
+        if self.inventory is not None:
+            return self._columns().get_tickets(when_, from_, to_, limit, after)
 
         result = {}
-        for ticket in tickets:
-            result[ticket.id] = {
-                'id': ticket.id,
-                'from_': ticket.from_,
-                'to_': ticket.to_,
-                'when_': ticket.when_,
-                'price': ticket.price,
-            }
+        with self._session_scope() as session:
+            tickets = session.query(Ticket).filter(and_( \
+                Ticket.from_ == from_ if from_ else True, \
+                Ticket.to_ == to_ if to_ else True, \
+                Ticket.when_ > when_, \
+                # условие на when_ отдельно: по нему индекс начинает чтение сразу с курсора
+                Ticket.when_ >= after[0] if after else True, \
+                tuple_(Ticket.when_, Ticket.price, Ticket.id) > tuple_(*after) if after else True)) \
+                .order_by(Ticket.when_.asc(), Ticket.price.asc(), Ticket.id.asc()).limit(limit)
+
+            for ticket in tickets:
+                result[ticket.id] = {
+                    'id': ticket.id,
+                    'from_': ticket.from_,
+                    'to_': ticket.to_,
+                    'when_': ticket.when_,
+                    'price': ticket.price,
+                }
 
         return result
 
+    @DISPATCHER_SECONDS.time('get_departure_locations')
     def get_departure_locations(self, when_=None, limit=None):
 
         '''
@@ -256,12 +640,17 @@ class Dispatcher:
         '''
 
         when_ = self._get_date_for_query(when_)
-        locations = self.session.query(Ticket.from_).filter(Ticket.when_ > when_). \
-            group_by(Ticket.from_). \
-            order_by(Ticket.from_.asc()).limit(limit)
+        if self.inventory is not None:
+            return self._columns().get_departure_locations(when_, limit)
+
+        with self._session_scope() as session:
+            locations = session.query(Ticket.from_).filter(Ticket.when_ > when_). \
+                group_by(Ticket.from_). \
+                order_by(Ticket.from_.asc()).limit(limit)
 
-        return [location.from_ for location in locations]
+            return [location.from_ for location in locations]
 
+    @DISPATCHER_SECONDS.time('get_arrival_locations')
     def get_arrival_locations(self, when_=None, limit=None):
 
         '''
@@ -275,12 +664,17 @@ class Dispatcher:
         '''
 
         when_ = self._get_date_for_query(when_)
-        locations = self.session.query(Ticket.to_).filter(Ticket.when_ > when_). \
-            group_by(Ticket.to_). \
-            order_by(Ticket.to_.asc()).limit(limit)
+        if self.inventory is not None:
+            return self._columns().get_arrival_locations(when_, limit)
+
+        with self._session_scope() as session:
+            locations = session.query(Ticket.to_).filter(Ticket.when_ > when_). \
+                group_by(Ticket.to_). \
+                order_by(Ticket.to_.asc()).limit(limit)
 
-        return [location.to_ for location in locations]
+            return [location.to_ for location in locations]
 
+    @DISPATCHER_SECONDS.time('is_route_available')
     def is_route_available(self, from_, to_, when_=None):
 
         '''
@@ -295,22 +689,74 @@ class Dispatcher:
         '''
 
         when_ = self._get_date_for_query(when_)
-        count = self.session.query(Ticket.id).filter(and_( \
-            Ticket.from_ == from_, \
-            Ticket.to_ == to_, \
-            Ticket.when_ > when_)) \
-            .count()
+
+        if self.inventory is not None:
+            return self._columns().is_route_available(from_, to_, when_)
+
+        if self.route_index is not None:
+            if not self.route_index.is_built:
+                with self._session_scope() as session:
+                    self.route_index.rebuild(session)
+            elif self.route_index.is_stale:
+                self.route_index.rebuild_in_background(self._session_scope)
+            return self.route_index.is_available(from_, to_, when_)
+
+        with self._session_scope() as session:
+            count = session.query(Ticket.id).filter(and_( \
+                Ticket.from_ == from_, \
+                Ticket.to_ == to_, \
+                Ticket.when_ > when_)) \
+                .count()
 
         return bool(count)
 
+    @DISPATCHER_SECONDS.time('add_orders')
+    def add_orders(self, orders):
+        '''
+        Запись пачки заказов в БД одной транзакцией (executemany).
+        :param orders: list словарей с полями ORDER_FIELDS
+        :return: int - кол-во записанных заказов
+        '''
+        if not orders:
+            return 0
+
+        stored_at = datetime.datetime.now()
+        rows = [dict(order, stored_at=stored_at) for order in orders]
+        with self._session_scope() as session:
+            session.execute(Order.__table__.insert(), rows)
+        return len(rows)
+
+    def get_orders(self, peer_id=None, limit=None):
+        '''
+        Заказы, начиная с последних.
+        :param peer_id: int - только заказы пользователя (None - все)
+        :return: list словарей с полями id, ORDER_FIELDS, stored_at
+        '''
+        with self._session_scope() as session:
+            query = session.query(Order)
+            if peer_id is not None:
+                query = query.filter(Order.peer_id == peer_id)
+            orders = query.order_by(Order.created_at.desc(), Order.id.desc()).limit(limit)
+
+            return [{column.name: getattr(order, column.name) for column in Order.__table__.columns}
+                    for order in orders]
+
     def _print_tickets(self, tickets: list):
         for ticket in tickets:
             print(ticket)
 
 
 def main():
+    parser = argparse.ArgumentParser(description='Заполнение БД рейсами по расписанию Dispatcher.settings')
+    parser.add_argument('--days', type=int, default=Dispatcher.settings['num_days'],
+                        help='на сколько дней вперед сформировать рейсы')
+    parser.add_argument('--chunk-size', type=int, default=5000, help='кол-во строк в одной транзакции')
+    args = parser.parse_args()
+
     dispatcher = Dispatcher()
-    dispatcher._create_tickets_in_db()
+    stats = dispatcher._create_tickets_in_db(num_days=args.days, chunk_size=args.chunk_size)
+    print(f'Рейсов по расписанию: {stats["rows"]}, записано новых: {stats["inserted"]}, '
+          f'{stats["seconds"]:.2f} сек. ({stats["rows_per_second"]:.0f} строк/сек.)')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,44 @@
+''' Подключение к VK API: к api.vk.com или к другому адресу с тем же протоколом (локальный стенд для нагрузочных тестов) '''
+import requests
+import vk_api
+from vk_api.vk_api import TOO_MANY_RPS_CODE
+
+VK_API_URL = 'https://api.vk.com/method/'
+
+
+class ApiUrlSession(requests.Session):
+    """ Сессия requests, которая отправляет вызовы методов VK API на api_url вместо api.vk.com """
+
+    def __init__(self, api_url):
+        super().__init__()
+        self.api_url = api_url if api_url.endswith('/') else f'{api_url}/'
+
+    def request(self, method, url, *args, **kwargs):
+        if url.startswith(VK_API_URL):
+            url = self.api_url + url[len(VK_API_URL):]
+        return super().request(method, url, *args, **kwargs)
+
+
+def create_vk_session(token, api_url=None):
+    """
+    vk_api.VkApi для токена.
+    :param api_url: str - адрес методов API, например http://127.0.0.1:8081/method/ (None - api.vk.com)
+    """
+
+    if not api_url or api_url == VK_API_URL:
+        return vk_api.VkApi(token=token)
+
+    vk = vk_api.VkApi(token=token, session=ApiUrlSession(api_url))
+    vk.RPS_DELAY = 0  # ограничение частоты запросов api.vk.com к стенду не относится
+    return vk
+
+
+def disable_builtin_rate_limit(vk):
+    """
+    Отключает ограничение частоты vk_api (не больше 3 запросов в сек. на все методы) и его повтор запроса
+    после ошибки "слишком много запросов": частотой отправки управляет scheduler.OutboundScheduler,
+    которому нужна сама ошибка.
+    """
+
+    vk.RPS_DELAY = 0
+    vk.error_handlers.pop(TOO_MANY_RPS_CODE, None)